@@ -1,5 +1,6 @@
 from fireball_clustering.perseus.perseus import Perseus
-from fireball_clustering.database import db_queries, db_setup, db_writes
+from fireball_clustering.database import db_queries, db_setup, db_writer
+from fireball_clustering.readiness import ReadinessTracker
 
 from queue import Queue
 import threading 
@@ -9,12 +10,13 @@ class AnalysisProducer():
     def __init__(self, queue: Queue) -> None:
         self.thread = threading.Thread(target=self.producer_loop)
         self.queue = queue
+        self.tracker = ReadinessTracker()
 
     def producer_loop(self):
         while True:
             time.sleep(10)
             count = 0
-            for stations_to_process in db_queries.getIngestedRadii():
+            for stations_to_process in self.tracker.poll():
                 self.queue.put(stations_to_process)
                 count += 1
             if count:
@@ -41,21 +43,39 @@ class AnalysisConsumer():
                 continue
             
             all_candidates = []
+            stations_data = {}
+            fr_timestamps = {}
             for station_date in stations_to_process:
                 station_id, date = station_date
                 print(f'[AnalysisPipeline] Processing Station: {station_id} for Date: {date}')
+                # Nights emitted again with a later night of their neighbourhood are clustered with
+                # their stored candidates, not processed again
                 if db_queries.isProcessed(station_id, date): 
                     all_candidates.extend(db_queries.getFireballsByStationDate(station_id, date))
+                    continue
                 
                 try:
-                    db_writes.setDataToProcessing([(station_id, date)])
+                    db_writer.submit(('setDataToProcessing', ([(station_id, date)],)))
 
-                    station_data = self.perseus.ingestFieldsumsDB(station_id, date)
-                    fr_timestamps = self.perseus.ingestFrDB(station_id, date)
-                    processed_station_data = self.perseus.process(station_data)
-                    filtered_candidates = self.perseus.identify(station_id, processed_station_data, fr_timestamps)
+                    stations_data[station_date] = self.perseus.ingestFieldsumsDB(station_id, date)
+                    fr_timestamps[station_date] = self.perseus.ingestFrDB(station_id, date)
+                except Exception as e:
+                    stations_data.pop(station_date, None)
+                    print(f'[AnalysisPipeline] PROCESSING ERROR: {e}')
+
+            # The station nights of the cluster are preprocessed together
+            try:
+                processed = self.perseus.processBatch(stations_data)
+            except Exception as e:
+                processed = {}
+                print(f'[AnalysisPipeline] PROCESSING ERROR: {e}')
+
+            for station_date, processed_station_data in processed.items():
+                station_id, date = station_date
+                try:
+                    filtered_candidates = self.perseus.identify(station_id, processed_station_data, fr_timestamps[station_date])
                     all_candidates.extend(filtered_candidates)
-                    db_writes.setDataToProcessed([(station_id, date)])
+                    db_writer.submit(('setDataToProcessed', ([(station_id, date)],)))
                 except Exception as e:
                     print(f'[AnalysisPipeline] PROCESSING ERROR: {e}')
             if all_candidates:
@@ -75,7 +95,9 @@ class AnalysisConsumer():
         self.thread.join()
 
 class Analysis():
-    def __init__(self) -> None:
+    def __init__(self, writer: db_writer.WriterClient | None = None) -> None:
+        # DB writes of the pipeline go through the writer process if there is one
+        db_writer.useClient(writer)
         self.queue = Queue()
         self.producer = AnalysisProducer(self.queue)
         self.consumer = AnalysisConsumer(self.queue)
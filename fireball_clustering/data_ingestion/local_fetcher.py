@@ -2,50 +2,190 @@
     Data ingestion from a local file system.
 '''
 import os
-import tarfile
 import io
-import datetime
+import tarfile
+import numpy as np
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import resource_tracker, shared_memory
 
-from fireball_clustering.utils.fieldsum_handlers import readFieldIntensitiesBytes, filenameToDatetime
+from fireball_clustering.utils.fieldsum_handlers import (iterFieldIntensitiesTarball, filenameToDatetime,
+                                                          frameTimestamps, mergeSortedBlocks)
 from fireball_clustering.dataclasses.models import StationData
+from fireball_clustering import parameters
+
+FPS = parameters.FPS
+DEINTERLACE = parameters.DEINTERLACE
+
+# Bytes per sample in a worker's shared memory block (int64 timestamp + uint32 intensity)
+_SAMPLE_BYTES = 12
+
+# Process pool of this process and the (pid, workers) it was created for, reused across uploads
+_executor = None
+_executor_key = None
+
+def _decodeFsArchive(fs_tarball: tarfile.TarFile) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    Decodes every FS file of an opened FS archive into time sorted (timestamps, intensities) arrays.
+    '''
+    timestamp_blocks = []
+    intensity_blocks = []
+
+    # Each FS file is a sorted block starting at the time in its name
+    for file_name, intensity_arr in iterFieldIntensitiesTarball(fs_tarball, deinterlace=DEINTERLACE):
+        start_time = filenameToDatetime(file_name)
+        timestamp_blocks.append(frameTimestamps(start_time, len(intensity_arr), FPS, deinterlace=DEINTERLACE))
+        intensity_blocks.append(intensity_arr)
 
-FPS = 25
+    return mergeSortedBlocks(timestamp_blocks, intensity_blocks)
 
-def ingestFromTarball(path: str) -> tuple[StationData, list[str]]:
+def _decodeFsArchiveWorker(archive_bytes: bytes) -> tuple[str, int]:
+    '''
+    Process pool worker. Decodes a compressed FS archive and places the result in a new shared memory
+    block laid out as int64 timestamps followed by uint32 intensities.
+
+    Returns:
+        tuple[str, int]: Name of the shared memory block and the number of samples in it.
+    '''
+    with tarfile.open(fileobj=io.BytesIO(archive_bytes), mode='r|bz2') as fs_tarball:
+        timestamps, intensities = _decodeFsArchive(fs_tarball)
+
+    n_samples = len(timestamps)
+    shm = shared_memory.SharedMemory(create=True, size=max(n_samples * _SAMPLE_BYTES, 1))
+    np.ndarray(n_samples, dtype=np.int64, buffer=shm.buf)[:] = timestamps
+    np.ndarray(n_samples, dtype=np.uint32, buffer=shm.buf, offset=n_samples * 8)[:] = intensities
+    # The block outlives this handle, the parent unlinks it once copied. The pool is created after the
+    # parent started its resource tracker, so workers register the block with that tracker and the
+    # parent's unlink unregisters it; only blocks never collected are unlinked when the parent exits.
+    shm.close()
+    return shm.name, n_samples
+
+def _collectSharedBlock(name: str, n_samples: int) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    Copies a worker's decoded samples out of shared memory and frees the block.
+    '''
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        timestamps = np.ndarray(n_samples, dtype=np.int64, buffer=shm.buf).copy()
+        intensities = np.ndarray(n_samples, dtype=np.uint32, buffer=shm.buf, offset=n_samples * 8).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+    return timestamps, intensities
+
+def ingestFromTarball(path: str, streaming: bool = True, workers: int | None = None) -> tuple[StationData, list[str]]:
+    '''
+    Ingests the fieldsums and FR file names from a station upload.
+
+    Args:
+        path (str): Path to the uploaded *.tar.bz2.
+        streaming (bool): If True, read the archive and its nested FS archives sequentially ('r|bz2') in a
+            single decompression pass, decoding each FS file as it streams past. If False, open the outer
+            archive for random access.
+        workers (int): Number of processes used to decompress the nested FS archives in parallel. Defaults
+            to parameters.INGEST_WORKERS. Uploads smaller than parameters.PARALLEL_INGEST_MIN_BYTES, or
+            workers <= 1, are ingested serially.
+    Returns:
+        tuple[StationData, list[str]]: The station data and the FR file names found in the archive.
+    '''
     if not os.path.exists(path):
         raise FileNotFoundError
+
+    workers = parameters.INGEST_WORKERS if workers is None else workers
+    if workers > 1 and os.path.getsize(path) >= parameters.PARALLEL_INGEST_MIN_BYTES:
+        return _ingestFromTarballParallel(path, workers)
     
-    datapoints = []
-    station_data = StationData(datetimes=[], intensities=[])
+    timestamp_blocks = []
+    intensity_blocks = []
     fr_files = []
+    mode = 'r|bz2' if streaming else 'r:bz2'
 
-    with tarfile.open(path, 'r:bz2') as tarball:
-        for member in tarball.getmembers():
+    with tarfile.open(path, mode) as tarball:
+        for member in tarball:
             if member.name.startswith('./FS') and member.name.endswith('.tar.bz2'):
                 inner_file = tarball.extractfile(member)
-                with tarfile.open(fileobj=inner_file, mode='r:bz2') as fs_tarball:
-                    for fs_member in fs_tarball.getmembers():
-                        fs_file = fs_tarball.extractfile(fs_member)
-                        if fs_file == None: continue
-                        fs_file_bytes = io.BytesIO(fs_file.read())
-
-                        timestamp = filenameToDatetime(fs_member.name.split('/')[1])
-                        half_frames, intensity_arr = readFieldIntensitiesBytes(fs_file_bytes)
-
-                        # Add each time step and intensity to in memory data
-                        for i in range(len(half_frames)):
-                            timestamp += datetime.timedelta(seconds=1/FPS)
-                            datapoints.append((timestamp, intensity_arr[i]))
+                with tarfile.open(fileobj=inner_file, mode='r|bz2') as fs_tarball:
+                    timestamps, intensities = _decodeFsArchive(fs_tarball)
+                timestamp_blocks.append(timestamps)
+                intensity_blocks.append(intensities)
 
             if member.name.startswith('./FR'):
                 fr_files.append(member.name)
 
-
     # Sort data by time 
-    datapoints.sort(key = lambda x: x[0])
+    timestamps, intensities = mergeSortedBlocks(timestamp_blocks, intensity_blocks)
+    station_data = StationData(timestamps=timestamps, intensity_array=intensities)
+
+    return (station_data, fr_files)
+
+def _getExecutor(workers: int) -> ProcessPoolExecutor:
+    '''
+    Returns the process pool of the calling process, created on first use and kept for later uploads.
+    A forked child never reuses the pool inherited from its parent.
+    '''
+    global _executor, _executor_key
+    key = (os.getpid(), workers)
+    if _executor_key != key:
+        if _executor is not None and _executor_key[0] == os.getpid():
+            _executor.shutdown()
+        # Workers inherit a running tracker instead of each starting their own (see _decodeFsArchiveWorker)
+        resource_tracker.ensure_running()
+        _executor = ProcessPoolExecutor(max_workers=workers)
+        _executor_key = key
+    return _executor
 
-    # Add data to return variable
-    station_data.datetimes = [x[0] for x in datapoints]
-    station_data.intensities = [x[1] for x in datapoints]
+def _collectFuture(future, timestamp_blocks: list, intensity_blocks: list, errors: list) -> None:
+    '''
+    Waits for a decode job and appends its samples to the blocks, or its exception to errors.
+    '''
+    global _executor, _executor_key
+    try:
+        timestamps, intensities = _collectSharedBlock(*future.result())
+    except BrokenProcessPool as e:
+        # A worker died, the next upload starts a fresh pool
+        _executor = _executor_key = None
+        errors.append(e)
+        return
+    except Exception as e:
+        errors.append(e)
+        return
+    timestamp_blocks.append(timestamps)
+    intensity_blocks.append(intensities)
+
+def _ingestFromTarballParallel(path: str, workers: int) -> tuple[StationData, list[str]]:
+    '''
+    Streams the outer archive and hands the raw bytes of each nested FS archive to the process pool,
+    so the bz2 decompression of the FS archives runs on several cores. At most 2 archives per worker
+    are in flight, the stream waits for the oldest one before reading further.
+    '''
+    executor = _getExecutor(workers)
+    pending = deque()
+    timestamp_blocks = []
+    intensity_blocks = []
+    errors = []
+    fr_files = []
+
+    try:
+        with tarfile.open(path, 'r|bz2') as tarball:
+            for member in tarball:
+                if member.name.startswith('./FS') and member.name.endswith('.tar.bz2'):
+                    while len(pending) >= 2 * workers:
+                        _collectFuture(pending.popleft(), timestamp_blocks, intensity_blocks, errors)
+                    archive_bytes = tarball.extractfile(member).read()
+                    pending.append(executor.submit(_decodeFsArchiveWorker, archive_bytes))
+
+                if member.name.startswith('./FR'):
+                    fr_files.append(member.name)
+    finally:
+        # Collect every block, even if reading or one worker failed, so no shared memory is leaked
+        while pending:
+            _collectFuture(pending.popleft(), timestamp_blocks, intensity_blocks, errors)
+    if errors:
+        raise errors[0]
+
+    # Sort data by time 
+    timestamps, intensities = mergeSortedBlocks(timestamp_blocks, intensity_blocks)
+    station_data = StationData(timestamps=timestamps, intensity_array=intensities)
 
     return (station_data, fr_files)
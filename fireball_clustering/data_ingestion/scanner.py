@@ -0,0 +1,131 @@
+'''
+    Parallel scanner for the station upload tree.
+
+    The tree is parameters.PATH/<six character station dir>/.../[processed/]<upload>.tar.bz2. Each
+    station directory is walked by a worker thread, since on network mounts the time is spent waiting
+    on directory listings and stats rather than in Python. Directories whose mtime is unchanged are
+    not listed at all when their subdirectories are known from a previous scan.
+'''
+import os
+import time
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+
+from fireball_clustering import parameters
+
+@dataclass
+class ScannedDir:
+    path: str
+    mtime_ns: int
+    # (path, size, mtime_ns) of each upload, None if the directory was pruned as unchanged
+    files: list[tuple[str, int, int]] | None
+    # Paths of the subdirectories that are scanned
+    subdirs: list[str]
+
+@dataclass
+class ScanStats:
+    duration: float = 0.0
+    entries: int = 0
+    dirs: int = 0
+    pruned_dirs: int = 0
+    unlisted_dirs: int = 0
+    files: int = 0
+
+    def add(self, other: 'ScanStats'):
+        self.entries += other.entries
+        self.dirs += other.dirs
+        self.pruned_dirs += other.pruned_dirs
+        self.unlisted_dirs += other.unlisted_dirs
+        self.files += other.files
+
+    def __str__(self) -> str:
+        return (f'{self.dirs} dirs ({self.pruned_dirs} unchanged, {self.unlisted_dirs} not listed), {self.entries} entries, '
+                f'{self.files} uploads in {self.duration:.2f}s')
+
+def isScannedDir(name: str) -> bool:
+    return name.lower() == 'processed' or len(name) == 6
+
+class ParallelScanner():
+    def __init__(self, workers: int | None = None) -> None:
+        self.workers = parameters.SCAN_WORKERS if workers is None else workers
+
+    def scan(self, root: str, dir_mtimes: dict[str, int] | None = None,
+             dir_subdirs: dict[str, list[str]] | None = None) -> tuple[list[ScannedDir], ScanStats]:
+        '''
+        Scans the upload tree below root.
+
+        Args:
+            root (str): Root of the upload tree.
+            dir_mtimes (dict): mtime_ns of directories from a previous scan. Directories whose mtime is
+                unchanged are pruned: their uploads are not listed or stat'ed, only their subdirectories
+                are followed.
+            dir_subdirs (dict): Subdirectories of directories from the same scan. A pruned directory in
+                it is not listed at all, since adding, removing or renaming a subdirectory changes its mtime.
+        Returns:
+            tuple[list[ScannedDir], ScanStats]: Every directory visited and the statistics of the scan.
+        '''
+        dir_mtimes = {} if dir_mtimes is None else dir_mtimes
+        dir_subdirs = {} if dir_subdirs is None else dir_subdirs
+        start_time = time.time()
+        stats = ScanStats()
+
+        # The root is listed here, the station directories below it are walked concurrently
+        root_dir, station_dirs = self._scanDir(root, dir_mtimes, dir_subdirs, stats)
+        results = [root_dir]
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for station_results, station_stats in executor.map(lambda path: self._walk(path, dir_mtimes, dir_subdirs), station_dirs):
+                results.extend(station_results)
+                stats.add(station_stats)
+
+        stats.duration = time.time() - start_time
+        return results, stats
+
+    def _walk(self, dir: str, dir_mtimes: dict[str, int], dir_subdirs: dict[str, list[str]]) -> tuple[list[ScannedDir], ScanStats]:
+        stats = ScanStats()
+        results = []
+        pending = [dir]
+        while pending:
+            scanned_dir, subdirs = self._scanDir(pending.pop(), dir_mtimes, dir_subdirs, stats)
+            results.append(scanned_dir)
+            pending.extend(subdirs)
+        return results, stats
+
+    def _scanDir(self, dir: str, dir_mtimes: dict[str, int], dir_subdirs: dict[str, list[str]],
+                 stats: ScanStats) -> tuple[ScannedDir, list[str]]:
+        try:
+            mtime_ns = os.stat(dir).st_mtime_ns
+        except OSError as e:
+            print(f'[Scanner] Skipping {dir}: {e}')
+            return ScannedDir(dir, 0, None, []), []
+        unchanged = dir_mtimes.get(dir) == mtime_ns
+
+        # On network mounts the listing is the main cost, an unchanged directory reuses its last one
+        if unchanged and dir in dir_subdirs:
+            stats.dirs += 1
+            stats.pruned_dirs += 1
+            stats.unlisted_dirs += 1
+            return ScannedDir(dir, mtime_ns, None, dir_subdirs[dir]), dir_subdirs[dir]
+
+        files = None if unchanged else []
+        subdirs = []
+
+        # is_dir()/is_file() answer from the cached d_type, only uploads are stat'ed
+        try:
+            with os.scandir(dir) as it:
+                for entry in it:
+                    stats.entries += 1
+                    if entry.is_dir():
+                        if isScannedDir(entry.name):
+                            subdirs.append(entry.path)
+                    elif not unchanged and entry.name.endswith('tar.bz2') and entry.is_file():
+                        entry_stat = entry.stat()
+                        files.append((entry.path, entry_stat.st_size, entry_stat.st_mtime_ns))
+                        stats.files += 1
+        except OSError as e:
+            print(f'[Scanner] Skipping {dir}: {e}')
+            return ScannedDir(dir, 0, None, []), []
+
+        stats.dirs += 1
+        stats.pruned_dirs += int(unchanged)
+        return ScannedDir(dir, mtime_ns, files, subdirs), subdirs
@@ -10,10 +10,9 @@ import bisect
 import pandas as pd
 from sklearn.cluster import DBSCAN
 
-from ..database import db_writes, db_queries
-from fireball_clustering.database import db_connection
+from ..database import db_writer, db_queries
 from .. import parameters
-from ..dataclasses.models import ProcessedStationData, Fireball
+from ..dataclasses.models import ProcessedStationData, Fireball, FireballBatch
 
 # TODO: Add lat and lng into the data considerations (could just include it in station_data to have it for reference everywhere)
 def identifyFireballs(station_name: str, station_data: ProcessedStationData, save_to_db=True) -> list[Fireball]:
@@ -22,54 +21,48 @@ def identifyFireballs(station_name: str, station_data: ProcessedStationData, sav
         station_data (dict): Dictionary with processed station data.
         save_to_db (bool): If True, saves the fireball data to the database.
     '''
-    if len(station_data.datetimes) == 0: return [] 
+    if len(station_data) == 0: return [] 
     
-    fireballs = []
+    starts, ends = detectCrossings(station_data.detrended_array, station_data.moving_std_array, parameters.CUTOFF)
 
-    # Modify into feature space
-    up = True
-    down = False
-    event = [] # (start_time, end_time, station_id)
-    
-    # Peak detection
-    # TODO: optimize
-    CUTOFF = parameters.CUTOFF # multiple of sigma
-    for idx in range(len(station_data.intensities)):
-        std = station_data.moving_std[idx]
-        if station_data.detrended_intensities[idx] >= CUTOFF * std and up:
-            up = False
-            down = True
-
-            event.append(station_data.datetimes[idx])
-        if station_data.detrended_intensities[idx] <= CUTOFF * std and down:
-            down = False
-            up = True
-
-            event.append(station_data.datetimes[idx])
-            event.append(station_name)
-            fireballs.append(event)
-            
-            event = []
-    
-    # Add fireball events to the DB
-    fireball_ids = db_writes.insertFireballs([(station_name,
-                                datetime.datetime.isoformat(start_time),
-                                datetime.datetime.isoformat(end_time))
-                                for start_time, end_time, station_name in fireballs])
-    
-    # TODO: create better method for returning fireballs without getting them from the db
-    # Convert to fireball dataclass
-    for i in range(len(fireballs)):
-        fireballs[i].append(fireball_ids[i])
-    
-    fireballs_dataclass = [Fireball(
-        station_name=station_name,
-        start_time=start_time,
-        end_time=end_time,
-        id=id
-    ) for start_time, end_time, station_name, id in fireballs]
+    fireballs = FireballBatch(station_name, station_data.timestamps[starts], station_data.timestamps[ends])
+
+    # Add fireball events to the DB, in one bulk insert
+    if save_to_db:
+        fireball_ids, = db_writer.call(('insertFireballs', (fireballs,)))
+        fireballs.ids = np.array(fireball_ids, dtype=np.int64)
+
+    return fireballs.toFireballs()
 
-    return fireballs_dataclass 
+def detectCrossings(detrended: np.ndarray, moving_std: np.ndarray, cutoff: float) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    Finds events where the detrended intensity rises to cutoff * moving std and falls back to it.
+
+    Same semantics as walking the samples with an up/down state: waiting (up), a sample at or above
+    the threshold starts an event; during an event (down), a sample at or below it ends the event.
+    A sample exactly at the threshold both starts and ends an event when waiting, so the event
+    starts and ends on it. Samples where either value is NaN (e.g. the single-sample windows at the
+    start of a series) are neither above nor below and leave the state unchanged. An event still
+    open at the end is dropped.
+
+    Returns:
+        tuple[ndarray, ndarray]: Sample index of the start and of the end of each event.
+    '''
+    detrended = np.asarray(detrended, dtype=np.float64)
+    threshold = cutoff * np.asarray(moving_std, dtype=np.float64)
+    valid = ~(np.isnan(detrended) | np.isnan(threshold))
+    above = valid & (detrended >= threshold)
+    below = valid & (detrended <= threshold)
+
+    # The state after a sample is set by the last valid sample so far: during an event after one
+    # strictly above, waiting after one at or below. The state before a sample is the one after the previous.
+    last_valid = np.maximum.accumulate(np.where(valid, np.arange(len(valid)), -1))
+    in_event_after = np.where(last_valid >= 0, (above & ~below)[np.maximum(last_valid, 0)], False)
+    in_event_before = np.concatenate(([False], in_event_after[:-1]))
+
+    starts = np.flatnonzero(above & ~in_event_before)
+    ends = np.flatnonzero(below & (above | in_event_before))
+    return starts[:len(ends)], ends
 
 def filterFireballsWithFR(fireballs: list[Fireball], fr_timestamps: list[datetime.datetime]):
     '''
@@ -103,7 +96,7 @@ def filterFireballsWithFR(fireballs: list[Fireball], fr_timestamps: list[datetim
         if left_delta <= MAX_DELTA or (right_delta and right_delta <= MAX_DELTA):
             candidates.append(fireball)
 
-    db_writes.insertCandidateFireballs(candidates)
+    db_writer.submit(('insertCandidateFireballs', (candidates,)))
         
     return candidates
 
@@ -191,10 +184,6 @@ def clusterFireballs(fireballs: list[Fireball]):
         'end_iso_str': lambda x: max(list(x)),
     })
 
-    db = db_connection.Database()
-    conn = db.conn
-    with db.lock:
-        sql_st_clusters_collapsed.to_sql('pandas_clusters', conn, if_exists='append', index=False,
-                                         dtype={'cluster_id': 'INTEGER PRIMARY KEY AUTOINCREMENT','station_id': 'TEXT', 'start_iso_str': 'TEXT', 'end_iso_str': 'TEXT'})
-    db.conn.close()
+    db_writer.submit(('insertPandasClusters', (list(sql_st_clusters_collapsed[[
+        'spatiotemporal_cluster_id', 'station_id', 'start_iso_str', 'end_iso_str']].itertuples(index=False, name=None)),)))
     return spatiotemporal_clusters 
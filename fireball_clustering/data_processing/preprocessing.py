@@ -4,16 +4,18 @@
     Date: 2025-01-30
 '''
 import os
-import pandas as pd
+import numpy as np
 import datetime
 from scipy import signal
 from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 from ..utils import fieldsum_handlers as fh
+from .. import parameters
 from ..dataclasses.models import StationData, ProcessedStationData    
 
-# TODO: change from default 25
-FPS = 25 # FPS of camera, assumed to be 25
+FPS = parameters.FPS # FPS of camera
+DEINTERLACE = parameters.DEINTERLACE
 
 def ingestStationData(fieldsums_path: str):
     '''
@@ -22,8 +24,7 @@ def ingestStationData(fieldsums_path: str):
     Returns:
         StationData: StationData dataclass with fieldsum data.
     '''
-    datapoints = []
-    station_data = StationData(datetimes=[], intensities=[])
+    station_data = StationData()
 
     try:
         fieldsum_files = os.listdir(fieldsums_path)
@@ -32,22 +33,18 @@ def ingestStationData(fieldsums_path: str):
         return station_data
 
     # Iterate through fieldsum files
+    timestamp_blocks = []
+    intensity_blocks = []
     for f in fieldsum_files:
         # Get starting timestamp and fieldsum data
-        timestamp = fh.filenameToDatetime(f)
-        half_frames, intensity_arr = fh.readFieldIntensitiesBin(fieldsums_path, f)
-        
-        # Add each time step and intensity to in memory data
-        for i in range(len(half_frames)):
-            timestamp += datetime.timedelta(seconds=1/FPS)
-            datapoints.append((timestamp, intensity_arr[i]))
+        start_time = fh.filenameToDatetime(f)
+        _, intensity_arr = fh.readFieldIntensitiesBin(fieldsums_path, f, deinterlace=DEINTERLACE)
+        timestamp_blocks.append(fh.frameTimestamps(start_time, len(intensity_arr), FPS, deinterlace=DEINTERLACE))
+        intensity_blocks.append(intensity_arr)
 
     # Sort data by time 
-    datapoints.sort(key = lambda x: x[0])
-
-    # Add data to return variable
-    station_data.datetimes = [x[0] for x in datapoints]
-    station_data.intensities = [x[1] for x in datapoints]
+    timestamps, intensities = fh.mergeSortedBlocks(timestamp_blocks, intensity_blocks)
+    station_data = StationData(timestamps=timestamps, intensity_array=intensities)
 
     return station_data
 
@@ -70,54 +67,165 @@ def ingestFRFiles(fr_file_path: str):
     fr_timestamps = [fh.filenameToDatetime(i) for i in fr_files]
     return fr_timestamps
 
-# TODO: convert to dataframe before handling data
-def preprocessFieldsums(station_data: StationData, avg_window=30, std_window=30) -> ProcessedStationData:
+def preprocessFieldsums(station_data: StationData, avg_window=None, std_window=None) -> ProcessedStationData:
     '''
     Applies a bandpass filter and detrends the fieldsum data for a single station.
 
     Args:
-        station_data (dict): Dictionary with station data 'datetimes', 'intensities'.
-        window (int): The window size to be used for detrending and the std.
+        station_data (StationData): Samples sorted by timestamp.
+        avg_window (int): The window size in seconds of the moving average used for detrending,
+            parameters.AVG_WINDOW by default.
+        std_window (int): The window size in seconds of the moving std, parameters.STD_WINDOW by default.
     Returns:
-        ProcessedStationData: A ProcessedStationData object.
+        ProcessedStationData: A ProcessedStationData object, sharing the timestamp and intensity
+            arrays of station_data.
     '''
-    if len(station_data.intensities) == 0:
-        return ProcessedStationData([], [], [], [])
+    return preprocessBatch({None: station_data}, avg_window, std_window)[None]
 
-    # Convert station data to dataframe
-    df = pd.DataFrame({ 
-        'datetimes': station_data.datetimes,
-        'intensities': station_data.intensities,
-    })
-    df['datetimes'] = pd.to_datetime(df['datetimes'], format='ISO8601')
-    df = df.set_index('datetimes')
+def preprocessBatch(stations_data: dict, avg_window=None, std_window=None) -> dict:
+    '''
+    Preprocesses the station nights of a cluster together: the segments of all nights share one
+    filter design and one worker pool, so a cluster costs about as much as its longest segments
+    spread over parameters.PREPROCESS_WORKERS threads.
 
-    # Bandpass Filter
-    b, a = signal.butter(4, [1/10, 1], btype='bandpass', fs=FPS)
-    df['bandpass_intensities'] = signal.filtfilt(b, a, df['intensities'])
-    df['bandpass_intensities'] = abs(df['bandpass_intensities'])
+    Args:
+        stations_data (dict): Keys (e.g. station ids) to StationData.
+        avg_window, std_window (int): As for preprocessFieldsums.
+    Returns:
+        dict: The same keys to ProcessedStationData, as used by clustering.identifyFireballs.
+    '''
+    outputs = {}
+    segments = []
+    for key, station_data in stations_data.items():
+        if len(station_data) == 0:
+            outputs[key] = ProcessedStationData([], [], [], [])
+            continue
+        # Segments write their results straight into their slice of the outputs
+        outputs[key] = ProcessedStationData(
+            timestamps = station_data.timestamps,
+            intensity_array = station_data.intensity_array,
+            detrended_array = np.empty(len(station_data)),
+            moving_std_array = np.empty(len(station_data)),
+        )
+        edges = segmentEdges(station_data.timestamps)
+        segments.extend((station_data, outputs[key], lo, hi) for lo, hi in zip(edges[:-1], edges[1:]))
+
+    _runSegments(segments, avg_window, std_window)
+    return outputs
+
+def preprocessArrays(timestamps: np.ndarray, intensities: np.ndarray, avg_window=None, std_window=None) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    Bandpass → detrend → moving std on arrays. The night is split into contiguous segments at gaps
+    longer than parameters.PREPROCESS_GAP_SECONDS, each segment is processed on its own, so the
+    filter and the windows never run across a gap, and segments are spread over
+    parameters.PREPROCESS_WORKERS threads. Windows are time based like pandas rolling('<N>s'):
+    the window of each sample covers the samples of its segment in (t - window, t].
 
-    # Calculate and subtract moving avg
-    avg_window_size = f'{avg_window}s'
-    std_window_size = f'{std_window}s'
+    Args:
+        timestamps (ndarray): int64 epoch nanoseconds, sorted.
+        intensities (ndarray): Raw intensities.
+        avg_window, std_window (int): Window sizes in seconds, parameters.AVG_WINDOW and
+            parameters.STD_WINDOW by default.
+    Returns:
+        tuple[ndarray, ndarray]: float64 detrended intensities and their moving std (ddof=1, NaN
+            where the window holds a single sample).
+    '''
+    processed = preprocessFieldsums(StationData(timestamps=timestamps, intensity_array=intensities), avg_window, std_window)
+    return processed.detrended_array, processed.moving_std_array
 
-    df[f'{avg_window_size}_moving_avg'] = df['bandpass_intensities'].rolling(window=avg_window_size).mean()
-    df['detrended_intensities'] = abs(df['bandpass_intensities'] - df[f'{avg_window_size}_moving_avg'])
+@lru_cache
+def bandpassCoefficients(fps: float = FPS) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    Returns:
+        tuple[ndarray, ndarray]: (b, a) of the Butterworth bandpass, designed once per frame rate.
+    '''
+    return signal.butter(4, [1/10, 1], btype='bandpass', fs=fps)
+
+def _runSegments(segments: list, avg_window, std_window):
+    avg_window = parameters.AVG_WINDOW if avg_window is None else avg_window
+    std_window = parameters.STD_WINDOW if std_window is None else std_window
+    b, a = bandpassCoefficients()
+
+    def preprocessSegment(segment):
+        station_data, processed, lo, hi = segment
+        processed.detrended_array[lo:hi], processed.moving_std_array[lo:hi] = _preprocessSegment(
+            station_data.timestamps[lo:hi], station_data.intensity_array[lo:hi], b, a, avg_window, std_window)
+
+    if len(segments) <= 1 or parameters.PREPROCESS_WORKERS <= 1:
+        for segment in segments:
+            preprocessSegment(segment)
+    else:
+        # filtfilt and the numpy kernels release the GIL, so threads filter segments in parallel.
+        # Longest segments first, so a long one does not start last.
+        segments = sorted(segments, key=lambda segment: segment[2] - segment[3])
+        with ThreadPoolExecutor(max_workers=parameters.PREPROCESS_WORKERS) as executor:
+            list(executor.map(preprocessSegment, segments))
+
+def _preprocessSegment(timestamps: np.ndarray, intensities: np.ndarray, b, a, avg_window, std_window) -> tuple[np.ndarray, np.ndarray]:
+    # Bandpass Filter, segments shorter than the default padding are padded less
+    bandpass = np.abs(signal.filtfilt(b, a, intensities, padlen=min(3 * max(len(a), len(b)), len(intensities) - 1)))
 
-    # Calculate moving standard dev
-    df[f'moving_std'] = df['detrended_intensities'].rolling(window=std_window_size).std()
+    # Calculate and subtract moving avg
+    avg_starts = windowStarts(timestamps, avg_window)
+    detrended = np.abs(bandpass - movingMean(bandpass, avg_starts))
 
-    # Return updated dataset
-    df = df.reset_index()
-    df = df.drop(columns=[f'{avg_window_size}_moving_avg'])
-    processed_data = df.to_dict(orient='list')
+    # Calculate moving standard dev
+    std_starts = avg_starts if std_window == avg_window else windowStarts(timestamps, std_window)
+    return detrended, movingStd(detrended, std_starts)
 
-    processed_station_data = ProcessedStationData(
-        datetimes = processed_data['datetimes'],
-        intensities = processed_data['intensities'],
-        detrended_intensities = processed_data['detrended_intensities'],
-        moving_std = processed_data['moving_std'],
-    )
+def segmentEdges(timestamps: np.ndarray, gap_seconds: float | None = None) -> np.ndarray:
+    '''
+    Args:
+        gap_seconds (float): Smallest gap that splits segments, parameters.PREPROCESS_GAP_SECONDS by default.
+    Returns:
+        ndarray: Index of the first sample of each contiguous segment, followed by len(timestamps).
+    '''
+    gap_ns = int((parameters.PREPROCESS_GAP_SECONDS if gap_seconds is None else gap_seconds) * 1e9)
+    breaks = np.flatnonzero(np.diff(timestamps) > gap_ns) + 1
+    return np.concatenate(([0], breaks, [len(timestamps)]))
 
-    return processed_station_data 
+def windowStarts(timestamps: np.ndarray, window_seconds: float) -> np.ndarray:
+    '''
+    Finds the (t - window, t] window of each sample by time, so windows stay correct across the gaps
+    between FS files and capture sessions. The limits are sorted like the timestamps, so one
+    vectorized search over the night is enough.
 
+    Returns:
+        ndarray: Index of the first sample in the window of each sample.
+    '''
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    return np.searchsorted(timestamps, timestamps - int(window_seconds * 1e9), side='right')
+
+def movingMean(values: np.ndarray, starts: np.ndarray) -> np.ndarray:
+    sums = _windowSums(values, starts)
+    return sums / (np.arange(1, len(values) + 1) - starts)
+
+def movingStd(values: np.ndarray, starts: np.ndarray) -> np.ndarray:
+    counts = np.arange(1, len(values) + 1) - starts
+    # Sums around the overall mean keep the cumulative sums small
+    centered = values - values.mean()
+    sums = _windowSums(centered, starts)
+    sums_sq = _windowSums(centered * centered, starts)
+    variance = np.divide(sums_sq - sums * sums / counts, counts - 1,
+                         out=np.full(len(values), np.nan), where=counts > 1)
+    return np.sqrt(np.maximum(variance, 0.0, out=variance, where=counts > 1))
+
+def _windowSums(values: np.ndarray, starts: np.ndarray) -> np.ndarray:
+    cumulative, compensation = _compensatedCumsum(values)
+    return (cumulative[1:] - cumulative[starts]) + (compensation[1:] - compensation[starts])
+
+def _compensatedCumsum(values: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    Cumulative sums with a leading 0, and the running total of their rounding errors. np.cumsum adds
+    sequentially, so the error of each addition is recovered exactly afterwards with TwoSum, and
+    cumulative + compensation is accurate to about the precision of the compensation itself.
+    '''
+    cumulative = np.zeros(len(values) + 1)
+    np.cumsum(values, out=cumulative[1:])
+    previous = cumulative[:-1]
+    # TwoSum(previous, value): the exact error of fl(previous + value)
+    value_part = cumulative[1:] - previous
+    errors = (previous - (cumulative[1:] - value_part)) + (values - value_part)
+    compensation = np.zeros(len(values) + 1)
+    np.cumsum(errors, out=compensation[1:])
+    return cumulative, compensation
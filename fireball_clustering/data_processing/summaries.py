@@ -0,0 +1,50 @@
+'''
+    Per-station summaries of the fieldsums in fixed time bins, written at ingestion so that
+    screening can find the interesting windows without loading full-resolution nights.
+'''
+import numpy as np
+
+from .. import parameters
+from ..dataclasses.models import StationData
+
+def summarizeFieldsums(station_data: StationData, bin_seconds: int | None = None) -> list[tuple[int, int, int, float, float, float]]:
+    '''
+    Summarizes the samples of a station night in bins aligned to multiples of bin_seconds since the
+    epoch. Within each bin the intensities are detrended by their least squares line, the
+    excursion is the largest positive residual.
+
+    Args:
+        station_data (StationData): Samples sorted by timestamp.
+        bin_seconds (int): Bin size, parameters.SUMMARY_BIN_SECONDS by default.
+    Returns:
+        list[tuple]: (bin_start_ns, n_samples, max, mean, std, max_excursion) of each non-empty bin,
+            intensities in raw units and std with ddof=0.
+    '''
+    if len(station_data) == 0:
+        return []
+    bin_ns = int((parameters.SUMMARY_BIN_SECONDS if bin_seconds is None else bin_seconds) * 1e9)
+
+    timestamps = np.asarray(station_data.timestamps, dtype=np.int64)
+    intensities = np.asarray(station_data.intensity_array, dtype=np.float64)
+    bins = timestamps // bin_ns
+    bin_edges = np.flatnonzero(np.diff(bins, prepend=bins[0] - 1))
+    counts = np.diff(np.append(bin_edges, len(bins)))
+
+    # Two passes around the bin means, sums of raw intensities in the billions lose the variance
+    means = np.add.reduceat(intensities, bin_edges) / counts
+    deviations = intensities - np.repeat(means, counts)
+    stds = np.sqrt(np.add.reduceat(deviations ** 2, bin_edges) / counts)
+
+    # Least squares slope of each bin against time (seconds) from the bin's mean time
+    seconds = (timestamps - np.repeat(timestamps[bin_edges], counts)) / 1e9
+    seconds -= np.repeat(np.add.reduceat(seconds, bin_edges) / counts, counts)
+    seconds_sq = np.add.reduceat(seconds ** 2, bin_edges)
+    slopes = np.divide(np.add.reduceat(seconds * deviations, bin_edges), seconds_sq,
+                       out=np.zeros(len(bin_edges)), where=seconds_sq > 0)
+    residuals = deviations - np.repeat(slopes, counts) * seconds
+
+    maxima = np.maximum.reduceat(station_data.intensity_array, bin_edges)
+    excursions = np.maximum(np.maximum.reduceat(residuals, bin_edges), 0.0)
+
+    return list(zip((bins[bin_edges] * bin_ns).tolist(), counts.tolist(), maxima.tolist(),
+                    means.tolist(), stds.tolist(), excursions.tolist()))
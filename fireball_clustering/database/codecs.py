@@ -0,0 +1,146 @@
+'''
+    Codecs for the fieldsum intensity series.
+
+    A codec is a transform, optionally followed by a general purpose compression stage, and is named
+    '<transform>[+<stage>]', e.g. 'raw', 'delta', 'delta+zlib', 'raw+lzma'. Transforms:
+        raw:   little-endian uint32 values.
+        delta: first differences, zigzag mapped to unsigned, then bit-packed in blocks of BLOCK_SIZE
+               values. Each block uses the bit width of its largest value:
+                   uint8[n_blocks] bit width of each block
+                   bit-packed blocks, BLOCK_SIZE * width / 8 bytes each, least significant bit first
+    Stages: zlib, lzma (stdlib).
+
+    The codec id stored in blob and file headers is the transform id in the low byte and the stage id
+    in the high byte, so 0 is always raw.
+'''
+import lzma
+import zlib
+import numpy as np
+
+BLOCK_SIZE = 128
+
+TRANSFORMS = {'raw': 0, 'delta': 1}
+STAGES = {'': 0, 'zlib': 1, 'lzma': 2}
+
+CODEC_RAW = 0
+CODECS = ['raw', 'delta', 'raw+zlib', 'delta+zlib', 'raw+lzma', 'delta+lzma']
+
+def codecId(name: str) -> int:
+    transform, _, stage = name.partition('+')
+    if transform not in TRANSFORMS or stage not in STAGES:
+        raise ValueError(f'Unknown fieldsum codec: {name}')
+    return TRANSFORMS[transform] | STAGES[stage] << 8
+
+def codecName(codec_id: int) -> str:
+    transforms = {v: k for k, v in TRANSFORMS.items()}
+    stages = {v: k for k, v in STAGES.items()}
+    transform, stage = transforms.get(codec_id & 0xFF), stages.get(codec_id >> 8)
+    if transform is None or stage is None:
+        raise ValueError(f'Unknown fieldsum codec id: {codec_id}')
+    return f'{transform}+{stage}' if stage else transform
+
+def encode(values: np.ndarray, codec_id: int) -> bytes:
+    '''
+    Args:
+        values (ndarray): uint32 intensities.
+        codec_id (int): See codecId.
+    Returns:
+        bytes: The encoded values. The number of values is not included, it is kept in the header.
+    '''
+    values = np.asarray(values, dtype='<u4')
+    transform, stage = codec_id & 0xFF, codec_id >> 8
+    if transform == TRANSFORMS['raw']:
+        payload = values.tobytes()
+    elif transform == TRANSFORMS['delta']:
+        payload = _packDeltas(values)
+    else:
+        raise ValueError(f'Unknown fieldsum codec id: {codec_id}')
+
+    if stage == STAGES['zlib']:
+        return zlib.compress(payload, 6)
+    if stage == STAGES['lzma']:
+        return lzma.compress(payload, preset=6)
+    return payload
+
+def decode(payload, n_values: int, codec_id: int) -> np.ndarray:
+    '''
+    Returns:
+        ndarray: uint32 intensities. For the raw codec without a stage this is a read-only view on
+            the payload, otherwise a new array.
+    '''
+    transform, stage = codec_id & 0xFF, codec_id >> 8
+    if stage == STAGES['zlib']:
+        payload = zlib.decompress(payload)
+    elif stage == STAGES['lzma']:
+        payload = lzma.decompress(payload)
+    elif stage != STAGES['']:
+        raise ValueError(f'Unknown fieldsum codec id: {codec_id}')
+
+    if transform == TRANSFORMS['raw']:
+        return np.frombuffer(payload, dtype='<u4', count=n_values)
+    if transform == TRANSFORMS['delta']:
+        return _unpackDeltas(payload, n_values)
+    raise ValueError(f'Unknown fieldsum codec id: {codec_id}')
+
+def _packDeltas(values: np.ndarray) -> bytes:
+    n_blocks = -(-len(values) // BLOCK_SIZE)
+    deltas = np.zeros(n_blocks * BLOCK_SIZE, dtype=np.int64)
+    deltas[:len(values)] = np.diff(values.astype(np.int64), prepend=0)
+    # Zigzag: small negative and positive steps both become small unsigned values
+    zigzag = ((deltas << 1) ^ (deltas >> 63)).view(np.uint64).reshape(n_blocks, BLOCK_SIZE)
+
+    widths = _bitLengths(zigzag.max(axis=1, initial=0))
+    block_offsets = _blockOffsets(widths)
+    packed = np.zeros(int(block_offsets[-1]) + int(widths[-1]) * (BLOCK_SIZE // 8) if n_blocks else 0, dtype=np.uint8)
+    for width in np.unique(widths):
+        if width == 0:
+            continue
+        block_index = np.flatnonzero(widths == width)
+        bits = ((zigzag[block_index, :, None] >> np.arange(width, dtype=np.uint64)) & np.uint64(1)).astype(np.uint8)
+        byte_index = block_offsets[block_index, None] + np.arange(int(width) * BLOCK_SIZE // 8)
+        packed[byte_index] = np.packbits(bits.reshape(len(block_index), -1), axis=1, bitorder='little')
+
+    return widths.tobytes() + packed.tobytes()
+
+def _unpackDeltas(payload, n_values: int) -> np.ndarray:
+    n_blocks = -(-n_values // BLOCK_SIZE)
+    payload = np.frombuffer(payload, dtype=np.uint8)
+    widths = payload[:n_blocks]
+    block_offsets = _blockOffsets(widths)
+
+    # Every value lies within the 8 bytes starting at the byte of its first bit (width + shift <= 41
+    # bits), so each one is a single unaligned little-endian uint64 load, shift and mask
+    packed = np.zeros(len(payload) - n_blocks + 8, dtype=np.uint8)
+    packed[:len(payload) - n_blocks] = payload[n_blocks:]
+    words = np.ndarray(shape=(len(packed) - 7,), dtype='<u8', buffer=packed, strides=(1,))
+
+    value_widths = np.repeat(widths.astype(np.int64), BLOCK_SIZE)[:n_values]
+    bit_offsets = np.tile(np.arange(BLOCK_SIZE, dtype=np.int64), n_blocks)[:n_values] * value_widths
+    byte_offsets = np.repeat(block_offsets, BLOCK_SIZE)[:n_values] + (bit_offsets >> 3)
+    masks = (np.uint64(1) << value_widths.astype(np.uint64)) - np.uint64(1)
+    zigzag = (words[byte_offsets] >> (bit_offsets & 7).astype(np.uint64)) & masks
+
+    deltas = (zigzag >> np.uint64(1)).view(np.int64) ^ -(zigzag & np.uint64(1)).view(np.int64)
+    return np.cumsum(deltas).astype(np.uint32)
+
+def _blockOffsets(widths: np.ndarray) -> np.ndarray:
+    '''
+    Returns:
+        ndarray: int64 byte offset of each packed block.
+    '''
+    block_sizes = widths.astype(np.int64) * (BLOCK_SIZE // 8)
+    return np.cumsum(block_sizes) - block_sizes
+
+def _bitLengths(values: np.ndarray) -> np.ndarray:
+    '''
+    Returns:
+        ndarray: uint8 number of bits needed for each uint64 value.
+    '''
+    lengths = np.zeros(len(values), dtype=np.uint8)
+    remaining = values.copy()
+    for shift in (32, 16, 8, 4, 2, 1):
+        over = remaining >= (np.uint64(1) << np.uint64(shift))
+        lengths[over] += shift
+        remaining[over] >>= np.uint64(shift)
+    lengths[remaining > 0] += 1
+    return lengths
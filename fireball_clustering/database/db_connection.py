@@ -1,10 +1,105 @@
+'''
+    Pooled connections to the SQLite DB used in this project.
+
+    Each thread of each process keeps one long-lived connection, opened on first use with the
+    pragmas below and a prepared statement cache, instead of connecting for every statement.
+    Pooled connections must not be closed by callers; use closeConnection().
+'''
+import os
 import sqlite3
+import threading
 import multiprocessing
+from contextlib import contextmanager
+
+from fireball_clustering import parameters
+
+DB_PATH = 'gmn_fireball_clustering.db'
 
 class Database():
+    '''
+    Kept for callers that use db.conn / db.cur / db.lock, backed by the pooled connection.
+    '''
+    # Serializes writers across the processes forked from the main process
     lock = multiprocessing.Lock()
 
     def __init__(self) -> None:
-        self.conn = sqlite3.connect('gmn_fireball_clustering.db')
-        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn = getConnection()
         self.cur = self.conn.cursor()
+
+_local = threading.local()
+
+def getConnection() -> sqlite3.Connection:
+    '''
+    Returns:
+        sqlite3.Connection: The connection of the calling thread, opened on first use.
+    '''
+    # A connection inherited through fork belongs to the parent and is never reused
+    if getattr(_local, 'pid', None) != os.getpid():
+        _local.conn = None
+        _local.depth = 0
+        _local.pid = os.getpid()
+
+    if _local.conn is None:
+        conn = sqlite3.connect(DB_PATH, cached_statements=parameters.DB_CACHED_STATEMENTS)
+        conn.execute('PRAGMA journal_mode=WAL')
+        # In WAL mode NORMAL only syncs at checkpoints, a power loss can lose the last commits but
+        # never corrupts the DB
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA mmap_size={int(parameters.DB_MMAP_SIZE)}')
+        conn.execute(f'PRAGMA cache_size={-int(parameters.DB_CACHE_SIZE_KB)}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        _local.conn = conn
+    return _local.conn
+
+def closeConnection():
+    '''
+    Closes the connection of the calling thread, e.g. before the DB file is removed or replaced.
+    '''
+    if getattr(_local, 'pid', None) == os.getpid() and _local.conn is not None:
+        _local.conn.close()
+    _local.conn = None
+    _local.depth = 0
+    _local.pid = os.getpid()
+
+@contextmanager
+def transaction():
+    '''
+    Runs the enclosed writes as one transaction on the pooled connection, holding the writer lock.
+    Commits on success and rolls back if an exception is raised. Nested inside another transaction
+    of the same thread it becomes a savepoint, so only its own writes are rolled back on error and
+    nothing is committed until the outermost transaction ends.
+
+    Yields:
+        sqlite3.Cursor
+    '''
+    conn = getConnection()
+    depth = getattr(_local, 'depth', 0)
+    if depth:
+        savepoint = f'nested_{depth}'
+        conn.execute(f'SAVEPOINT {savepoint}')
+        _local.depth = depth + 1
+        try:
+            yield conn.cursor()
+        except BaseException:
+            conn.execute(f'ROLLBACK TO {savepoint}')
+            conn.execute(f'RELEASE {savepoint}')
+            raise
+        else:
+            conn.execute(f'RELEASE {savepoint}')
+        finally:
+            _local.depth = depth
+        return
+
+    with Database.lock:
+        # IMMEDIATE takes SQLite's write lock up front, so a busy DB is waited on instead of failing
+        # when a read transaction would have to be upgraded
+        conn.execute('BEGIN IMMEDIATE')
+        _local.depth = 1
+        try:
+            yield conn.cursor()
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            _local.depth = 0
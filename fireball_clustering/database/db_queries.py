@@ -3,14 +3,18 @@
 
     Author: Armaan Mahajan
 '''
+import os
+import json
 import sqlite3
 import datetime
 import pickle
 import math
+import numpy as np
 from datetime import datetime
 
-from fireball_clustering.dataclasses.models import StationData
-from fireball_clustering.database.db_connection import Database
+from fireball_clustering.dataclasses.models import StationData, datetimesToNanoseconds, nanosecondsToDatetimes
+from fireball_clustering.database.db_connection import getConnection
+from fireball_clustering.database import fieldsum_format, sample_store
 from fireball_clustering.utils.fieldsum_handlers import filenameToDatetime
 from fireball_clustering import parameters
 from fireball_clustering.dataclasses.models import Fireball
@@ -20,12 +24,9 @@ def getAllStations() -> list[tuple[str, float, float]]:
     Returns:
         List of tuples of form (<STATION_ID>, <LAT>, <LON>)
     '''
-    db = Database()
-    conn = db.conn
-    cur = db.cur
+    cur = getConnection().cursor()
     stations = cur.execute('SELECT * FROM stations')
     res = [row for row in stations]
-    conn.close()
     return res
 
 def getStationsDataByID(station_ids):
@@ -40,55 +41,141 @@ def getStationsDataByID(station_ids):
     '''
     placeholders = ",".join('?' for _ in station_ids) 
     QUERY = f"SELECT * FROM stations WHERE station_id IN ({placeholders})"
-    db = Database()
-    conn = db.conn
-    cur = db.cur
+    cur = getConnection().cursor()
     stations = cur.execute(QUERY, station_ids)
     res = [station for station in stations]
-    conn.close()
     return res
 
 def getStationDataByDate(station_id: str, date: datetime) -> StationData:
-    db = Database()
-    conn = db.conn
-    cur = db.cur
-    cur.execute('SELECT * from fieldsums WHERE station_id = ? AND date = ?', (station_id, date.isoformat()))
+    '''
+    Returns:
+        StationData: The fieldsums of a station night. For nights in the sample store the columns
+            are views on the mapped file, nothing is read until they are used.
+    '''
+    cur = getConnection().cursor()
+    cur.execute('SELECT path, datetimes, intensities FROM fieldsums WHERE station_id = ? AND date = ?', (station_id, date.isoformat()))
     row = cur.fetchone()
-    
-    if row:
-        dts = pickle.loads(row[3])
-        ints = pickle.loads(row[4])
-    else:
+
+    if row is None:
         raise ValueError(f"No fieldsum data found for {station_id} - {date}")
+    return _rowToStationData(row)
+
+def getStationDataInWindow(station_id: str, start_time: datetime, end_time: datetime) -> StationData:
+    '''
+    Fetches the fieldsums of a station between two times (inclusive), found by the time bounds of the
+    nights in the catalog rather than by date. Only the pages of the window are read from the store.
+
+    Returns:
+        StationData: Possibly empty if the station has no samples in the window.
+    '''
+    start_ns = int(datetimesToNanoseconds([start_time])[0])
+    end_ns = int(datetimesToNanoseconds([end_time])[0])
+    return getStationDataBetween(station_id, start_ns, end_ns)
+
+def getStationDataBetween(station_id: str, start_ns: int, end_ns: int) -> StationData:
+    '''
+    getStationDataInWindow with the window in epoch nanoseconds.
+    '''
+    cur = getConnection().cursor()
+    cur.execute('SELECT path, datetimes, intensities FROM fieldsums WHERE station_id = ? AND start_ns <= ? AND end_ns >= ? '
+                'ORDER BY start_ns', (station_id, end_ns, start_ns))
+    rows = cur.fetchall()
 
-    conn.close()
-    return StationData(datetimes=dts, intensities=ints)
+    windows = [sample_store.sliceWindow(_rowToStationData(row), start_ns, end_ns) for row in rows]
+    if not windows:
+        return StationData()
+    if len(windows) == 1:
+        return windows[0]
+    return StationData(timestamps=np.concatenate([window.timestamps for window in windows]),
+                       intensity_array=np.concatenate([window.intensity_array for window in windows]))
+
+def getSummariesInWindow(start_time: datetime, end_time: datetime, station_ids: list[str] | None = None,
+                         min_excursion: float | None = None) -> list[tuple[str, datetime, int, int, float, float, float]]:
+    '''
+    Screens the fieldsum summaries of the bins starting between two times (inclusive), across the
+    network or for the given stations. Full-resolution samples of the interesting bins can then be
+    loaded with getStationDataInWindow.
+
+    Args:
+        min_excursion (float): If given, only bins whose max excursion is at least this multiple of
+            their std are returned, e.g. parameters.CUTOFF.
+    Returns:
+        List of tuples with form (<STATION_ID>, <BIN_START>, <N_SAMPLES>, <MAX>, <MEAN>, <STD>, <MAX_EXCURSION>),
+        ordered by station and time
+    '''
+    start_ns = int(datetimesToNanoseconds([start_time])[0])
+    end_ns = int(datetimesToNanoseconds([end_time])[0])
+
+    query = ('SELECT station_id, bin_start_ns, n_samples, max_intensity, mean_intensity, std_intensity, max_excursion '
+             'FROM fieldsum_summaries WHERE bin_start_ns BETWEEN ? AND ?')
+    params = [start_ns, end_ns]
+    if station_ids is not None:
+        query += f' AND station_id IN ({",".join("?" for _ in station_ids)})'
+        params.extend(station_ids)
+    if min_excursion is not None:
+        query += ' AND max_excursion >= ? * std_intensity'
+        params.append(min_excursion)
+
+    cur = getConnection().cursor()
+    rows = cur.execute(query + ' ORDER BY station_id, bin_start_ns', params).fetchall()
+    bin_starts = nanosecondsToDatetimes([row[1] for row in rows])
+    return [(row[0], bin_start, *row[2:]) for row, bin_start in zip(rows, bin_starts)]
+
+def _rowToStationData(row) -> StationData:
+    path, datetimes_blob, intensities_blob = row
+    if path is not None:
+        return sample_store.readSamples(path)
+    # Nights ingested before the sample store, see migrate_fieldsums
+    timestamps, intensities = fieldsum_format.decodeFieldsumColumns(datetimes_blob, intensities_blob)
+    return StationData(timestamps=timestamps, intensity_array=intensities)
+
+# In-process copy of the station neighbour graph, with the database id and graph version it was loaded at
+_graph: dict[str, dict[str, float | None]] = {}
+_graph_version = None
+
+def getStationGraph() -> dict[str, dict[str, float | None]]:
+    '''
+    Returns the station neighbour graph, loaded once and reloaded only after stations or neighbours
+    changed (checked by one lookup of station_graph_version). The graph is shared, do not modify it.
+
+    Returns:
+        Dict of <STATION_ID> to a dict of <NEIGHBOUR_ID> to <DISTANCE_KM>
+    '''
+    global _graph, _graph_version
+    cur = getConnection().cursor()
+    version = cur.execute('SELECT database_id, version FROM station_graph_version').fetchone()
+    if version != _graph_version:
+        graph = {}
+        for station_id, neighbour_id, distance_km in cur.execute('SELECT station_id, neighbour_id, distance_km FROM station_neighbours'):
+            graph.setdefault(station_id, {})[neighbour_id] = distance_km
+        _graph, _graph_version = graph, version
+    return _graph
 
 def getStationsWithinRadius(station_id: str) -> list[str]:
-    db = Database()
-    conn = db.conn
-    cur = db.cur
-    cur.execute('SELECT * FROM radius WHERE station_id = ?', (station_id,))
-    row = cur.fetchone()
-    if row:
-        _, stations_within_radius_blob = row
-        stations = pickle.loads(stations_within_radius_blob)
-    else:
+    neighbours = getStationGraph().get(station_id)
+    if neighbours is None:
         raise ValueError(f"No stations within radius information found for: {station_id}")
-
-    conn.close()
-    return stations
+    return list(neighbours)
 
 def getIngestedStations() -> list[tuple[str, datetime]]:
-    db = Database()
-    conn = db.conn
-    cur = db.cur
+    cur = getConnection().cursor()
     cur.execute('SELECT * FROM analysis WHERE status="ingested"')
     rows = cur.fetchall()
     ingested_stations = [(station_id, datetime.fromisoformat(date)) for station_id, date, _ in rows]
-    conn.close()
     return ingested_stations
 
+def getIngestedSince(rowid: int) -> list[tuple[int, str, datetime]]:
+    '''
+    Gets the station nights set to ingested after a given analysis row. Re-ingesting a night
+    replaces its row, so it shows up again with a new rowid.
+
+    Returns:
+        List of tuples with form (<ROWID>, <STATION_ID>, <DATE_OBJ>), in rowid order
+    '''
+    cur = getConnection().cursor()
+    cur.execute("SELECT rowid, station_id, date FROM analysis WHERE rowid > ? AND status = 'ingested' ORDER BY rowid", (rowid,))
+    return [(row_id, station_id, datetime.fromisoformat(date)) for row_id, station_id, date in cur.fetchall()]
+
 # TODO: clean this up
 def getIngestedRadii() -> list[list[tuple[str, str]]]:
     '''
@@ -104,14 +191,12 @@ def getIngestedRadii() -> list[list[tuple[str, str]]]:
         stations_dates_map[station_id] = date_obj
 
     res = []
-    all_station_ids = [station_id for station_id, _, _ in getAllStations()]
-    for station_id in all_station_ids:
+    for station_id, neighbours in getStationGraph().items():
         # Get number of stations within radius that are ingested
-        radius_set = set(getStationsWithinRadius(station_id))
-        ingested_within_radius = radius_set.intersection(ingested_stations)
+        ingested_within_radius = neighbours.keys() & ingested_stations
         num_ingested_within_radius = len(ingested_within_radius)
         # If enough are ingested, add them to the return value
-        if num_ingested_within_radius >= math.floor(len(radius_set) * parameters.MIN_CAMERAS):
+        if num_ingested_within_radius >= math.floor(len(neighbours) * parameters.MIN_CAMERAS):
             stations_to_process = []
             for station in ingested_within_radius:
                 if station in stations_dates_map:
@@ -121,27 +206,15 @@ def getIngestedRadii() -> list[list[tuple[str, str]]]:
     
     return res
 
-def getRadiusStations(station_id: str):
-    db = Database()
-    conn = db.conn
-    cur = db.cur
-    cur.execute('SELECT * FROM radius WHERE station_id=?', (station_id,))
-    row = cur.fetchone()
-    conn.close()
-    if row:
-        return pickle.loads(row[1])
-    else:
-        return []
+def getRadiusStations(station_id: str) -> list[str]:
+    return list(getStationGraph().get(station_id, {}))
 
 def isProcessed(station_id: str, date: str) -> bool:
-    db = Database()
-    conn = db.conn
-    cur = db.cur
+    cur = getConnection().cursor()
     cur.execute('SELECT * FROM analysis WHERE station_id=? AND date=?', 
                 (station_id, date))
     row = cur.fetchone()
     print(row)
-    conn.close()
     return True if row[2] == 'processed' else False
 
 def getFrTimestampsByDate(station_id: str, date: datetime) -> list[datetime]:
@@ -152,9 +225,7 @@ def getFrTimestampsByDate(station_id: str, date: datetime) -> list[datetime]:
         station_id: str of station id
         date: datetime object for earliest time of the given day (00:00:00)
     '''
-    db = Database()
-    conn = db.conn
-    cur = db.cur
+    cur = getConnection().cursor()
     cur.execute('SELECT * from fr_files WHERE station_id = ? AND date = ?', (station_id, date.isoformat()))
     row = cur.fetchone()
     
@@ -164,7 +235,6 @@ def getFrTimestampsByDate(station_id: str, date: datetime) -> list[datetime]:
     else:
         raise ValueError(f"No fr_file data found for {station_id} - {date}")
 
-    conn.close()
     
     return fr_datetimes
 
@@ -178,10 +248,8 @@ def getFireballsByStationDate(station_id: str, date: datetime) -> list[Fireball]
     Returns:
         An array of Fireball objects for the given station and date
     '''
-    db = Database()
-    conn = db.conn
-    cur = db.cur
-    cur.execute('SELECT * FROM candidate_fireballs WHERE station_id=? AND DATE(start_time)=?', 
+    cur = getConnection().cursor()
+    cur.execute('SELECT fireball_id, station_id, start_time, end_time FROM candidate_fireballs WHERE station_id=? AND date=?', 
                 (station_id, datetime.strftime(date, '%Y-%m-%d')))
     rows = cur.fetchall()
     fireballs: list[Fireball] = []
@@ -192,5 +260,43 @@ def getFireballsByStationDate(station_id: str, date: datetime) -> list[Fireball]
             start_time=datetime.fromisoformat(row[2]),
             end_time=datetime.fromisoformat(row[3])
         ))
-    conn.close()
     return fireballs
+
+def getScannedFiles() -> dict[str, tuple[int, int]]:
+    '''
+    Returns:
+        Dict of ingested upload paths to their (<SIZE>, <MTIME_NS>) at ingestion.
+    '''
+    cur = getConnection().cursor()
+    cur.execute('SELECT path, size, mtime_ns FROM scanned_files')
+    res = {path: (size, mtime_ns) for path, size, mtime_ns in cur.fetchall()}
+    return res
+
+def getScannedDirs() -> dict[str, int]:
+    '''
+    Returns:
+        Dict of fully ingested directory paths to their mtime_ns.
+    '''
+    cur = getConnection().cursor()
+    cur.execute('SELECT path, mtime_ns FROM scanned_dirs')
+    res = {path: mtime_ns for path, mtime_ns in cur.fetchall()}
+    return res
+
+def getScannedSubdirs() -> dict[str, list[str]]:
+    '''
+    Returns:
+        Dict of fully ingested directory paths to the paths of their subdirectories when recorded,
+        valid while the directory's mtime_ns is the one in getScannedDirs.
+    '''
+    cur = getConnection().cursor()
+    cur.execute('SELECT path, subdirs FROM scanned_dirs WHERE subdirs IS NOT NULL')
+    return {path: [os.path.join(path, name) for name in json.loads(subdirs)] for path, subdirs in cur.fetchall()}
+
+def isIngestedFingerprint(fingerprint: str) -> bool:
+    '''
+    Checks the ingestion ledger for an upload with the given content fingerprint.
+    '''
+    cur = getConnection().cursor()
+    cur.execute('SELECT 1 FROM ingestion_ledger WHERE fingerprint = ?', (fingerprint,))
+    row = cur.fetchone()
+    return row is not None
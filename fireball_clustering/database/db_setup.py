@@ -1,15 +1,28 @@
 '''
-    This file contains functions to create and initialize the database with
+    This file contains functions to create, initialize and migrate the database with
     the following tables:
         Stations:
             - station_id (TEXT): Unique identifier for the station.
             - latitude (real): Latitude of the station
             - longitude (real): Longitude of the station
+        Fieldsums:
+            - fieldsum_id (PRIMARY KEY INT): Unique identifier for the station night
+            - station_id (FOREIGN KEY TEXT): Identifier of the recording station
+            - date (TEXT): ISO8601 date of the night
+            - datetimes (BLOB): Legacy inline timestamps, empty for rows in the sample store
+            - intensities (BLOB): Legacy inline intensities, empty for rows in the sample store
+            - path (TEXT): File of the night in the sample store, relative to SAMPLE_STORE_DIR
+            - n_samples (INT): Number of samples of the night
+            - start_ns (INT): Epoch nanoseconds of the first sample
+            - end_ns (INT): Epoch nanoseconds of the last sample
         Fireballs:
             - fireball_id (int): Unique identifier for the fireball
             - station_id (FOREIGN KEY INT): Identifier of observing station
             - start_time (TEXT): ISO8601 representation of fireball start_time
             - end_time (TEXT): ISO8601 representation of fireball end_time
+            - date (TEXT): YYYY-MM-DD date of start_time
+        Candidate_Fireballs:
+            - same columns as Fireballs
         Clusters:
             - cluster_id (PRIMARY KEY INT): Unique identifier for the cluster
             - start_time (TEXT): ISO8601 representation of cluster start_time
@@ -17,19 +30,59 @@
         Cluster_Fireballs:
             - fireball_id (FOREIGN KEY INT)
             - cluster_id (FOREIGN KEY INT) 
+        Scanned_Files:
+            - path (PRIMARY KEY TEXT): Path of an ingested upload
+            - size (INT): Size of the upload in bytes when it was ingested
+            - mtime_ns (INT): Modification time of the upload when it was ingested
+        Scanned_Dirs:
+            - path (PRIMARY KEY TEXT): Path of a directory whose uploads are all ingested
+            - mtime_ns (INT): Modification time of the directory at that point
+            - subdirs (TEXT): JSON list of the names of its scanned subdirectories at that point, NULL if unknown
+        Ingestion_Ledger:
+            - fingerprint (PRIMARY KEY TEXT): Content fingerprint of an ingested upload
+            - path (TEXT): Path the upload was ingested from
+            - station_id (TEXT): Station of the upload
+            - date (TEXT): ISO8601 date of the night in the upload
+            - ingested_at (TEXT): ISO8601 time of ingestion
+        Station_Neighbours:
+            - station_id (TEXT): Central station
+            - neighbour_id (TEXT): Station within the search radius of the central station
+            - distance_km (REAL): Great circle distance between the two, NULL if unknown
+        Station_Graph_Version:
+            - version (INT): Incremented by triggers on every change of stations or station_neighbours
+            - database_id (TEXT): Random id of the database, set when it is created or migrated
+        Fieldsum_Summaries:
+            - station_id (TEXT): Recording station
+            - bin_start_ns (INT): Epoch nanoseconds of the start of the bin (SUMMARY_BIN_SECONDS)
+            - n_samples (INT): Number of samples in the bin
+            - max_intensity (INT), mean_intensity (REAL), std_intensity (REAL): Of the raw intensities
+            - max_excursion (REAL): Largest intensity above the bin's linear trend
+        Pandas_Clusters:
+            - spatiotemporal_cluster_id (INT): Cluster of one clusterFireballs run
+            - station_id (TEXT): JSON list of the observing stations
+            - start_iso_str (TEXT), end_iso_str (TEXT): Times of the first start and last end
+
+    (station_id, date) is unique in the analysis, fieldsums and fr_files tables, and
+    (station_id, neighbour_id) in station_neighbours.
+    Columns, tables and indexes added after the first release are applied by migrateDatabase.
+
+    Creating and migrating the schema are the only writes made outside the writer process
+    (see db_writer): they run once at startup, before any component writes, in a transaction
+    holding Database.lock.
 '''
 
-import sqlite3
 import requests
 import datetime
+import pickle
 
-from . import db_writes
+from . import db_writer
 from . import db_queries
-from fireball_clustering.utils.math import stationsWithinRadius
+from .db_connection import Database, getConnection
+from fireball_clustering.utils.math import stationsWithinRadius, haversineDistance
 
 def initializeEmptyDatabase():
     # Initialize connection
-    con = sqlite3.connect('gmn_fireball_clustering.db')
+    con = getConnection()
     cursor = con.cursor()
 
     # Create tables
@@ -109,6 +162,185 @@ def initializeEmptyDatabase():
                    """)
     con.commit()
 
+    migrateDatabase()
+
+def migrateDatabase():
+    '''
+    Brings the schema of the database up to SCHEMA_VERSION by applying the pending MIGRATIONS in a
+    single transaction. The applied version is kept in PRAGMA user_version, so this is safe to call
+    on every start and from several processes.
+    '''
+    con = getConnection()
+    with Database.lock:
+        # Take the write lock before reading the version so concurrent starts migrate only once
+        con.execute('BEGIN IMMEDIATE')
+        try:
+            version = con.execute('PRAGMA user_version').fetchone()[0]
+            if version < SCHEMA_VERSION:
+                cursor = con.cursor()
+                for migration in MIGRATIONS[version:]:
+                    migration(cursor)
+                cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+                print(f'[Database] Migrated schema from version {version} to {SCHEMA_VERSION}.')
+            con.commit()
+        except BaseException:
+            con.rollback()
+            raise
+
+def _addScanState(cursor):
+    '''
+    Version 1, the watcher's scan state tables:
+        Scanned_Files: uploads that have been ingested, with their size and mtime.
+        Scanned_Dirs: directories whose uploads have all been ingested, with their mtime.
+        Ingestion_Ledger: content fingerprints of ingested uploads.
+    '''
+    cursor.execute("""
+                   CREATE TABLE IF NOT EXISTS scanned_files(
+                        path TEXT PRIMARY KEY,
+                        size INTEGER NOT NULL,
+                        mtime_ns INTEGER NOT NULL
+                   )
+                   """)
+    cursor.execute("""
+                   CREATE TABLE IF NOT EXISTS scanned_dirs(
+                        path TEXT PRIMARY KEY,
+                        mtime_ns INTEGER NOT NULL
+                   )
+                   """)
+    cursor.execute("""
+                   CREATE TABLE IF NOT EXISTS ingestion_ledger(
+                        fingerprint TEXT PRIMARY KEY,
+                        path TEXT NOT NULL,
+                        station_id TEXT NOT NULL,
+                        date TEXT NOT NULL,
+                        ingested_at TEXT NOT NULL
+                   )
+                   """)
+
+def _addSampleStoreColumns(cursor):
+    '''
+    Version 2, the sample store catalog columns of the fieldsums table.
+    '''
+    _addColumns(cursor, 'fieldsums', (('path', 'TEXT'), ('n_samples', 'INTEGER'), ('start_ns', 'INTEGER'), ('end_ns', 'INTEGER')))
+
+def _addIndexes(cursor):
+    '''
+    Version 3, keys and indexes of the lookup paths:
+        - UNIQUE (station_id, date) on analysis, fieldsums and fr_files and UNIQUE station_id on radius,
+          keeping the latest row of existing duplicates
+        - a stored night date on fireballs and candidate_fireballs, backfilled from start_time, so
+          lookups by station night can use an index instead of DATE(start_time)
+    '''
+    for table, key in (('analysis', 'station_id, date'), ('fieldsums', 'station_id, date'),
+                       ('fr_files', 'station_id, date'), ('radius', 'station_id')):
+        cursor.execute(f'DELETE FROM {table} WHERE rowid NOT IN (SELECT MAX(rowid) FROM {table} GROUP BY {key})')
+        cursor.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS {table}_key ON {table}({key})')
+    cursor.execute('CREATE INDEX IF NOT EXISTS analysis_status ON analysis(status)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS fieldsums_station_start ON fieldsums(station_id, start_ns)')
+
+    for table in ('fireballs', 'candidate_fireballs'):
+        _addColumns(cursor, table, (('date', 'TEXT'),))
+        cursor.execute(f'UPDATE {table} SET date = DATE(start_time) WHERE date IS NULL')
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS {table}_station_date ON {table}(station_id, date)')
+
+def _addStationNeighbours(cursor):
+    '''
+    Version 4, the station_neighbours adjacency table replacing the pickled neighbour lists of the
+    radius table, and a version counter of the station graph for the in-process cache of db_queries.
+    '''
+    cursor.execute("""
+                   CREATE TABLE IF NOT EXISTS station_neighbours(
+                        station_id TEXT NOT NULL,
+                        neighbour_id TEXT NOT NULL,
+                        distance_km REAL,
+                        PRIMARY KEY (station_id, neighbour_id)
+                   ) WITHOUT ROWID
+                   """)
+    cursor.execute('CREATE INDEX IF NOT EXISTS station_neighbours_neighbour ON station_neighbours(neighbour_id)')
+
+    coordinates = {station_id: (lat, lon) for station_id, lat, lon in cursor.execute('SELECT station_id, latitude, longitude FROM stations')}
+    neighbours = []
+    for station_id, stations_within_radius_blob in cursor.execute('SELECT station_id, stations_within_radius FROM radius').fetchall():
+        for neighbour_id in pickle.loads(stations_within_radius_blob):
+            neighbours.append((station_id, neighbour_id, _stationDistance(coordinates, station_id, neighbour_id)))
+    cursor.executemany('INSERT OR REPLACE INTO station_neighbours (station_id, neighbour_id, distance_km) VALUES(?, ?, ?)', neighbours)
+    cursor.execute('DROP TABLE radius')
+
+    cursor.execute('CREATE TABLE IF NOT EXISTS station_graph_version(version INTEGER NOT NULL)')
+    cursor.execute('INSERT INTO station_graph_version (version) VALUES(0)')
+    for table in ('stations', 'station_neighbours'):
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            cursor.execute(f"""
+                           CREATE TRIGGER IF NOT EXISTS {table}_{event.lower()}_version AFTER {event} ON {table}
+                           BEGIN
+                                UPDATE station_graph_version SET version = version + 1;
+                           END
+                           """)
+
+def _addSummaries(cursor):
+    '''
+    Version 5, the fieldsum_summaries table, keyed by station and bin and indexed by time for
+    network-wide screening of a window.
+    '''
+    cursor.execute("""
+                   CREATE TABLE IF NOT EXISTS fieldsum_summaries(
+                        station_id TEXT NOT NULL,
+                        bin_start_ns INTEGER NOT NULL,
+                        n_samples INTEGER NOT NULL,
+                        max_intensity INTEGER NOT NULL,
+                        mean_intensity REAL NOT NULL,
+                        std_intensity REAL NOT NULL,
+                        max_excursion REAL NOT NULL,
+                        PRIMARY KEY (station_id, bin_start_ns)
+                   ) WITHOUT ROWID
+                   """)
+    cursor.execute('CREATE INDEX IF NOT EXISTS fieldsum_summaries_bin ON fieldsum_summaries(bin_start_ns)')
+
+def _addPandasClusters(cursor):
+    '''
+    Version 6, the pandas_clusters table that clusterFireballs used to create on its first write,
+    now created here so the write can go through the writer.
+    '''
+    cursor.execute("""
+                   CREATE TABLE IF NOT EXISTS pandas_clusters(
+                        spatiotemporal_cluster_id INTEGER,
+                        station_id TEXT,
+                        start_iso_str TEXT,
+                        end_iso_str TEXT
+                   )
+                   """)
+
+def _addDatabaseId(cursor):
+    '''
+    Version 7, a random id of the database in station_graph_version. Caches keyed by the graph
+    version include it, so a database recreated at the same path is not mistaken for the old one.
+    '''
+    _addColumns(cursor, 'station_graph_version', [('database_id', 'TEXT')])
+    cursor.execute('UPDATE station_graph_version SET database_id = lower(hex(randomblob(16)))')
+
+def _stationDistance(coordinates: dict, station_id: str, neighbour_id: str) -> float | None:
+    if station_id not in coordinates or neighbour_id not in coordinates:
+        return None
+    return haversineDistance(*coordinates[station_id], *coordinates[neighbour_id])
+
+def _addColumns(cursor, table: str, columns):
+    existing = [row[1] for row in cursor.execute(f'PRAGMA table_info({table})')]
+    for column, column_type in columns:
+        if column not in existing:
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+
+def _addScannedSubdirs(cursor):
+    '''
+    Version 8, the subdirectories of each scanned directory, so that an unchanged directory is not
+    listed again to follow them. Existing rows are listed once more to fill it in.
+    '''
+    _addColumns(cursor, 'scanned_dirs', [('subdirs', 'TEXT')])
+
+# Applied in order, the schema version of a database is the number of migrations applied to it
+MIGRATIONS = [_addScanState, _addSampleStoreColumns, _addIndexes, _addStationNeighbours, _addSummaries, _addPandasClusters,
+              _addDatabaseId, _addScannedSubdirs]
+SCHEMA_VERSION = len(MIGRATIONS)
+
 def insertStations():
     '''
     Inserts stations from the GMNs public station listings.
@@ -137,16 +369,17 @@ def insertStations():
         lon = station_metadata[station][most_recent_iso]['lon']
         filtered_metadata.append((station, lat, lon))
     
-    db_writes.insertStations(filtered_metadata)
+    db_writer.call(('insertStations', (filtered_metadata,)))
 
 def insertRadius():
     stations = db_queries.getAllStations()
-    radius_map = {}
+    coordinates = {station_id: (lat, lng) for station_id, lat, lng in stations}
+    neighbours = []
     for station_id, lat, lng in stations:
-        stations_within_radius = stationsWithinRadius(stations, lat, lng, 1000)
-        radius_map[station_id] = stations_within_radius
+        for neighbour_id in stationsWithinRadius(stations, lat, lng, 1000):
+            neighbours.append((station_id, neighbour_id, _stationDistance(coordinates, station_id, neighbour_id)))
 
-    db_writes.insertRadius(radius_map)
+    db_writer.call(('insertNeighbours', (neighbours,)))
 
 if __name__ == "__main__":
     initializeEmptyDatabase()
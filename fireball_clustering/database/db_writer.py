@@ -0,0 +1,288 @@
+'''
+    Single writer process that owns all writes to the database.
+
+    Components submit batches of writes over a queue; each batch is a list of (<DB_WRITES_FUNCTION>,
+    <ARGS>) and is applied atomically. The writer commits batches in groups, bounded by
+    parameters.WRITER_GROUP_SIZE batches and parameters.WRITER_GROUP_INTERVAL seconds, instead of
+    committing after every call. Callers that need the results of a write (e.g. row ids) use call(),
+    which commits the current group at once and waits for the results, raising if the writer
+    stops or does not reply within parameters.WRITER_CALL_TIMEOUT.
+
+    A process talks to the writer through the WriterClient set with useClient(). Without one, writes
+    are applied directly, so scripts and tests work without a writer process. Replies are matched to
+    calls on the client's own reply queue, so every process that call()s needs a client of its own.
+
+    The only writes made outside the writer are creating and migrating the schema
+    (db_setup.initializeEmptyDatabase and migrateDatabase). run.py does both before the writer is
+    started, components only repeat them when run on their own, and each runs in a single
+    transaction holding Database.lock. migrate_fieldsums, which moves inline samples to the sample
+    store, is such a migration too: it is run offline, while the pipeline is stopped, and commits
+    its batches through transaction().
+'''
+import os
+import time
+import queue
+import traceback
+import multiprocessing
+
+from fireball_clustering.database import db_writes
+from fireball_clustering.database.db_connection import transaction
+from fireball_clustering import parameters
+
+# Functions of db_writes that can be submitted, by name
+WRITES = {name: getattr(db_writes, name) for name in (
+    'insertStations', 'insertNeighbours', 'replaceNeighbours', 'insertFieldsums', 'catalogFieldsums', 'insertSummaries', 'insertFRs',
+    'setDataToIngested', 'setDataToProcessing', 'setDataToProcessed', 'insertScannedFiles', 'insertScannedDirs',
+    'insertLedgerEntry', 'insertFireballs', 'insertCandidateFireballs', 'insertPandasClusters',
+)}
+
+def applyBatch(writes) -> list:
+    '''
+    Applies a batch of writes in one (possibly nested) transaction.
+
+    Returns:
+        list: The return value of each write.
+    '''
+    with transaction():
+        return [WRITES[name](*args) for name, args in writes]
+
+class WriterStats():
+    '''
+    Counters of the writer process, shared with the process that started it.
+    '''
+    def __init__(self) -> None:
+        self.batches = multiprocessing.Value('q', 0)
+        self.failures = multiprocessing.Value('q', 0)
+        self.groups = multiprocessing.Value('q', 0)
+        self.latency_total = multiprocessing.Value('d', 0.0)
+        self.latency_max = multiprocessing.Value('d', 0.0)
+
+    def record(self, latencies: list[float], failures: int):
+        with self.batches.get_lock():
+            self.batches.value += len(latencies)
+            self.failures.value += failures
+            self.groups.value += 1
+            self.latency_total.value += sum(latencies)
+            self.latency_max.value = max(self.latency_max.value, max(latencies))
+
+    def summary(self, depth) -> str:
+        with self.batches.get_lock():
+            batches = self.batches.value
+            failures = self.failures.value
+            groups = self.groups.value
+            mean_latency = self.latency_total.value / batches if batches else 0.0
+            max_latency = self.latency_max.value
+        per_group = batches / groups if groups else 0.0
+        return (f'{batches} batches ({failures} failed) in {groups} commits ({per_group:.1f} per commit), '
+                f'latency mean {mean_latency * 1000:.1f}ms max {max_latency * 1000:.1f}ms, queue depth {depth}')
+
+class WriterClient():
+    '''
+    Handle of the writer for another process. Any process can submit(); call() waits on the
+    client's own reply queue, so each client must only call() from one process, and from one thread
+    at a time.
+    '''
+    def __init__(self, requests: multiprocessing.Queue, replies: multiprocessing.Queue, reply_slot: int,
+                 writer_pid) -> None:
+        self.requests = requests
+        self.replies = replies
+        self.reply_slot = reply_slot
+        # Shared pid of the running writer process, 0 while it is not running
+        self.writer_pid = writer_pid
+        self.call_id = 0
+        # Pid of the process that call()s, set by its first call
+        self.caller_pid = multiprocessing.Value('q', 0)
+
+    def submit(self, *writes):
+        self.requests.put((list(writes), time.time(), None))
+
+    def call(self, *writes, timeout: float | None = None) -> list:
+        '''
+        Raises:
+            RuntimeError: The writes failed, or the writer stopped before replying.
+            TimeoutError: No reply within timeout seconds (parameters.WRITER_CALL_TIMEOUT by default).
+        '''
+        with self.caller_pid.get_lock():
+            if self.caller_pid.value == 0:
+                self.caller_pid.value = os.getpid()
+            elif self.caller_pid.value != os.getpid():
+                # Another process reads the same reply queue and would take this call's replies
+                raise RuntimeError('Writer client is already used by another process, create a client per process.')
+        if not self.writerAlive():
+            raise RuntimeError('Database writer is not running.')
+        timeout = parameters.WRITER_CALL_TIMEOUT if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        self.call_id += 1
+        self.requests.put((list(writes), time.time(), (self.reply_slot, self.call_id)))
+
+        while True:
+            try:
+                call_id, results, error = self.replies.get(timeout=max(0.0, min(1.0, deadline - time.monotonic())))
+            except queue.Empty:
+                if not self.writerAlive():
+                    raise RuntimeError('Database writer is not running.')
+                if time.monotonic() >= deadline:
+                    raise TimeoutError(f'Database writer did not reply within {timeout}s.')
+                continue
+            # Replies to earlier calls that timed out are dropped
+            if call_id == self.call_id:
+                break
+
+        if isinstance(error, db_writes.DuplicateUpload):
+            raise error
+        if error is not None:
+            raise RuntimeError(f'Database write failed: {error}')
+        return results
+
+    def writerAlive(self) -> bool:
+        pid = self.writer_pid.value
+        if pid == 0:
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+class DatabaseWriter():
+    def __init__(self) -> None:
+        # Bounded so that a writer that falls behind applies back-pressure to the components
+        self.requests = multiprocessing.Queue(maxsize=parameters.WRITER_QUEUE_SIZE)
+        self.replies = []
+        self.stats = WriterStats()
+        self.pid = multiprocessing.Value('q', 0)
+        self.process = multiprocessing.Process(target=self.writer_loop, name='db-writer')
+
+    def __getstate__(self):
+        # The process handle cannot be sent to the child when it is spawned rather than forked
+        state = self.__dict__.copy()
+        state.pop('process', None)
+        return state
+
+    def client(self) -> WriterClient:
+        '''
+        Creates a client for another component. Clients must be created before the writer is started,
+        since their reply queues are inherited by the writer process.
+        '''
+        if self.process.pid is not None:
+            raise RuntimeError('Writer clients must be created before the writer is started.')
+        self.replies.append(multiprocessing.Queue())
+        return WriterClient(self.requests, self.replies[-1], len(self.replies) - 1, self.pid)
+
+    def writer_loop(self):
+        try:
+            self.serve()
+        finally:
+            # Callers waiting on a reply stop waiting
+            self.pid.value = 0
+
+    def serve(self):
+        group = []
+        deadline = 0.0
+        next_report = time.monotonic() + parameters.WRITER_STATS_INTERVAL
+        stopping = False
+        while not stopping:
+            timeout = max(0.0, deadline - time.monotonic()) if group else 1.0
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                # Nothing arrived, only the group deadline and the report interval are checked
+                request = False
+
+            if request is None:
+                stopping = True
+            elif request:
+                if not group:
+                    deadline = time.monotonic() + parameters.WRITER_GROUP_INTERVAL
+                group.append(request)
+
+            # Commit when the group is full, old enough, a caller waits on it, or on shutdown
+            if group and (stopping or len(group) >= parameters.WRITER_GROUP_SIZE or time.monotonic() >= deadline
+                          or (request and request[2] is not None)):
+                self.commit(group)
+                group = []
+
+            if time.monotonic() >= next_report:
+                self.report()
+                next_report = time.monotonic() + parameters.WRITER_STATS_INTERVAL
+        self.report()
+
+    def commit(self, group: list):
+        outcomes = []
+        try:
+            with transaction():
+                for writes, _, _ in group:
+                    try:
+                        outcomes.append((applyBatch(writes), None))
+                    except db_writes.DuplicateUpload as e:
+                        # Expected when workers race on the same content, returned as is to the caller
+                        outcomes.append((None, e))
+                    except Exception as e:
+                        # Only the failed batch is rolled back (savepoint), the rest of the group commits
+                        print(f'[DatabaseWriter] Batch failed: {e}')
+                        traceback.print_exc()
+                        outcomes.append((None, repr(e)))
+        except Exception as e:
+            print(f'[DatabaseWriter] Group commit failed: {e}')
+            traceback.print_exc()
+            outcomes = [(None, repr(e))] * len(group)
+
+        done = time.time()
+        for (_, submitted_at, reply_to), outcome in zip(group, outcomes):
+            if reply_to is not None:
+                reply_slot, call_id = reply_to
+                self.replies[reply_slot].put((call_id, *outcome))
+        self.stats.record([done - submitted_at for _, submitted_at, _ in group],
+                          sum(error is not None for _, error in outcomes))
+
+    def report(self):
+        try:
+            depth = self.requests.qsize()
+        except NotImplementedError:
+            depth = 'unknown'
+        print(f'[DatabaseWriter] {self.stats.summary(depth)}')
+
+    def start(self):
+        self.process.start()
+        self.pid.value = self.process.pid
+        print('[DatabaseWriter] Writer started.')
+
+    def stop(self):
+        # Pending batches are committed before the writer exits
+        self.requests.put(None)
+        self.process.join()
+
+    def join(self):
+        self.process.join()
+
+_client = None
+
+def useClient(client: WriterClient | None):
+    '''
+    Routes the writes of the calling process through the writer, or applies them directly if None.
+    '''
+    global _client
+    _client = client
+
+def submit(*writes):
+    '''
+    Submits a batch of writes, each a tuple (<DB_WRITES_FUNCTION>, <ARGS>), without waiting for it.
+    '''
+    if _client is None:
+        applyBatch(writes)
+    else:
+        _client.submit(*writes)
+
+def call(*writes) -> list:
+    '''
+    Applies a batch of writes, each a tuple (<DB_WRITES_FUNCTION>, <ARGS>), and waits for it to be
+    committed.
+
+    Returns:
+        list: The return value of each write, e.g. the row ids of inserted fireballs.
+    '''
+    if _client is None:
+        return applyBatch(writes)
+    return _client.call(*writes)
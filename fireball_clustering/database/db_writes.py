@@ -4,12 +4,26 @@
     Author: Armaan Mahajan
 '''
 
+import os
+import json
 import sqlite3
 import pickle
 from datetime import datetime
 
-from fireball_clustering.dataclasses.models import StationData, Fireball
-from fireball_clustering.database.db_connection import Database
+import numpy as np
+
+from fireball_clustering.dataclasses.models import (StationData, Fireball, FireballBatch, datetimesToNanoseconds,
+                                                  nanosecondsToIsoformat)
+from fireball_clustering.database.db_connection import transaction
+from fireball_clustering.database import db_queries, sample_store
+from fireball_clustering.data_processing.summaries import summarizeFieldsums
+from fireball_clustering import parameters
+
+class DuplicateUpload(Exception):
+    '''
+    Raised by insertLedgerEntry when the fingerprint is already in the ledger, which rolls back the
+    rest of the batch it is part of.
+    '''
 
 def insertStations(stations):
     '''
@@ -18,162 +32,238 @@ def insertStations(stations):
     Args:
         stations (list of tuples): List of tuples with the format (station_id, latitude, longitude, status)
     '''
-    db = Database()
-    conn = db.conn
-    cursor = db.cur
-    with db.lock:
+    with transaction() as cursor:
         cursor.executemany('INSERT INTO stations (station_id, latitude, longitude) VALUES(?, ?, ?)', stations)
-        conn.commit()
-        conn.close()
 
-def insertRadius(radii: dict):
+def insertNeighbours(neighbours: list[tuple[str, str, float | None]]):
     '''
+    Inserts edges of the station neighbour graph.
+
     Args:
-        radii: dictionary of station_id: list<stations_within_radius>
+        neighbours: List of tuples of form (<STATION_ID>, <NEIGHBOUR_ID>, <DISTANCE_KM>)
     '''
-    db = Database()
-    conn = db.conn
-    cursor = db.cur
-    to_insert = [(k, pickle.dumps(v)) for k, v in radii.items()]
-    with db.lock:
-        cursor.executemany('INSERT INTO radius (station_id, stations_within_radius) VALUES(?, ?)', to_insert)
-        conn.commit()
-        conn.close()
+    with transaction() as cursor:
+        cursor.executemany('INSERT OR REPLACE INTO station_neighbours (station_id, neighbour_id, distance_km) VALUES(?, ?, ?)', neighbours)
 
-def updateRadius(station_id, stations_within_radius):
+def replaceNeighbours(station_id: str, neighbours: list[tuple[str, float | None]]):
     '''
+    Replaces all neighbours of a station.
+
     Args:
-        station_id: station ID that the stations within radius need to be updated for
-        stations_within_radius: list of stations within a radius of station with station id
+        station_id: station ID that the neighbours need to be updated for
+        neighbours: List of tuples of form (<NEIGHBOUR_ID>, <DISTANCE_KM>)
     '''
-    db = Database()
-    conn = db.conn
-    cursor = db.cur
-    with db.lock:
-        cursor.executemany('UPDATE radius SET stations_within_radius = ? WHERE station_id = ?', (pickle.dumps(stations_within_radius), station_id))
-        conn.commit()
-        conn.close()
+    with transaction() as cursor:
+        cursor.execute('DELETE FROM station_neighbours WHERE station_id = ?', (station_id,))
+        cursor.executemany('INSERT INTO station_neighbours (station_id, neighbour_id, distance_km) VALUES(?, ?, ?)',
+                           [(station_id, neighbour_id, distance_km) for neighbour_id, distance_km in neighbours])
 
 def insertFieldsums(station_id: str, date: datetime, station_data: StationData):
     '''
-    Inserts 1+ fieldsum arrays into the fieldsums table of the database.
+    Writes the fieldsums of a station night to the sample store and catalogs them in the fieldsums table.
 
     Args:
         station_id
         date: the earliest datetime object for the date being passed (00:00:00)
     '''
-    dts = pickle.dumps([dt.isoformat() for dt in station_data.datetimes])
-    ints = pickle.dumps(station_data.intensities)
+    # The file is replaced atomically before the catalog row, so the row never points at a partial file
+    path = sample_store.samplePath(station_id, date)
+    n_samples, start_ns, end_ns = sample_store.writeSamples(path, station_data)
+    with transaction():
+        previous_path = catalogFieldsums(station_id, date, path, n_samples, start_ns, end_ns)
+        insertSummaries(station_id, start_ns, end_ns, summarizeFieldsums(station_data))
+    if previous_path is not None:
+        sample_store.removeSamples(previous_path)
 
-    db = Database()
-    conn = db.conn
-    cursor = db.cur
-    with db.lock:
-        cursor.execute('INSERT INTO fieldsums (station_id, date, datetimes, intensities) VALUES(?, ?, ?, ?)', 
-                    (station_id, date.isoformat(), dts, ints))
-        conn.commit()
-        conn.close()
+def catalogFieldsums(station_id: str, date: datetime, path: str, n_samples: int, start_ns: int, end_ns: int) -> str | None:
+    '''
+    Catalogs a station night already written to the sample store (see sample_store.writeSamples).
+    The summaries of the upload of the night it replaces are removed, follow it with insertSummaries.
+
+    Returns:
+        str | None: Store path of the upload of the night it replaces, if in another file. Remove it
+            with sample_store.removeSamples once committed.
+    '''
+    with transaction() as cursor:
+        previous = cursor.execute('SELECT path, n_samples, start_ns, end_ns FROM fieldsums WHERE station_id = ? AND date = ?',
+                                  (station_id, date.isoformat())).fetchone()
+        # Replaces any earlier upload of the same night (unique station_id, date) so re-ingestion is idempotent
+        cursor.execute('INSERT OR REPLACE INTO fieldsums (station_id, date, datetimes, intensities, path, n_samples, start_ns, end_ns) '
+                       'VALUES(?, ?, ?, ?, ?, ?, ?, ?)',
+                    (station_id, date.isoformat(), b'', b'', path, n_samples, start_ns, end_ns))
+
+        # The earlier upload can span bins the new one does not, its summaries must not outlive it
+        if previous is not None and previous[1]:
+            bin_ns = int(parameters.SUMMARY_BIN_SECONDS * 1e9)
+            first_bin_ns, last_bin_ns = previous[2] // bin_ns * bin_ns, previous[3] // bin_ns * bin_ns
+            cursor.execute('DELETE FROM fieldsum_summaries WHERE station_id = ? AND bin_start_ns BETWEEN ? AND ?',
+                           (station_id, first_bin_ns, last_bin_ns))
+            _resummarizeBins(cursor, station_id, sorted({first_bin_ns, last_bin_ns}))
+    if previous is None or previous[0] is None or previous[0] == path:
+        return None
+    return previous[0]
+
+def insertSummaries(station_id: str, start_ns: int, end_ns: int, summaries: list[tuple]):
+    '''
+    Replaces the fieldsum summaries of a station night whose samples are between two times (inclusive).
+    Its first and last bins can hold samples of the adjacent nights too, so they are summarized
+    again from the samples of every night in the catalog, catalog the night before its summaries.
+
+    Args:
+        summaries: List of tuples as returned by summaries.summarizeFieldsums
+    '''
+    if not summaries:
+        return
+    with transaction() as cursor:
+        # The bins between the boundary bins hold only this night
+        cursor.execute('DELETE FROM fieldsum_summaries WHERE station_id = ? AND bin_start_ns > ? AND bin_start_ns < ?',
+                       (station_id, summaries[0][0], summaries[-1][0]))
+        cursor.executemany('INSERT OR REPLACE INTO fieldsum_summaries (station_id, bin_start_ns, n_samples, max_intensity, '
+                           'mean_intensity, std_intensity, max_excursion) VALUES(?, ?, ?, ?, ?, ?, ?)',
+                           [(station_id, *summary) for summary in summaries[1:-1]])
+        _resummarizeBins(cursor, station_id, sorted({summaries[0][0], summaries[-1][0]}))
+
+def _resummarizeBins(cursor, station_id: str, bin_starts: list[int]):
+    '''
+    Summarizes bins again from the samples of every cataloged night of the station, bins left
+    without samples are removed.
+    '''
+    bin_ns = int(parameters.SUMMARY_BIN_SECONDS * 1e9)
+    for bin_start_ns in bin_starts:
+        station_data = db_queries.getStationDataBetween(station_id, bin_start_ns, bin_start_ns + bin_ns - 1)
+        if len(station_data):
+            cursor.execute('INSERT OR REPLACE INTO fieldsum_summaries (station_id, bin_start_ns, n_samples, max_intensity, '
+                           'mean_intensity, std_intensity, max_excursion) VALUES(?, ?, ?, ?, ?, ?, ?)',
+                           (station_id, *summarizeFieldsums(station_data)[0]))
+        else:
+            cursor.execute('DELETE FROM fieldsum_summaries WHERE station_id = ? AND bin_start_ns = ?', (station_id, bin_start_ns))
 
 def insertFRs(station_id: str, date: datetime, fr_timestamps: list):
     fr_dump = pickle.dumps(fr_timestamps)
 
-    db = Database()
-    conn = db.conn
-    cursor = db.cur
-    with db.lock:
-        cursor.execute('INSERT INTO fr_files (station_id, date, fr_timestamps) VALUES(?, ?, ?)', 
+    with transaction() as cursor:
+        cursor.execute('INSERT OR REPLACE INTO fr_files (station_id, date, fr_timestamps) VALUES(?, ?, ?)', 
                     (station_id, date.isoformat(), fr_dump))
-        conn.commit()
-        conn.close()
 
 def setDataToIngested(stations_dates: list[tuple[str, datetime]]):
     '''
-    Sets the data state to ingested for the given stations and dates. Assumes the stations and dates do not exist in the table.
+    Sets the data state to ingested for the given stations and dates. Existing states for the same
+    stations and dates are replaced, so the night is analysed again with the newly ingested data.
 
     Args:
         stations_dates: List of tuples of form (<STATION_ID>, <DATETIME_OBJ>)
     '''
     analysis_states = [(id, date, 'ingested') for id, date in stations_dates]
 
-    db = Database()
-    conn = db.conn
-    cursor = db.cur
-    with db.lock:
-        cursor.executemany('INSERT INTO analysis (station_id, date, status) VALUES(?, ?, ?)', analysis_states)
-        conn.commit()
-        conn.close()
+    with transaction() as cursor:
+        cursor.executemany('INSERT OR REPLACE INTO analysis (station_id, date, status) VALUES(?, ?, ?)', analysis_states)
 
 def setDataToProcessing(stations_dates: list[tuple[str, datetime]]):
     analysis_states = [('processing', id, date) for id, date in stations_dates]
 
-    db = Database()
-    conn = db.conn
-    cursor = db.cur
-    with db.lock:
+    with transaction() as cursor:
         cursor.executemany('UPDATE analysis SET status=? WHERE station_id=? and date=?', analysis_states)
-        conn.commit()
-        conn.close()
 
 def setDataToProcessed(stations_dates: list[tuple[str, datetime]]):
     analysis_states = [('processed', id, date) for id, date in stations_dates]
 
-    db = Database()
-    conn = db.conn
-    cursor = db.cur
-    with db.lock:
+    with transaction() as cursor:
         cursor.executemany('UPDATE analysis SET status=? WHERE station_id=? and date=?', analysis_states)
-        conn.commit()
-        conn.close()
 
-def insertFireballs(fireballs):
+def insertScannedFiles(files: list[tuple[str, int, int]]):
+    '''
+    Records uploads as ingested in the watcher's scan state.
+
+    Args:
+        files: List of tuples of form (<PATH>, <SIZE>, <MTIME_NS>)
+    '''
+    with transaction() as cursor:
+        cursor.executemany('INSERT OR REPLACE INTO scanned_files (path, size, mtime_ns) VALUES(?, ?, ?)', files)
+
+def insertScannedDirs(dirs: list[tuple]):
+    '''
+    Records directories whose uploads have all been ingested.
+
+    Args:
+        dirs: List of tuples of form (<DIR_PATH>, <MTIME_NS>) or (<DIR_PATH>, <MTIME_NS>, <SUBDIR_PATHS>)
+    '''
+    rows = [(dir[0], dir[1], json.dumps([os.path.basename(subdir) for subdir in dir[2]]) if len(dir) > 2 else None)
+            for dir in dirs]
+    with transaction() as cursor:
+        cursor.executemany('INSERT OR REPLACE INTO scanned_dirs (path, mtime_ns, subdirs) VALUES(?, ?, ?)', rows)
+
+def insertLedgerEntry(fingerprint: str, path: str, station_id: str, date: datetime):
+    '''
+    Records the content fingerprint of an ingested upload. Put first in the batch of the upload,
+    so that when two workers ingest the same content only the first batch is applied.
+
+    Raises:
+        DuplicateUpload: The fingerprint was already recorded.
+    '''
+    with transaction() as cursor:
+        cursor.execute('INSERT OR IGNORE INTO ingestion_ledger (fingerprint, path, station_id, date, ingested_at) VALUES(?, ?, ?, ?, ?)',
+                       (fingerprint, path, station_id, date.isoformat(), datetime.now().isoformat()))
+        if cursor.rowcount == 0:
+            raise DuplicateUpload(fingerprint)
+
+def insertFireballs(fireballs: FireballBatch | list[tuple]) -> list[int]:
     '''
     Inserts one or more fireballs into the fireballs table of the database.
 
     Args:
-        fireballs (list of tuples): List of tuples with following format(station_id, start_time, end_time))
+        fireballs (FireballBatch | list of tuples): A batch from detection, or tuples with the format
+            (station_id, start_time, end_time), times in ISO8601
     
     Returns:
         Array of primary keys for each fireball in the same order as they were inserted.
     '''
-    res = [] # Array of IDs
-
-    db = Database()
-    conn = db.conn
-    cursor = db.cur
-    with db.lock:
-        for fireball in fireballs:
-            cursor.execute('INSERT INTO fireballs (station_id, start_time, end_time) VALUES(?, ?, ?)', fireball)
-            res.append(cursor.lastrowid)
-        conn.commit()
-        conn.close()
+    if not isinstance(fireballs, FireballBatch):
+        fireballs = _tuplesToBatch(fireballs)
+    return _insertFireballBatch('fireballs', fireballs)
 
-    return res
-
-def insertCandidateFireballs(fireballs: list[Fireball]):
+def insertCandidateFireballs(fireballs: FireballBatch | list[Fireball]) -> list[int]:
     '''
-    Inserts one or more fireballs into the fireballs table of the database.
+    Inserts one or more fireballs into the candidate_fireballs table of the database.
 
     Args:
-        fireballs (list of tuples): List of tuples with following format(station_id, start_time, end_time))
+        fireballs (FireballBatch | list of Fireball)
     
     Returns:
         Array of primary keys for each fireball in the same order as they were inserted.
     '''
+    if not isinstance(fireballs, FireballBatch):
+        fireballs = FireballBatch.fromFireballs(fireballs)
+    return _insertFireballBatch('candidate_fireballs', fireballs)
+
+# Rows per INSERT statement, 4 parameters each, well below SQLite's limit of 32766 parameters. Full
+# chunks reuse one cached prepared statement, whatever the size of the batch.
+FIREBALL_INSERT_CHUNK = 1024
+
+def _insertFireballBatch(table: str, batch: FireballBatch) -> list[int]:
+    rows = list(zip(batch.station_names.tolist(),
+                    nanosecondsToIsoformat(batch.start_timestamps).tolist(),
+                    nanosecondsToIsoformat(batch.end_timestamps).tolist(),
+                    batch.start_timestamps.view('datetime64[ns]').astype('datetime64[D]').astype(str).tolist()))
     res = [] # Array of IDs
 
-    db = Database()
-    conn = db.conn
-    cursor = db.cur
-    with db.lock:
-        for fireball in fireballs:
-            cursor.execute('INSERT INTO candidate_fireballs (station_id, start_time, end_time) VALUES(?, ?, ?)', 
-                           (fireball.station_name, fireball.start_time.isoformat(), fireball.end_time.isoformat()))
-            res.append(cursor.lastrowid)
-        conn.commit()
-        conn.close()
+    with transaction() as cursor:
+        for chunk_start in range(0, len(rows), FIREBALL_INSERT_CHUNK):
+            chunk = rows[chunk_start:chunk_start + FIREBALL_INSERT_CHUNK]
+            values = ', '.join(['(?, ?, ?, ?)'] * len(chunk))
+            cursor.execute(f'INSERT INTO {table} (station_id, start_time, end_time, date) VALUES {values} RETURNING fireball_id',
+                           [param for row in chunk for param in row])
+            # RETURNING rows come in no defined order, but the new rowids of one statement increase
+            # in the order of its rows
+            res.extend(sorted(fireball_id for fireball_id, in cursor.fetchall()))
 
+    batch.ids = np.array(res, dtype=np.int64)
     return res
 
+def _tuplesToBatch(fireballs: list[tuple]) -> FireballBatch:
+    return FireballBatch([station_id for station_id, _, _ in fireballs],
+                         datetimesToNanoseconds([start_time for _, start_time, _ in fireballs]),
+                         datetimesToNanoseconds([end_time for _, _, end_time in fireballs]))
+
 def insertClusters(clusters):
     '''
     Inserts 1+ cluster(s) into the clusters table of the database and updates FireballsClusters to reflect the relationship.
@@ -186,9 +276,16 @@ def insertClusters(clusters):
         - end_time (TEXT): ISO8601 representation of cluster end_time
     
     '''
-    db = Database()
-    conn = db.conn
-    cursor = db.cur
-    with db.lock:
+    with transaction() as cursor:
         pass
-    conn.close()
+
+def insertPandasClusters(clusters: list[tuple[int, str, str, str]]):
+    '''
+    Appends the clusters of a clusterFireballs run to the pandas_clusters table.
+
+    Args:
+        clusters (list of tuples): (spatiotemporal_cluster_id, station_ids as JSON, start ISO8601, end ISO8601)
+    '''
+    with transaction() as cursor:
+        cursor.executemany('INSERT INTO pandas_clusters (spatiotemporal_cluster_id, station_id, start_iso_str, end_iso_str) '
+                           'VALUES(?, ?, ?, ?)', clusters)
@@ -0,0 +1,20 @@
+'''
+    Decoding of the datetimes and intensities columns of fieldsums rows that still hold their
+    samples inline. Such rows hold pickled lists of ISO8601 strings and numbers; samples are now
+    written to the sample store instead, and migrate_fieldsums moves old rows there.
+'''
+import pickle
+import numpy as np
+
+from fireball_clustering.dataclasses.models import datetimesToNanoseconds
+
+def decodeFieldsumColumns(datetimes_blob: bytes, intensities_blob: bytes) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    Decodes the pickled datetimes and intensities columns of a legacy fieldsums row.
+
+    Returns:
+        tuple[ndarray, ndarray]: int64 epoch nanosecond timestamps and uint32 intensities.
+    '''
+    timestamps = datetimesToNanoseconds(pickle.loads(datetimes_blob))
+    intensities = np.asarray(pickle.loads(intensities_blob), dtype=np.uint32)
+    return timestamps, intensities
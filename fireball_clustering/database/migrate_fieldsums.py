@@ -0,0 +1,56 @@
+'''
+    Moves fieldsums rows that still hold their samples inline as pickled lists into the sample store,
+    leaving only the catalog columns in the table.
+
+    Rows are converted one at a time and committed in batches, each in one transaction(), so the
+    migration can be stopped and resumed; rows that are already in the store are skipped. Run VACUUM
+    afterwards to give the space of the inline blobs back.
+
+    This is an offline schema migration: it writes directly rather than through the writer process
+    (see db_writer), so run it while the pipeline is stopped.
+
+    Usage: python -m fireball_clustering.database.migrate_fieldsums
+'''
+import time
+from datetime import datetime
+
+from fireball_clustering.database.db_connection import getConnection, transaction
+from fireball_clustering.database import db_setup, fieldsum_format, sample_store
+from fireball_clustering.dataclasses.models import StationData
+
+def migrateFieldsums(batch_size: int = 50) -> int:
+    '''
+    Args:
+        batch_size (int): Number of rows converted per commit.
+    Returns:
+        int: Number of rows converted.
+    '''
+    db_setup.migrateDatabase()
+
+    # Only the ids are read up front, blobs are read one row at a time
+    fieldsum_ids = [row[0] for row in getConnection().execute('SELECT fieldsum_id FROM fieldsums WHERE path IS NULL')]
+
+    converted = 0
+    for batch_start in range(0, len(fieldsum_ids), batch_size):
+        with transaction() as cursor:
+            for fieldsum_id in fieldsum_ids[batch_start:batch_start + batch_size]:
+                cursor.execute('SELECT station_id, date, datetimes, intensities FROM fieldsums WHERE fieldsum_id = ?', (fieldsum_id,))
+                station_id, date, datetimes_blob, intensities_blob = cursor.fetchone()
+                timestamps, intensities = fieldsum_format.decodeFieldsumColumns(datetimes_blob, intensities_blob)
+
+                path = sample_store.samplePath(station_id, datetime.fromisoformat(date))
+                n_samples, start_ns, end_ns = sample_store.writeSamples(path, StationData(timestamps=timestamps, intensity_array=intensities))
+                cursor.execute('UPDATE fieldsums SET datetimes = ?, intensities = ?, path = ?, n_samples = ?, start_ns = ?, end_ns = ? '
+                               'WHERE fieldsum_id = ?',
+                               (b'', b'', path, n_samples, start_ns, end_ns, fieldsum_id))
+                converted += 1
+        print(f'[Migration] Moved {converted}/{len(fieldsum_ids)} fieldsum rows to the sample store.')
+    return converted
+
+def main():
+    start_time = time.time()
+    converted = migrateFieldsums()
+    print(f'[Migration] Moved {converted} fieldsum rows to the sample store in {time.time() - start_time:.1f}s.')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+'''
+    Memory-mapped store of the fieldsum samples of each station night.
+
+    Every station night is one file below parameters.SAMPLE_STORE_DIR, the fieldsums table only
+    catalogs it (path, sample count and time bounds). Each upload of a night is written to a file of
+    its own, so the cataloged path always holds the samples of the cataloged upload, and the file of
+    the upload it replaces is removed once the new row is committed. Files are little-endian and columnar:
+        header (64 bytes): magic b'GFSS', uint16 version, uint16 intensity codec, uint64 n_samples,
+                           int64 start_ns, int64 end_ns, zero padding
+        int64[n_samples]  epoch nanosecond timestamps, sorted
+        intensities encoded with the codec (see codecs), uint32[n_samples] for the raw codec
+
+    Reads map the file and return numpy views on it, so only the pages that are used are read
+    from disk. Intensities stored with any other codec than raw are decoded as a whole on read.
+    Files are replaced atomically, readers holding a map of the old file keep seeing it.
+'''
+import os
+import struct
+import tempfile
+import numpy as np
+
+from fireball_clustering.dataclasses.models import StationData
+from fireball_clustering.database import codecs
+from fireball_clustering import parameters
+
+STORE_MAGIC = b'GFSS'
+STORE_VERSION = 1
+STORE_HEADER = struct.Struct('<4sHHQqq')
+# Header padded so that both columns are aligned
+STORE_HEADER_SIZE = 64
+
+def samplePath(station_id: str, date, upload: str | None = None) -> str:
+    '''
+    Args:
+        upload (str): Unique id of an upload, for a file of its own. Not the content fingerprint, two
+            workers racing on the same content must not write the same file.
+    Returns:
+        str: Path of a station night relative to the store directory, as cataloged in fieldsums.
+    '''
+    name = f'{station_id}_{date.strftime("%Y%m%d")}' if upload is None else f'{station_id}_{date.strftime("%Y%m%d")}_{upload}'
+    return os.path.join(station_id, f'{name}.fss')
+
+def resolvePath(path: str) -> str:
+    return os.path.join(parameters.SAMPLE_STORE_DIR, path)
+
+def writeSamples(path: str, station_data: StationData, codec: str | None = None) -> tuple[int, int, int]:
+    '''
+    Writes the samples of a station night to the store.
+
+    Args:
+        path (str): Path relative to the store directory (see samplePath).
+        station_data (StationData): Samples sorted by timestamp.
+        codec (str): Codec of the intensities, parameters.FIELDSUM_CODEC by default.
+    Returns:
+        tuple[int, int, int]: Number of samples and the first and last timestamp (epoch ns).
+    '''
+    timestamps = np.asarray(station_data.timestamps, dtype='<i8')
+    intensities = np.asarray(station_data.intensity_array, dtype='<u4')
+    n_samples = len(timestamps)
+    start_ns = int(timestamps[0]) if n_samples else 0
+    end_ns = int(timestamps[-1]) if n_samples else 0
+    codec_id = codecs.codecId(parameters.FIELDSUM_CODEC if codec is None else codec)
+
+    full_path = resolvePath(path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    # A unique temporary file per write, workers writing the same night must not share one
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(full_path), prefix=os.path.basename(full_path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            os.fchmod(f.fileno(), 0o644)
+            header = STORE_HEADER.pack(STORE_MAGIC, STORE_VERSION, codec_id, n_samples, start_ns, end_ns)
+            f.write(header.ljust(STORE_HEADER_SIZE, b'\0'))
+            f.write(timestamps.tobytes())
+            f.write(codecs.encode(intensities, codec_id))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, full_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    return n_samples, start_ns, end_ns
+
+def removeSamples(path: str):
+    '''
+    Removes a station night from the store, if it is there. Readers holding a map of it keep seeing it.
+    '''
+    try:
+        os.remove(resolvePath(path))
+    except FileNotFoundError:
+        pass
+
+def readSamples(path: str) -> StationData:
+    '''
+    Maps a station night from the store.
+
+    Returns:
+        StationData: Columns are read-only views on the mapped file.
+    '''
+    full_path = resolvePath(path)
+    with open(full_path, 'rb') as f:
+        header = f.read(STORE_HEADER_SIZE)
+    if len(header) < STORE_HEADER_SIZE:
+        raise ValueError(f'Truncated sample store file: {full_path}')
+    magic, version, codec_id, n_samples, _, _ = STORE_HEADER.unpack_from(header)
+    if magic != STORE_MAGIC or version != STORE_VERSION:
+        raise ValueError(f'Unsupported sample store file {full_path}: {magic!r} version {version}')
+
+    if n_samples == 0:
+        return StationData()
+
+    timestamps_end = STORE_HEADER_SIZE + 8 * n_samples
+    file_size = os.path.getsize(full_path)
+    if file_size < timestamps_end + (4 * n_samples if codec_id == codecs.CODEC_RAW else 0):
+        raise ValueError(f'Truncated sample store file: {full_path}')
+
+    mapped = np.memmap(full_path, dtype=np.uint8, mode='r')
+    timestamps = mapped[STORE_HEADER_SIZE:timestamps_end].view('<i8')
+    intensities = codecs.decode(mapped[timestamps_end:], n_samples, codec_id)
+    return StationData(timestamps=timestamps, intensity_array=intensities)
+
+def sliceWindow(station_data: StationData, start_ns: int, end_ns: int) -> StationData:
+    '''
+    Returns:
+        StationData: Views of the samples with start_ns <= timestamp <= end_ns. On mapped data the
+            binary search and the slice only touch the pages around and inside the window.
+    '''
+    lo = np.searchsorted(station_data.timestamps, start_ns, side='left')
+    hi = np.searchsorted(station_data.timestamps, end_ns, side='right')
+    return StationData(timestamps=station_data.timestamps[lo:hi],
+                       intensity_array=station_data.intensity_array[lo:hi])
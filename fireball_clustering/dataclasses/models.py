@@ -1,31 +1,242 @@
 from dataclasses import dataclass
 from datetime import datetime
+import numpy as np
 import pandas as pd
 
-@dataclass
+def datetimesToNanoseconds(datetimes) -> np.ndarray:
+    '''
+    Converts naive UTC datetimes (or ISO8601 strings) to int64 epoch nanoseconds.
+    '''
+    if len(datetimes) == 0:
+        return np.zeros(0, dtype=np.int64)
+    if isinstance(datetimes[0], str):
+        index = pd.to_datetime(datetimes, format='ISO8601')
+        return index.to_numpy(dtype='datetime64[ns]').view(np.int64)
+    return np.array(datetimes, dtype='datetime64[ns]').view(np.int64)
+
+def nanosecondsToDatetimes(timestamps: np.ndarray) -> list[datetime]:
+    '''
+    Converts int64 epoch nanoseconds to a list of naive UTC datetimes (microsecond precision).
+    '''
+    return np.asarray(timestamps, dtype=np.int64).view('datetime64[ns]').astype('datetime64[us]').tolist()
+
+def nanosecondsToIsoformat(timestamps: np.ndarray) -> np.ndarray:
+    '''
+    Formats int64 epoch nanoseconds like datetime.isoformat (microseconds only when non-zero).
+
+    Returns:
+        ndarray: str array of ISO8601 timestamps.
+    '''
+    microseconds = np.asarray(timestamps, dtype=np.int64).view('datetime64[ns]').astype('datetime64[us]')
+    seconds = microseconds.astype('datetime64[s]')
+    return np.where(microseconds == seconds, np.datetime_as_string(seconds), np.datetime_as_string(microseconds))
+
 class StationData:
-    datetimes: list[datetime]
-    intensities: list[int | float]
-    
+    '''
+    Fieldsum samples for a single station night, stored as columns:
+        timestamps (int64 ndarray): Epoch nanoseconds of each sample.
+        intensity_array (uint32 ndarray): Summed field intensity of each sample.
+
+    The `datetimes` and `intensities` attributes are lazily built, read-only tuple views of the
+    columns kept for existing callers, assign a new sequence to change the samples.
+    '''
+    __slots__ = ('timestamps', 'intensity_array', '_datetimes', '_intensities')
+
+    def __init__(self, datetimes: list[datetime] | None = None, intensities: list[int | float] | None = None,
+                 *, timestamps: np.ndarray | None = None, intensity_array: np.ndarray | None = None) -> None:
+        self.timestamps = np.zeros(0, dtype=np.int64)
+        self.intensity_array = np.zeros(0, dtype=np.uint32)
+        self._datetimes = None
+        self._intensities = None
+
+        if timestamps is not None:
+            self.timestamps = np.asarray(timestamps, dtype=np.int64)
+        elif datetimes is not None:
+            self.datetimes = datetimes
+
+        if intensity_array is not None:
+            self.intensity_array = np.asarray(intensity_array, dtype=np.uint32)
+        elif intensities is not None:
+            self.intensities = intensities
+
+    @property
+    def datetimes(self) -> tuple[datetime, ...]:
+        if self._datetimes is None:
+            self._datetimes = tuple(nanosecondsToDatetimes(self.timestamps))
+        return self._datetimes
+
+    @datetimes.setter
+    def datetimes(self, datetimes: list[datetime]):
+        self.timestamps = datetimesToNanoseconds(datetimes)
+        self._datetimes = None
+
+    @property
+    def intensities(self) -> tuple[int, ...]:
+        if self._intensities is None:
+            self._intensities = tuple(self.intensity_array.tolist())
+        return self._intensities
+
+    @intensities.setter
+    def intensities(self, intensities: list[int]):
+        self.intensity_array = np.asarray(intensities, dtype=np.uint32)
+        self._intensities = None
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, StationData):
+            return NotImplemented
+        return (np.array_equal(self.timestamps, other.timestamps) and
+                np.array_equal(self.intensity_array, other.intensity_array))
+
+    def __repr__(self) -> str:
+        return f'StationData(samples={len(self)})'
+
+    def __getstate__(self):
+        return (self.timestamps, self.intensity_array)
+
+    def __setstate__(self, state):
+        # Pickles of the former dataclass carry its __dict__ of lists
+        if isinstance(state, dict):
+            self.__init__(state.get('datetimes'), state.get('intensities'))
+            return
+        self.timestamps, self.intensity_array = state
+        self._datetimes = None
+        self._intensities = None
+
     def getDataframe(self):
         return pd.DataFrame({
-            'datetime': self.datetimes,
-            'intensity': self.intensities,
+            'datetime': self.timestamps.view('datetime64[ns]'),
+            'intensity': self.intensity_array,
         })
 
-@dataclass
 class ProcessedStationData:
-    datetimes: list[datetime]
-    intensities: list[int | float]
-    detrended_intensities: list[int | float]
-    moving_std: list[float]
+    '''
+    Preprocessed fieldsum samples for a single station night, stored as columns:
+        timestamps (int64 ndarray): Epoch nanoseconds of each sample.
+        intensity_array (ndarray): Raw intensity of each sample.
+        detrended_array (float64 ndarray): Bandpassed and detrended intensity.
+        moving_std_array (float64 ndarray): Moving standard deviation of the detrended intensity.
+
+    The sequence attributes are lazily built, read-only tuple views of the columns kept for
+    existing callers, assign a new sequence to change the samples.
+    '''
+    __slots__ = ('timestamps', 'intensity_array', 'detrended_array', 'moving_std_array',
+                 '_datetimes', '_intensities', '_detrended_intensities', '_moving_std')
+
+    def __init__(self, datetimes: list[datetime] | None = None, intensities: list[int | float] | None = None,
+                 detrended_intensities: list[int | float] | None = None, moving_std: list[float] | None = None,
+                 *, timestamps: np.ndarray | None = None, intensity_array: np.ndarray | None = None,
+                 detrended_array: np.ndarray | None = None, moving_std_array: np.ndarray | None = None) -> None:
+        self.timestamps = np.zeros(0, dtype=np.int64)
+        self.intensity_array = np.zeros(0, dtype=np.uint32)
+        self.detrended_array = np.zeros(0, dtype=np.float64)
+        self.moving_std_array = np.zeros(0, dtype=np.float64)
+        self._datetimes = None
+        self._intensities = None
+        self._detrended_intensities = None
+        self._moving_std = None
+
+        if timestamps is not None:
+            self.timestamps = np.asarray(timestamps, dtype=np.int64)
+        elif datetimes is not None:
+            self.datetimes = datetimes
+
+        if intensity_array is not None:
+            self.intensity_array = np.asarray(intensity_array)
+        elif intensities is not None:
+            self.intensities = intensities
+
+        if detrended_array is not None:
+            self.detrended_array = np.asarray(detrended_array, dtype=np.float64)
+        elif detrended_intensities is not None:
+            self.detrended_intensities = detrended_intensities
+
+        if moving_std_array is not None:
+            self.moving_std_array = np.asarray(moving_std_array, dtype=np.float64)
+        elif moving_std is not None:
+            self.moving_std = moving_std
+
+    @property
+    def datetimes(self) -> tuple[datetime, ...]:
+        if self._datetimes is None:
+            self._datetimes = tuple(nanosecondsToDatetimes(self.timestamps))
+        return self._datetimes
+
+    @datetimes.setter
+    def datetimes(self, datetimes: list[datetime]):
+        self.timestamps = datetimesToNanoseconds(datetimes)
+        self._datetimes = None
+
+    @property
+    def intensities(self) -> tuple[int | float, ...]:
+        if self._intensities is None:
+            self._intensities = tuple(self.intensity_array.tolist())
+        return self._intensities
+
+    @intensities.setter
+    def intensities(self, intensities: list[int | float]):
+        self.intensity_array = np.asarray(intensities)
+        self._intensities = None
+
+    @property
+    def detrended_intensities(self) -> tuple[float, ...]:
+        if self._detrended_intensities is None:
+            self._detrended_intensities = tuple(self.detrended_array.tolist())
+        return self._detrended_intensities
+
+    @detrended_intensities.setter
+    def detrended_intensities(self, detrended_intensities: list[float]):
+        self.detrended_array = np.asarray(detrended_intensities, dtype=np.float64)
+        self._detrended_intensities = None
+
+    @property
+    def moving_std(self) -> tuple[float, ...]:
+        if self._moving_std is None:
+            self._moving_std = tuple(self.moving_std_array.tolist())
+        return self._moving_std
+
+    @moving_std.setter
+    def moving_std(self, moving_std: list[float]):
+        self.moving_std_array = np.asarray(moving_std, dtype=np.float64)
+        self._moving_std = None
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, ProcessedStationData):
+            return NotImplemented
+        return (np.array_equal(self.timestamps, other.timestamps) and
+                np.array_equal(self.intensity_array, other.intensity_array) and
+                np.array_equal(self.detrended_array, other.detrended_array, equal_nan=True) and
+                np.array_equal(self.moving_std_array, other.moving_std_array, equal_nan=True))
+
+    def __repr__(self) -> str:
+        return f'ProcessedStationData(samples={len(self)})'
+
+    def __getstate__(self):
+        return (self.timestamps, self.intensity_array, self.detrended_array, self.moving_std_array)
+
+    def __setstate__(self, state):
+        # Pickles of the former dataclass carry its __dict__ of lists
+        if isinstance(state, dict):
+            self.__init__(state.get('datetimes'), state.get('intensities'),
+                          state.get('detrended_intensities'), state.get('moving_std'))
+            return
+        self.timestamps, self.intensity_array, self.detrended_array, self.moving_std_array = state
+        self._datetimes = None
+        self._intensities = None
+        self._detrended_intensities = None
+        self._moving_std = None
 
     def getDataframe(self):
         return pd.DataFrame({
-            'datetime': self.datetimes,
-            'intensity': self.intensities,
-            'detrended_intensities': self.detrended_intensities,
-            'moving_std': self.moving_std
+            'datetime': self.timestamps.view('datetime64[ns]'),
+            'intensity': self.intensity_array,
+            'detrended_intensities': self.detrended_array,
+            'moving_std': self.moving_std_array
         })
 
 @dataclass
@@ -35,4 +246,42 @@ class Fireball:
     end_time: datetime
     id: int
 
+class FireballBatch:
+    '''
+    Fireballs detected on station data, stored as columns:
+        station_names (str ndarray): Station of each fireball.
+        start_timestamps (int64 ndarray): Epoch nanoseconds of each start.
+        end_timestamps (int64 ndarray): Epoch nanoseconds of each end.
+        ids (int64 ndarray | None): Primary keys, once inserted into the DB.
+
+    Detection builds batches straight from the sample arrays, Fireball objects are only created
+    when a caller asks for them.
+    '''
+    __slots__ = ('station_names', 'start_timestamps', 'end_timestamps', 'ids')
+
+    def __init__(self, station_names, start_timestamps: np.ndarray, end_timestamps: np.ndarray,
+                 ids: np.ndarray | None = None) -> None:
+        self.start_timestamps = np.asarray(start_timestamps, dtype=np.int64)
+        self.end_timestamps = np.asarray(end_timestamps, dtype=np.int64)
+        # A single station name applies to every fireball of the batch
+        self.station_names = np.broadcast_to(np.asarray(station_names, dtype=str), self.start_timestamps.shape)
+        self.ids = None if ids is None else np.asarray(ids, dtype=np.int64)
+
+    @classmethod
+    def fromFireballs(cls, fireballs: list[Fireball]) -> 'FireballBatch':
+        return cls([fireball.station_name for fireball in fireballs],
+                   datetimesToNanoseconds([fireball.start_time for fireball in fireballs]),
+                   datetimesToNanoseconds([fireball.end_time for fireball in fireballs]))
+
+    def toFireballs(self) -> list[Fireball]:
+        ids = self.ids.tolist() if self.ids is not None else [None] * len(self)
+        return [Fireball(station_name=station_name, start_time=start_time, end_time=end_time, id=id)
+                for station_name, start_time, end_time, id in zip(self.station_names.tolist(),
+                                                                    nanosecondsToDatetimes(self.start_timestamps),
+                                                                    nanosecondsToDatetimes(self.end_timestamps), ids)]
+
+    def __len__(self) -> int:
+        return len(self.start_timestamps)
 
+    def __repr__(self) -> str:
+        return f'FireballBatch(fireballs={len(self)})'
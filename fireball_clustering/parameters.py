@@ -3,6 +3,57 @@ Parameter values for the data analysis pipeline.
 
 Author: Armaan Mahajan
 '''
+# Camera frame rate and whether fieldsums are recorded per field (deinterlaced)
+FPS = 25
+DEINTERLACE = False
+
+# Worker processes of the pool (one per ingesting process) used to decompress the nested FS
+# archives of an upload, and the upload size (bytes) below which ingestion stays serial
+INGEST_WORKERS = 4
+PARALLEL_INGEST_MIN_BYTES = 8 * 1024 * 1024
+
+# Detect uploads with inotify where available instead of polling PATH, and how long (seconds) the
+# size and mtime of an upload that appears without a close event must stay unchanged before it is queued
+USE_INOTIFY = True
+UPLOAD_SETTLE_SECONDS = 2.0
+
+# Threads used to walk station directories when scanning PATH
+SCAN_WORKERS = 16
+
+# Size (bytes) of the head and tail blocks hashed to recognise re-uploaded tarballs
+FINGERPRINT_BLOCK_SIZE = 1024 * 1024
+
+# Watchdog ingestion worker processes, the max number of uploads waiting for them,
+# and how often (seconds) their throughput is reported
+WATCHDOG_WORKERS = 4
+INGEST_QUEUE_SIZE = 64
+WATCHDOG_STATS_INTERVAL = 300
+
+# Directory of the memory-mapped fieldsum files of each station night
+SAMPLE_STORE_DIR = './sample_store'
+
+# Codec of stored intensities (see database/codecs.py). 'delta' shrinks real FS data ~2.5x,
+# but reads then decode the whole night instead of mapping only the pages they touch
+FIELDSUM_CODEC = 'raw'
+
+# SQLite connection tuning: bytes of the DB file memory-mapped, page cache size (KiB) and
+# prepared statements cached per connection
+DB_MMAP_SIZE = 256 * 1024 * 1024
+DB_CACHE_SIZE_KB = 64 * 1024
+DB_CACHED_STATEMENTS = 256
+
+# Database writer process: max write batches waiting for it, max batches and seconds per
+# group commit, how often (seconds) its latency and queue depth are reported, and how long
+# (seconds) a caller waits for the results of its writes before giving up
+WRITER_QUEUE_SIZE = 1024
+WRITER_GROUP_SIZE = 64
+WRITER_GROUP_INTERVAL = 0.5
+WRITER_STATS_INTERVAL = 300
+WRITER_CALL_TIMEOUT = 600
+
+# Size in seconds of the bins of the fieldsum summaries written at ingestion
+SUMMARY_BIN_SECONDS = 60
+
 # Intensity cutoff for what is considered a fireball when multiplied by datasets std
 CUTOFF = 3
 
@@ -10,6 +61,11 @@ CUTOFF = 3
 AVG_WINDOW = 30
 STD_WINDOW = 30
 
+# Preprocessing splits a night into segments at gaps longer than this many seconds, and filters
+# the segments on this many threads
+PREPROCESS_GAP_SECONDS = 60
+PREPROCESS_WORKERS = 4
+
 # Temporal Proximity to FR events in seconds
 FR_EVENT_PROXIMITY = 10
 
@@ -17,6 +73,10 @@ FR_EVENT_PROXIMITY = 10
 # to begin analysis (within 1000km) 
 MIN_CAMERAS = 1/3
 
+# Nights older than this many days before the newest ingested night are dropped from the
+# analysis readiness tracker
+READINESS_RETENTION_DAYS = 7
+
 # Min number of station observers per fireball
 MIN_OBSERVERS = 3
 
@@ -1,8 +1,8 @@
 from fireball_clustering.dataclasses.models import StationData, ProcessedStationData, Fireball
-from fireball_clustering.data_processing.preprocessing import ingestFRFiles, ingestStationData, preprocessFieldsums
+from fireball_clustering.data_processing.preprocessing import ingestFRFiles, ingestStationData, preprocessFieldsums, preprocessBatch
 from fireball_clustering.data_processing.clustering import filterFireballsWithFR, identifyFireballs, clusterFireballs
 from fireball_clustering.database import db_queries
-from fireball_clustering.database import db_setup
+from fireball_clustering.database import db_setup, db_connection
 
 import datetime
 import os
@@ -11,7 +11,8 @@ class Perseus:
     def __init__(self, fieldsums_path: str = './fieldsums', fr_path: str = './fr_files') -> None:
         self.fs_path = fieldsums_path
         self.fr_path = fr_path
-        if not os.path.exists('./gmn_fireball_clustering.db'):
+        # Only when run on its own, run.py creates the DB before starting the writer
+        if not os.path.exists(db_connection.DB_PATH):
             db_setup.initializeEmptyDatabase()
             db_setup.insertStations()
      
@@ -59,6 +60,10 @@ class Perseus:
         processed_station_data = preprocessFieldsums(station_data)
         return processed_station_data
 
+    def processBatch(self, stations_data: dict) -> dict:
+        processed_stations_data = preprocessBatch(stations_data)
+        return processed_stations_data
+
     def identify(self, 
                  station_id: str, 
                  processed_station_data: ProcessedStationData, 
@@ -0,0 +1,82 @@
+'''
+    Incremental tracking of the station nights that are ready for analysis.
+'''
+import datetime
+import math
+
+from fireball_clustering.database import db_queries
+from fireball_clustering import parameters
+
+class ReadinessTracker():
+    '''
+    Tracks which station nights are ready for analysis from the ingestion events in the analysis
+    table, instead of recomputing readiness for the whole network on every tick.
+
+    For every central station and night it keeps the set of its neighbours ingested for that night.
+    An ingestion event updates only the neighbourhoods containing the station. A neighbourhood
+    becomes ready when the ingested neighbours first reach MIN_CAMERAS of it, and its group of
+    station nights is then emitted. A later ingestion into a ready neighbourhood emits the group
+    again, so the new night is clustered together with the nights emitted before; the analysis
+    reuses the candidates of the nights that are already processed instead of processing them again.
+    A group is emitted at most once per poll, however many of its nights were ingested.
+    '''
+    def __init__(self) -> None:
+        self.last_rowid = 0
+        self.graph = None
+        self.reverse = {} # station_id -> central stations that have it as a neighbour
+        self.ingested = {} # (central_station_id, date) -> set of ingested neighbour station_ids
+        self.ready = set() # (central_station_id, date) that reached MIN_CAMERAS
+        self.newest_date = None
+
+    def poll(self) -> list[list[tuple[str, datetime.datetime]]]:
+        '''
+        Applies the ingestion events since the last poll.
+
+        Returns:
+            List of groups of (<STATION_ID>, <DATE_OBJ>) that are ready for analysis
+        '''
+        graph = db_queries.getStationGraph()
+        if graph is not self.graph:
+            self.updateGraph(graph)
+
+        # Neighbourhoods ready after this poll's events, each emitted once even if several events touched it
+        ready = {}
+        events = db_queries.getIngestedSince(self.last_rowid)
+        for rowid, station_id, date in events:
+            self.last_rowid = rowid
+            ready.update(dict.fromkeys(self.ingest(station_id, date)))
+
+        groups = [[(neighbour, date) for neighbour in sorted(self.ingested[center, date])] for center, date in ready]
+        if events:
+            self.prune()
+        return groups
+
+    def ingest(self, station_id: str, date: datetime.datetime) -> list[tuple[str, datetime.datetime]]:
+        '''
+        Returns:
+            List of (<CENTRAL_STATION_ID>, <DATE_OBJ>) neighbourhoods whose group is to be emitted
+        '''
+        ready = []
+        for center in self.reverse.get(station_id, ()):
+            key = (center, date)
+            ingested = self.ingested.setdefault(key, set())
+            ingested.add(station_id)
+            if key in self.ready or len(ingested) >= math.floor(len(self.graph[center]) * parameters.MIN_CAMERAS):
+                self.ready.add(key)
+                ready.append(key)
+        if self.newest_date is None or date > self.newest_date:
+            self.newest_date = date
+        return ready
+
+    def updateGraph(self, graph: dict[str, dict[str, float | None]]):
+        self.graph = graph
+        self.reverse = {}
+        for center, neighbours in graph.items():
+            for neighbour in neighbours:
+                self.reverse.setdefault(neighbour, []).append(center)
+
+    def prune(self):
+        oldest = self.newest_date - datetime.timedelta(days=parameters.READINESS_RETENTION_DAYS)
+        for key in [key for key in self.ingested if key[1] < oldest]:
+            del self.ingested[key]
+            self.ready.discard(key)
@@ -0,0 +1,55 @@
+'''
+    Benchmarks the fieldsum intensity codecs on real station uploads.
+
+    Usage: python -m fireball_clustering.testing.benchmarking <upload.tar.bz2> [<upload.tar.bz2> ...]
+
+    Reports per codec the compression ratio against raw uint32 and the encode and decode throughput
+    in MB/s of raw intensities.
+'''
+from fireball_clustering.data_ingestion.local_fetcher import ingestFromTarball
+from fireball_clustering.database import codecs
+
+import argparse
+import time
+import numpy as np
+
+def benchmarkCodecs(intensities: np.ndarray, repeats: int = 5) -> list[tuple[str, float, float, float]]:
+    '''
+    Returns:
+        list[tuple]: (codec, compression ratio, encode MB/s, decode MB/s) of each codec.
+    '''
+    results = []
+    raw_megabytes = intensities.nbytes / 1e6
+    for codec in codecs.CODECS:
+        codec_id = codecs.codecId(codec)
+
+        start = time.perf_counter()
+        for _ in range(repeats):
+            encoded = codecs.encode(intensities, codec_id)
+        encode_time = (time.perf_counter() - start) / repeats
+
+        start = time.perf_counter()
+        for _ in range(repeats):
+            decoded = codecs.decode(encoded, len(intensities), codec_id)
+        decode_time = (time.perf_counter() - start) / repeats
+
+        assert np.array_equal(decoded, intensities), f'{codec} does not round trip'
+        results.append((codec, intensities.nbytes / max(len(encoded), 1),
+                        raw_megabytes / encode_time, raw_megabytes / decode_time))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('uploads', nargs='+', help='Station upload tarballs (*.tar.bz2)')
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    for upload in args.uploads:
+        station_data, _ = ingestFromTarball(upload)
+        print(f'{upload}: {len(station_data)} samples, {station_data.intensity_array.nbytes / 1e6:.1f} MB raw')
+        print(f'{"codec":<12}{"ratio":>8}{"encode MB/s":>14}{"decode MB/s":>14}')
+        for codec, ratio, encode_rate, decode_rate in benchmarkCodecs(station_data.intensity_array, args.repeats):
+            print(f'{codec:<12}{ratio:>8.2f}{encode_rate:>14.1f}{decode_rate:>14.1f}')
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,49 @@
 import unittest
-from fireball_clustering.data_processing.clustering import filterFireballsWithFR
+from fireball_clustering.data_processing.clustering import filterFireballsWithFR, detectCrossings, clusterFireballs
+from fireball_clustering.utils import fieldsum_handlers as fh
+from fireball_clustering.dataclasses.models import StationData, ProcessedStationData, Fireball, FireballBatch
+from fireball_clustering.database import db_queries, db_writes
+from fireball_clustering.database import codecs, db_connection, db_setup, db_writer, fieldsum_format, migrate_fieldsums, sample_store
+from fireball_clustering import parameters
+from fireball_clustering.readiness import ReadinessTracker
+from fireball_clustering.data_processing.summaries import summarizeFieldsums
+from fireball_clustering.data_processing import preprocessing
+from fireball_clustering.data_ingestion import local_fetcher, scanner
+from fireball_clustering.utils.fingerprint import fileFingerprint
+from fireball_clustering import watchdog
 import datetime
+import time
+import queue
+import uuid
+import multiprocessing
+import math
+import io
+import pickle
+import tempfile
+import os
+import tarfile
+import subprocess
+import sys
+import numpy as np
+import pandas as pd
+from scipy import signal
+from concurrent.futures import ThreadPoolExecutor
+from watchdog.events import DirCreatedEvent, DirModifiedEvent, FileClosedEvent, FileCreatedEvent, FileMovedEvent
+
+def makeFieldsumBytes(intensities):
+    intensities = np.asarray(intensities, dtype='<u4')
+    return np.array([len(intensities)], dtype='<u2').tobytes() + intensities.tobytes()
+
+def makeFieldsumTarball(fieldsums: dict) -> bytes:
+    ''' Builds an in memory FS*.tar.bz2 archive from a dict of file name: intensities. '''
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w:bz2') as tar:
+        for name, intensities in fieldsums.items():
+            data = makeFieldsumBytes(intensities)
+            info = tarfile.TarInfo(f'./{name}')
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
 
 class TestFilterFireballs(unittest.TestCase):
     def setUp(self) -> None:
@@ -25,5 +68,994 @@ class TestFilterFireballs(unittest.TestCase):
         expected_result = ['Fireball1', 'Fireball2', 'Fireball6']
         self.assertEqual(expected_result, candidates)
 
+class TestFieldsumDecoder(unittest.TestCase):
+    def testDecode(self):
+        half_frames, intensities = fh.decodeFieldIntensities(makeFieldsumBytes([5, 6, 70000]))
+        self.assertEqual([5, 6, 70000], intensities.tolist())
+        self.assertEqual([0.0, 1.0, 2.0], half_frames.tolist())
+
+        half_frames, _ = fh.readFieldIntensitiesBytes(io.BytesIO(makeFieldsumBytes([5, 6, 7])), deinterlace=True)
+        self.assertEqual([0.0, 0.5, 1.0], half_frames.tolist())
+
+    def testTruncatedBuffer(self):
+        with self.assertRaises(ValueError):
+            fh.decodeFieldIntensities(makeFieldsumBytes([1, 2, 3])[:-1])
+        with self.assertRaises(ValueError):
+            fh.decodeFieldIntensities(b'\x01')
+
+    def testTarball(self):
+        archive = makeFieldsumTarball({
+            'FS_AU0002_20221107_111129_639_0000000.bin': [1, 2, 3],
+            'FS_AU0002_20221107_111139_879_0000256.bin': [4, 5],
+        })
+        with tarfile.open(fileobj=io.BytesIO(archive), mode='r:bz2') as fs_tarball:
+            file_names, counts, intensities = fh.readFieldIntensitiesTarball(fs_tarball)
+        self.assertEqual(['FS_AU0002_20221107_111129_639_0000000.bin', 'FS_AU0002_20221107_111139_879_0000256.bin'], file_names)
+        self.assertEqual([3, 2], counts.tolist())
+        self.assertEqual([1, 2, 3, 4, 5], intensities.tolist())
+
+class TestTarballIngestion(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.min_bytes = parameters.PARALLEL_INGEST_MIN_BYTES
+        parameters.PARALLEL_INGEST_MIN_BYTES = 0
+
+        # Upload with three nested FS archives, the last one overlapping the first in time
+        rng = np.random.default_rng(0)
+        self.path = os.path.join(self.tmp.name, 'AU0002_20221107_111129_639666_detected.tar.bz2')
+        with tarfile.open(self.path, mode='w:bz2') as tar:
+            for i, second in enumerate(['111129', '111139', '111130']):
+                archive = makeFieldsumTarball({
+                    f'FS_AU0002_20221107_{second}_639_0000000.bin': rng.integers(0, 2**20, 256),
+                    f'FS_AU0002_20221107_{second}_879_0000256.bin': rng.integers(0, 2**20, 100),
+                })
+                info = tarfile.TarInfo(f'./FS_AU0002_20221107_{second}_{i}_fieldsums.tar.bz2')
+                info.size = len(archive)
+                tar.addfile(info, io.BytesIO(archive))
+            info = tarfile.TarInfo('./FR_AU0002_20221107_111135_000_0000000.bin')
+            tar.addfile(info, io.BytesIO(b''))
+
+    def tearDown(self) -> None:
+        parameters.PARALLEL_INGEST_MIN_BYTES = self.min_bytes
+        self.tmp.cleanup()
+
+    def testParallelMatchesSerial(self):
+        serial, serial_frs = local_fetcher.ingestFromTarball(self.path, workers=1)
+        parallel, parallel_frs = local_fetcher.ingestFromTarball(self.path, workers=2)
+        self.assertEqual(3 * 356, len(serial))
+        self.assertEqual(serial, parallel)
+        self.assertEqual(['./FR_AU0002_20221107_111135_000_0000000.bin'], serial_frs)
+        self.assertEqual(serial_frs, parallel_frs)
+
+        # The pool is kept for later uploads
+        executor = local_fetcher._getExecutor(2)
+        self.assertEqual(parallel, local_fetcher.ingestFromTarball(self.path, workers=2)[0])
+        self.assertIs(executor, local_fetcher._getExecutor(2))
+
+    def testNoLeakedSharedMemory(self):
+        # In a fresh interpreter the workers must not start resource trackers of their own, which warn
+        # about leaked blocks and unlink them again when they exit
+        script = ('import sys; from fireball_clustering import parameters; parameters.PARALLEL_INGEST_MIN_BYTES = 0; '
+                  'from fireball_clustering.data_ingestion import local_fetcher; '
+                  'local_fetcher.ingestFromTarball(sys.argv[1], workers=2)')
+        root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        result = subprocess.run([sys.executable, '-c', script, self.path], cwd=root, capture_output=True, text=True, timeout=60)
+        self.assertEqual(0, result.returncode, result.stderr)
+        self.assertNotIn('resource_tracker', result.stderr)
+
+class TestFrameTimestamps(unittest.TestCase):
+    def testArithmeticTimestamps(self):
+        start = datetime.datetime(2022, 11, 7, 11, 11, 29, 639000)
+        timestamps = fh.frameTimestamps(start, 10000, 25)
+        self.assertEqual(np.datetime64(start, 'ns').astype(np.int64), timestamps[0])
+        # No drift: the last frame is exactly 9999 periods of 40ms after the first
+        self.assertEqual(9999 * 40_000_000, timestamps[-1] - timestamps[0])
+
+        fields = fh.frameTimestamps(start, 3, 25, deinterlace=True)
+        self.assertEqual([0, 20_000_000, 40_000_000], (fields - fields[0]).tolist())
+
+    def testMergeSortedBlocks(self):
+        timestamps, values = fh.mergeSortedBlocks(
+            [np.array([10, 20]), np.array([0, 5]), np.array([15, 30])],
+            [np.array([1, 2]), np.array([3, 4]), np.array([5, 6])])
+        self.assertEqual([0, 5, 10, 15, 20, 30], timestamps.tolist())
+        self.assertEqual([3, 4, 1, 5, 2, 6], values.tolist())
+
+class TestStationData(unittest.TestCase):
+    def testListViews(self):
+        datetimes = [datetime.datetime(2022, 11, 7, 11, 11, 29, 640000), datetime.datetime(2022, 11, 7, 11, 11, 29, 680000)]
+        station_data = StationData(datetimes, [100, 200])
+        self.assertEqual(np.int64, station_data.timestamps.dtype)
+        self.assertEqual(np.uint32, station_data.intensity_array.dtype)
+        self.assertEqual(tuple(datetimes), station_data.datetimes)
+        self.assertEqual((100, 200), station_data.intensities)
+
+        # ISO8601 strings as stored in the DB resolve to the same columns
+        from_iso = StationData([dt.isoformat() for dt in datetimes], [100, 200])
+        self.assertEqual(station_data, from_iso)
+
+        station_data.intensities = [300, 400]
+        self.assertEqual([300, 400], station_data.intensity_array.tolist())
+
+    def testPickles(self):
+        datetimes = [datetime.datetime(2022, 11, 7, 11, 11, 29, 640000), datetime.datetime(2022, 11, 7, 11, 11, 29, 680000)]
+        station_data = StationData(datetimes, [100, 200])
+        self.assertEqual(station_data, pickle.loads(pickle.dumps(station_data)))
+        processed = ProcessedStationData(datetimes, [100, 200], [np.nan, 1.5], [np.nan, 0.5])
+        self.assertEqual(processed, pickle.loads(pickle.dumps(processed)))
+        self.assertNotEqual(processed, ProcessedStationData(datetimes, [100, 200], [np.nan, 1.5], [np.nan, 0.25]))
+
+        # State of the former dataclasses, as found in old pickles
+        legacy = StationData.__new__(StationData)
+        legacy.__setstate__({'datetimes': datetimes, 'intensities': [100, 200]})
+        self.assertEqual(station_data, legacy)
+        legacy = ProcessedStationData.__new__(ProcessedStationData)
+        legacy.__setstate__({'datetimes': datetimes, 'intensities': [100, 200],
+                             'detrended_intensities': [np.nan, 1.5], 'moving_std': [np.nan, 0.5]})
+        self.assertEqual(processed, legacy)
+
+class TestFieldsumFormat(unittest.TestCase):
+    def testLegacyRows(self):
+        datetimes = [datetime.datetime(2022, 11, 7, 11, 11, 29, 640000), datetime.datetime(2022, 11, 7, 11, 11, 29, 680000)]
+        expected = StationData(datetimes, [100, 200])
+
+        timestamps, intensities = fieldsum_format.decodeFieldsumColumns(
+            pickle.dumps([dt.isoformat() for dt in datetimes]), pickle.dumps([100, 200]))
+        self.assertEqual(expected, StationData(timestamps=timestamps, intensity_array=intensities))
+
+class TestSampleStore(unittest.TestCase):
+    def setUp(self):
+        self.store_dir = tempfile.TemporaryDirectory()
+        self.original_store_dir = parameters.SAMPLE_STORE_DIR
+        parameters.SAMPLE_STORE_DIR = self.store_dir.name
+
+    def tearDown(self):
+        parameters.SAMPLE_STORE_DIR = self.original_store_dir
+        self.store_dir.cleanup()
+
+    def testRoundTripAndWindow(self):
+        start = datetime.datetime(2022, 11, 7, 11, 11, 29, 640000)
+        station_data = StationData(timestamps=fh.frameTimestamps(start, 1000, 25), intensity_array=np.arange(1000))
+        path = sample_store.samplePath('AU0003', datetime.datetime(2022, 11, 7))
+
+        n_samples, start_ns, end_ns = sample_store.writeSamples(path, station_data)
+        self.assertEqual((1000, station_data.timestamps[0], station_data.timestamps[-1]), (n_samples, start_ns, end_ns))
+
+        mapped = sample_store.readSamples(path)
+        self.assertEqual(station_data, mapped)
+        self.assertFalse(mapped.timestamps.flags.writeable)
+
+        window = sample_store.sliceWindow(mapped, station_data.timestamps[100], station_data.timestamps[200])
+        self.assertEqual(tuple(range(100, 201)), window.intensities)
+
+        sample_store.writeSamples(path, StationData())
+        self.assertEqual(0, len(sample_store.readSamples(path)))
+
+    def testConcurrentWritesOfANight(self):
+        path = sample_store.samplePath('AU0002', datetime.datetime(2022, 11, 7))
+        versions = [StationData(timestamps=np.arange(n) * 40_000_000, intensity_array=np.full(n, n)) for n in (1000, 2000)]
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(lambda i: sample_store.writeSamples(path, versions[i % 2]), range(16)))
+
+        # The night is one complete version and no temporary file is left behind
+        self.assertIn(sample_store.readSamples(path), versions)
+        self.assertEqual([os.path.basename(path)], os.listdir(os.path.dirname(sample_store.resolvePath(path))))
+
+class TestCodecs(unittest.TestCase):
+    def testRoundTrip(self):
+        rng = np.random.default_rng(0)
+        series = [
+            np.zeros(0, dtype=np.uint32),
+            np.array([7], dtype=np.uint32),
+            (1_000_000 + np.cumsum(rng.integers(-50, 50, 1000))).astype(np.uint32),
+            # Full range steps need the widest blocks
+            np.array([0, 2**32 - 1, 0, 2**32 - 1], dtype=np.uint32),
+            rng.integers(0, 2**32, 300, dtype=np.uint64).astype(np.uint32),
+        ]
+        for codec in codecs.CODECS:
+            codec_id = codecs.codecId(codec)
+            self.assertEqual(codec, codecs.codecName(codec_id))
+            for values in series:
+                decoded = codecs.decode(codecs.encode(values, codec_id), len(values), codec_id)
+                self.assertTrue(np.array_equal(values, decoded), f'{codec}, {len(values)} values')
+
+    def testDeltaIsSmaller(self):
+        values = (1_000_000 + np.cumsum(np.random.default_rng(0).integers(-50, 50, 1000))).astype(np.uint32)
+        self.assertLess(len(codecs.encode(values, codecs.codecId('delta'))), values.nbytes / 3)
+
+class DatabaseTestCase(unittest.TestCase):
+    '''
+    Runs each test against a fresh database in a temporary directory.
+    '''
+    def setUp(self):
+        self.db_dir = tempfile.TemporaryDirectory()
+        self.original_db_path = db_connection.DB_PATH
+        db_connection.closeConnection()
+        db_connection.DB_PATH = os.path.join(self.db_dir.name, 'test.db')
+
+    def tearDown(self):
+        db_connection.closeConnection()
+        db_connection.DB_PATH = self.original_db_path
+        self.db_dir.cleanup()
+
+class TestMigrations(DatabaseTestCase):
+    def testMigrateExistingDatabase(self):
+        # Tables as created before the first migration, with a duplicated station night
+        conn = db_connection.getConnection()
+        conn.execute('CREATE TABLE analysis(station_id TEXT NOT NULL, date TEXT NOT NULL, status TEXT)')
+        for table in ('fieldsums', 'fr_files'):
+            conn.execute(f'CREATE TABLE {table}(station_id TEXT NOT NULL, date TEXT NOT NULL, datetimes BLOB, intensities BLOB)')
+        conn.execute('CREATE TABLE stations(station_id TEXT PRIMARY KEY, latitude REAL, longitude REAL)')
+        conn.execute('CREATE TABLE radius(station_id TEXT NOT NULL, stations_within_radius BLOB NOT NULL)')
+        for table in ('fireballs', 'candidate_fireballs'):
+            conn.execute(f'CREATE TABLE {table}(fireball_id INTEGER PRIMARY KEY, station_id TEXT NOT NULL, start_time TEXT, end_time TEXT)')
+        conn.execute("INSERT INTO analysis VALUES ('AU0001', '2022-11-07', 'ingested'), ('AU0001', '2022-11-07', 'processed')")
+        conn.execute("INSERT INTO candidate_fireballs (station_id, start_time) VALUES ('AU0001', '2022-11-07T11:12:04.669000')")
+        conn.execute("INSERT INTO stations VALUES ('AU0001', -32.0, 116.0), ('AU0002', -33.0, 116.0)")
+        conn.execute('INSERT INTO radius VALUES (?, ?)', ('AU0001', pickle.dumps(['AU0001', 'AU0002'])))
+        conn.commit()
+
+        db_setup.migrateDatabase()
+        db_setup.migrateDatabase()
+
+        self.assertEqual(db_setup.SCHEMA_VERSION, conn.execute('PRAGMA user_version').fetchone()[0])
+        self.assertEqual([('processed',)], conn.execute('SELECT status FROM analysis').fetchall())
+        self.assertEqual([('2022-11-07',)], conn.execute('SELECT date FROM candidate_fireballs').fetchall())
+        plan = conn.execute('EXPLAIN QUERY PLAN SELECT * FROM analysis WHERE station_id = ? AND date = ?', ('AU0001', '2022-11-07')).fetchall()
+        self.assertIn('USING INDEX', plan[0][-1])
+        self.assertEqual(['AU0001', 'AU0002'], db_queries.getStationsWithinRadius('AU0001'))
+        self.assertAlmostEqual(111.2, db_queries.getStationGraph()['AU0001']['AU0002'], places=1)
+
+class TestWriteBatches(DatabaseTestCase):
+    def testFailedBatchIsRolledBackAlone(self):
+        db_setup.initializeEmptyDatabase()
+        # As in a group commit of the writer: batches are savepoints inside one transaction
+        with db_connection.transaction():
+            db_writer.applyBatch([('insertScannedDirs', ([('/a', 1)],))])
+            with self.assertRaises(Exception):
+                db_writer.applyBatch([('insertScannedDirs', ([('/b', 2)],)),
+                                      ('insertStations', ([('AU0001', 0, 0), ('AU0001', 0, 0)],))])
+            ids, = db_writer.applyBatch([('insertFireballs', ([('AU0001', '2022-11-07T11:12:04', '2022-11-07T11:12:05')],))])
+
+        self.assertEqual({'/a': 1}, db_queries.getScannedDirs())
+        self.assertEqual([], db_queries.getStationsDataByID(['AU0001']))
+        self.assertEqual(1, len(ids))
+
+    def testPandasClusters(self):
+        db_setup.initializeEmptyDatabase()
+        clusters = [(0, '["AU0001", "AU0002"]', '2022-11-07 11:12:04', '2022-11-07 11:12:06')]
+        db_writer.submit(('insertPandasClusters', (clusters,)))
+        self.assertEqual(clusters, db_connection.getConnection().execute('SELECT * FROM pandas_clusters').fetchall())
+
+class TestWriterProcess(DatabaseTestCase):
+    def testCallFailsOnceWriterStops(self):
+        db_setup.initializeEmptyDatabase()
+        db_connection.closeConnection()
+        writer = db_writer.DatabaseWriter()
+        client = writer.client()
+
+        with self.assertRaises(RuntimeError):
+            client.call(('insertScannedDirs', ([('/a', 1)],)), timeout=5)
+
+        writer.start()
+        try:
+            self.assertEqual([None], client.call(('insertScannedDirs', ([('/b', 2)],)), timeout=30))
+        finally:
+            writer.stop()
+        self.assertEqual({'/b': 2}, db_queries.getScannedDirs())
+
+        # A caller waiting on a writer that is gone gets an error instead of hanging
+        start = time.monotonic()
+        with self.assertRaises(RuntimeError):
+            client.call(('insertScannedDirs', ([('/c', 3)],)), timeout=30)
+        self.assertLess(time.monotonic() - start, 5)
+
+    def testCallsFromSeveralProcesses(self):
+        db_setup.initializeEmptyDatabase()
+        db_connection.closeConnection()
+        writer = db_writer.DatabaseWriter()
+        clients = [writer.client() for _ in range(3)]
+        writer.start()
+        try:
+            # Each process gets the replies to its own calls
+            processes = [multiprocessing.Process(target=callWriter, args=(client, f'/p{i}', 20))
+                         for i, client in enumerate(clients)]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join(60)
+            self.assertEqual([0, 0, 0], [process.exitcode for process in processes])
+
+            # A client already used by another process is refused
+            with self.assertRaises(RuntimeError):
+                clients[0].call(('insertScannedDirs', ([('/x', 1)],)), timeout=5)
+        finally:
+            writer.stop()
+        self.assertEqual(60, len(db_queries.getScannedDirs()))
+
+def callWriter(client: db_writer.WriterClient, prefix: str, n_calls: int):
+    for i in range(n_calls):
+        assert client.call(('insertScannedDirs', ([(f'{prefix}/{i}', i)],)), timeout=30) == [None]
+
+class TestFireballInserts(DatabaseTestCase):
+    def testBatchIdsFollowRowOrder(self):
+        db_setup.initializeEmptyDatabase()
+        start = np.datetime64('2022-11-07T23:59:00', 'ns').astype(np.int64)
+        # Crosses the insert chunk size and midnight, with and without fractional seconds
+        starts = start + np.arange(2500, dtype=np.int64) * 500_000_000
+        batch = FireballBatch('AU0001', starts, starts + 250_000_000)
+
+        ids = db_writes.insertFireballs(batch)
+        self.assertEqual(2500, len(ids))
+        self.assertEqual(ids, batch.ids.tolist())
+
+        rows = db_connection.getConnection().execute(
+            'SELECT fireball_id, start_time, end_time, date FROM fireballs ORDER BY fireball_id').fetchall()
+        expected = batch.toFireballs()
+        self.assertEqual(ids, [row[0] for row in rows])
+        for row, fireball in zip(rows, expected):
+            self.assertEqual((fireball.start_time.isoformat(), fireball.end_time.isoformat(),
+                              fireball.start_time.date().isoformat()), row[1:])
+
+    def testTuplesAndFireballs(self):
+        db_setup.initializeEmptyDatabase()
+        ids = db_writes.insertFireballs([('AU0001', '2022-11-07T11:12:04', '2022-11-07T11:12:05.5'),
+                                         ('AU0002', '2022-11-07T11:12:06', '2022-11-07T11:12:07')])
+        self.assertEqual([1, 2], ids)
+
+        fireball = Fireball('AU0001', datetime.datetime(2022, 11, 7, 11, 12, 4), datetime.datetime(2022, 11, 7, 11, 12, 5), 1)
+        self.assertEqual([1], db_writes.insertCandidateFireballs([fireball]))
+        fetched, = db_queries.getFireballsByStationDate('AU0001', datetime.datetime(2022, 11, 7))
+        self.assertEqual(fireball, fetched)
+        self.assertEqual([], db_writes.insertCandidateFireballs([]))
+
+class TestStationGraph(DatabaseTestCase):
+    def testGraphFollowsChanges(self):
+        db_setup.initializeEmptyDatabase()
+        db_writes.insertStations([('AU0001', -32.0, 116.0), ('AU0002', -32.5, 116.0), ('AU0003', -33.0, 116.0)])
+        db_setup.insertRadius()
+        graph = db_queries.getStationGraph()
+        self.assertEqual({'AU0001', 'AU0002', 'AU0003'}, set(graph['AU0002']))
+        self.assertIs(graph, db_queries.getStationGraph())
+
+        db_writes.replaceNeighbours('AU0002', [('AU0001', 55.6)])
+        self.assertEqual({'AU0001': 55.6}, db_queries.getStationGraph()['AU0002'])
+        self.assertEqual([], db_queries.getRadiusStations('AU0004'))
+        with self.assertRaises(ValueError):
+            db_queries.getStationsWithinRadius('AU0004')
+
+    def testRecreatedDatabase(self):
+        stations = [('AU0001', -32.0, 116.0), ('AU0002', -32.5, 116.0), ('AU0003', -33.0, 116.0)]
+        for neighbour_id in ('AU0002', 'AU0003'):
+            # A new database at the same path, with the same number of graph changes
+            db_connection.closeConnection()
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(db_connection.DB_PATH + suffix):
+                    os.remove(db_connection.DB_PATH + suffix)
+            db_setup.initializeEmptyDatabase()
+            db_writes.insertStations(stations)
+            db_writes.insertNeighbours([('AU0001', neighbour_id, 1.0)])
+            self.assertEqual({neighbour_id: 1.0}, db_queries.getStationGraph()['AU0001'])
+
+class TestReadinessTracker(DatabaseTestCase):
+    def testGroupsEmittedOnceAtThreshold(self):
+        db_setup.initializeEmptyDatabase()
+        # AU0001 has 6 neighbours (itself included), so 2 must be ingested; AU0006 only has itself
+        db_writes.insertNeighbours([('AU0001', f'AU000{i}', 0.0) for i in range(1, 7)] + [('AU0006', 'AU0006', 0.0)])
+        night = datetime.datetime(2022, 11, 7)
+        tracker = ReadinessTracker()
+
+        db_writes.setDataToIngested([('AU0002', night)])
+        self.assertEqual([], tracker.poll())
+        db_writes.setDataToIngested([('AU0003', night), ('AU0004', night)])
+        self.assertEqual([[('AU0002', night), ('AU0003', night), ('AU0004', night)]], tracker.poll())
+        self.assertEqual([], tracker.poll())
+
+        # A late night is emitted with the nights of every ready neighbourhood it is in
+        db_writes.setDataToIngested([('AU0006', night)])
+        groups = tracker.poll()
+        self.assertIn([('AU0006', night)], groups)
+        self.assertIn([('AU0002', night), ('AU0003', night), ('AU0004', night), ('AU0006', night)], groups)
+        self.assertEqual(2, len(groups))
+        self.assertEqual([], tracker.poll())
+
+        # Other nights are tracked separately
+        db_writes.setDataToIngested([('AU0002', night + datetime.timedelta(days=1))])
+        self.assertEqual([], tracker.poll())
+
+    def testLateNightClusteredWithEarlierNights(self):
+        db_setup.initializeEmptyDatabase()
+        db_writes.insertStations([(f'AU000{i}', -33.0 - i / 100, 151.0) for i in range(1, 7)])
+        db_writes.insertNeighbours([(f'AU000{i}', f'AU000{j}', 0.0) for i in range(1, 7) for j in range(1, 7)])
+        night = datetime.datetime(2022, 11, 7)
+        start = datetime.datetime(2022, 11, 7, 11, 12, 4)
+        tracker = ReadinessTracker()
+
+        # Two stations saw the fireball and were processed before the third one's night arrived
+        db_writes.setDataToIngested([('AU0001', night), ('AU0002', night)])
+        groups = tracker.poll()
+        self.assertTrue(groups)
+        db_writes.insertCandidateFireballs([Fireball(station_id, start, start + datetime.timedelta(seconds=2), None)
+                                            for station_id in ('AU0001', 'AU0002')])
+        db_writes.setDataToProcessed([('AU0001', night), ('AU0002', night)])
+
+        # The late night comes with the processed ones, whose stored candidates are clustered with its own
+        db_writes.setDataToIngested([('AU0003', night)])
+        groups = tracker.poll()
+        self.assertIn([('AU0001', night), ('AU0002', night), ('AU0003', night)], groups)
+        candidates = [Fireball('AU0003', start, start + datetime.timedelta(seconds=2), None)]
+        for station_id, date in groups[0]:
+            if db_queries.isProcessed(station_id, date):
+                candidates.extend(db_queries.getFireballsByStationDate(station_id, date))
+        clusters = clusterFireballs(candidates)
+        self.assertEqual(['AU0001', 'AU0002', 'AU0003'], sorted(clusters['station_id']))
+
+class TestSummaries(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.original_store_dir = parameters.SAMPLE_STORE_DIR
+        parameters.SAMPLE_STORE_DIR = os.path.join(self.db_dir.name, 'sample_store')
+
+    def tearDown(self):
+        parameters.SAMPLE_STORE_DIR = self.original_store_dir
+        super().tearDown()
+
+    def testSummarizeFieldsums(self):
+        start = np.datetime64('2022-11-14T19:57:30', 'ns').astype(np.int64)
+        timestamps = start + np.arange(0, 90 * 25) * 40_000_000
+        # A slowly rising trend with a flash of 500 over it in the second minute
+        intensities = (4_000_000_000 + np.arange(len(timestamps)) // 20).astype(np.uint32)
+        intensities[1000] += 500
+        station_data = StationData(timestamps=timestamps, intensity_array=intensities)
+
+        first, second = summarizeFieldsums(station_data, bin_seconds=60)
+        self.assertEqual(int(start - 30 * 10**9), first[0])
+        self.assertEqual((750, 1500), (first[1], second[1]))
+        self.assertEqual(int(intensities[750:].max()), second[2])
+        self.assertAlmostEqual(np.mean(intensities[750:]), second[3], places=3)
+        self.assertAlmostEqual(np.std(intensities[750:].astype(np.float64)), second[4], places=3)
+        self.assertAlmostEqual(500, second[5], delta=1)
+        self.assertLess(first[5], 2)
+
+        db_setup.initializeEmptyDatabase()
+        db_writes.insertFieldsums('AU0001', datetime.datetime(2022, 11, 14), station_data)
+        window = (datetime.datetime(2022, 11, 14, 19, 50), datetime.datetime(2022, 11, 14, 20, 0))
+        self.assertEqual(2, len(db_queries.getSummariesInWindow(*window)))
+        screened = db_queries.getSummariesInWindow(*window, station_ids=['AU0001'], min_excursion=parameters.CUTOFF)
+        self.assertEqual([('AU0001', datetime.datetime(2022, 11, 14, 19, 58))], [row[:2] for row in screened])
+
+    def testAdjacentNightsShareABin(self):
+        db_setup.initializeEmptyDatabase()
+        # The first night ends and the next begins within the 12:00 bin
+        shared_bin = np.datetime64('2022-11-15T12:00:00', 'ns').astype(np.int64)
+        first = StationData(timestamps=shared_bin - 90 * 10**9 + np.arange(0, 120) * 10**9,
+                            intensity_array=np.full(120, 100))
+        second = StationData(timestamps=shared_bin + 40 * 10**9 + np.arange(0, 60) * 10**9,
+                             intensity_array=np.full(60, 300))
+        db_writes.insertFieldsums('AU0001', datetime.datetime(2022, 11, 14), first)
+        db_writes.insertFieldsums('AU0001', datetime.datetime(2022, 11, 15), second)
+
+        window = (datetime.datetime(2022, 11, 15, 11, 0), datetime.datetime(2022, 11, 15, 13, 0))
+        samples = np.concatenate([first.intensity_array[90:], second.intensity_array[:20]])
+        expected = (30 + 20, 300, np.mean(samples), np.std(samples))
+        summaries = {row[1]: row[2:6] for row in db_queries.getSummariesInWindow(*window)}
+        self.assertEqual(4, len(summaries))
+        self.assertEqual(expected, summaries[datetime.datetime(2022, 11, 15, 12, 0)])
+
+        # Re-ingesting either night keeps the other night's samples in the shared bin
+        db_writes.insertFieldsums('AU0001', datetime.datetime(2022, 11, 14), first)
+        summaries = {row[1]: row[2:6] for row in db_queries.getSummariesInWindow(*window)}
+        self.assertEqual(4, len(summaries))
+        self.assertEqual(expected, summaries[datetime.datetime(2022, 11, 15, 12, 0)])
+
+    def testShorterReupload(self):
+        db_setup.initializeEmptyDatabase()
+        start = np.datetime64('2022-11-15T11:57:30', 'ns').astype(np.int64)
+        def samples(first_second: int, n_samples: int, intensity: int) -> StationData:
+            return StationData(timestamps=start + (first_second + np.arange(n_samples)) * 10**9,
+                               intensity_array=np.full(n_samples, intensity))
+
+        # The first night ends in the 11:58 bin, the second begins in it and is then re-uploaded shorter
+        db_writes.insertFieldsums('AU0001', datetime.datetime(2022, 11, 14), samples(0, 60, 100))
+        db_writes.insertFieldsums('AU0001', datetime.datetime(2022, 11, 15), samples(70, 180, 300))
+        db_writes.insertFieldsums('AU0001', datetime.datetime(2022, 11, 15), samples(100, 70, 200))
+
+        window = (datetime.datetime(2022, 11, 15, 11, 0), datetime.datetime(2022, 11, 15, 13, 0))
+        summaries = [(row[1].strftime('%H:%M'), row[2], row[4]) for row in db_queries.getSummariesInWindow(*window)]
+        self.assertEqual([('11:57', 30, 100), ('11:58', 30, 100), ('11:59', 50, 200), ('12:00', 20, 200)], summaries)
+
+class TestReingestion(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.original_store_dir = parameters.SAMPLE_STORE_DIR
+        parameters.SAMPLE_STORE_DIR = os.path.join(self.db_dir.name, 'sample_store')
+        db_setup.initializeEmptyDatabase()
+
+    def tearDown(self):
+        parameters.SAMPLE_STORE_DIR = self.original_store_dir
+        super().tearDown()
+
+    def ingestUpload(self, fingerprint: str, station_data: StationData, fr_files: list[str]) -> list:
+        # The batch a watchdog worker submits for an upload
+        return self.commitUpload(fingerprint, station_data, fr_files, self.writeUpload(station_data))
+
+    def writeUpload(self, station_data: StationData) -> tuple:
+        path = sample_store.samplePath('AU0001', datetime.datetime(2022, 11, 14), uuid.uuid4().hex)
+        return path, *sample_store.writeSamples(path, station_data)
+
+    def commitUpload(self, fingerprint: str, station_data: StationData, fr_files: list[str], written: tuple) -> list:
+        date = datetime.datetime(2022, 11, 14)
+        path, n_samples, start_ns, end_ns = written
+        try:
+            results = db_writer.applyBatch([
+                ('insertLedgerEntry', (fingerprint, '/uploads/AU0001_20221114.tar.bz2', 'AU0001', date)),
+                ('catalogFieldsums', ('AU0001', date, path, n_samples, start_ns, end_ns)),
+                ('insertSummaries', ('AU0001', start_ns, end_ns, summarizeFieldsums(station_data))),
+                ('insertFRs', ('AU0001', date, fr_files)),
+                ('setDataToIngested', ([('AU0001', date)],)),
+            ])
+        except db_writes.DuplicateUpload:
+            sample_store.removeSamples(path)
+            raise
+        if results[1] is not None:
+            sample_store.removeSamples(results[1])
+        return results
+
+    def storedFiles(self) -> list[str]:
+        return [os.path.join('AU0001', name) for name in os.listdir(os.path.join(parameters.SAMPLE_STORE_DIR, 'AU0001'))]
+
+    def catalogedFiles(self) -> list[str]:
+        return [row[0] for row in db_connection.getConnection().execute('SELECT path FROM fieldsums')]
+
+    def countRows(self) -> list[int]:
+        conn = db_connection.getConnection()
+        return [conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+                for table in ('fieldsums', 'fr_files', 'analysis', 'ingestion_ledger')]
+
+    def testReuploadReplacesNight(self):
+        start = np.datetime64('2022-11-14T19:57:30', 'ns').astype(np.int64)
+        timestamps = start + np.arange(0, 90 * 25) * 40_000_000
+        first = StationData(timestamps=timestamps, intensity_array=np.full(len(timestamps), 100))
+        self.ingestUpload('1-aaaa', first, ['./FR_1.bin'])
+        n_summaries = len(db_queries.getSummariesInWindow(datetime.datetime(2022, 11, 14), datetime.datetime(2022, 11, 15)))
+
+        # The same content again is rejected as a whole, even if the upfront ledger check raced
+        with self.assertRaises(db_writes.DuplicateUpload):
+            self.ingestUpload('1-aaaa', first, ['./FR_1.bin', './FR_2.bin'])
+        self.assertEqual([1, 1, 1, 1], self.countRows())
+        fr_dump, = db_connection.getConnection().execute('SELECT fr_timestamps FROM fr_files').fetchone()
+        self.assertEqual(['./FR_1.bin'], pickle.loads(fr_dump))
+        # The rejected upload's file is removed, not the one of the same content it raced with
+        self.assertEqual(self.catalogedFiles(), self.storedFiles())
+
+        # New content for the same night replaces its rows instead of adding to them
+        second = StationData(timestamps=timestamps, intensity_array=np.full(len(timestamps), 200))
+        self.ingestUpload('1-bbbb', second, ['./FR_1.bin', './FR_2.bin'])
+        self.assertEqual([1, 1, 1, 2], self.countRows())
+        self.assertEqual(second, db_queries.getStationDataByDate('AU0001', datetime.datetime(2022, 11, 14)))
+        # The replaced upload's file is removed, the cataloged one is the new upload's own
+        self.assertEqual(self.catalogedFiles(), self.storedFiles())
+        summaries = db_queries.getSummariesInWindow(datetime.datetime(2022, 11, 14), datetime.datetime(2022, 11, 15))
+        self.assertEqual(n_summaries, len(summaries))
+        self.assertTrue(db_queries.isIngestedFingerprint('1-bbbb'))
+
+    def testRacingUploadsOfANight(self):
+        start = np.datetime64('2022-11-14T19:57:30', 'ns').astype(np.int64)
+        first = StationData(timestamps=start + np.arange(0, 100) * 40_000_000, intensity_array=np.full(100, 100))
+        second = StationData(timestamps=start + np.arange(0, 50) * 40_000_000, intensity_array=np.full(50, 200))
+
+        # Two workers write their samples, then commit in the opposite order
+        first_written = self.writeUpload(first)
+        second_written = self.writeUpload(second)
+        self.commitUpload('1-bbbb', second, [], second_written)
+        self.commitUpload('1-aaaa', first, [], first_written)
+
+        # The last commit is cataloged together with its own samples
+        self.assertEqual(first, db_queries.getStationDataByDate('AU0001', datetime.datetime(2022, 11, 14)))
+        self.assertEqual(self.catalogedFiles(), self.storedFiles())
+
+class TestFieldsumMigration(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.original_store_dir = parameters.SAMPLE_STORE_DIR
+        parameters.SAMPLE_STORE_DIR = os.path.join(self.db_dir.name, 'sample_store')
+        db_setup.initializeEmptyDatabase()
+
+    def tearDown(self):
+        parameters.SAMPLE_STORE_DIR = self.original_store_dir
+        super().tearDown()
+
+    def testInlineRowsMovedToStore(self):
+        datetimes = [datetime.datetime(2022, 11, 7, 11, 11, 29, 640000), datetime.datetime(2022, 11, 7, 11, 11, 29, 680000)]
+        with db_connection.transaction() as cursor:
+            for station_id in ('AU0001', 'AU0002', 'AU0003'):
+                cursor.execute('INSERT INTO fieldsums (station_id, date, datetimes, intensities) VALUES(?, ?, ?, ?)',
+                               (station_id, '2022-11-07T00:00:00', pickle.dumps([dt.isoformat() for dt in datetimes]),
+                                pickle.dumps([100, 200])))
+
+        self.assertEqual(3, migrate_fieldsums.migrateFieldsums(batch_size=2))
+        self.assertEqual(0, migrate_fieldsums.migrateFieldsums(batch_size=2))
+        for station_id in ('AU0001', 'AU0002', 'AU0003'):
+            self.assertEqual(StationData(datetimes, [100, 200]),
+                             db_queries.getStationDataByDate(station_id, datetime.datetime(2022, 11, 7)))
+
+class TestFingerprint(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def writeFile(self, name: str, content: bytes) -> str:
+        path = os.path.join(self.tmp.name, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def testFingerprint(self):
+        content = np.random.default_rng(0).bytes(10_000)
+        original = self.writeFile('a.tar.bz2', content)
+        copy = self.writeFile('b.tar.bz2', content)
+        self.assertEqual(fileFingerprint(original, block_size=1024), fileFingerprint(copy, block_size=1024))
+        self.assertTrue(fileFingerprint(original).startswith('10000-'))
+
+        # Changes to the head, tail or size are seen, the middle is only hashed in full
+        middle = self.writeFile('c.tar.bz2', content[:5000] + b'x' + content[5001:])
+        tail = self.writeFile('d.tar.bz2', content[:-1] + b'x')
+        longer = self.writeFile('e.tar.bz2', content + b'x')
+        self.assertEqual(fileFingerprint(original, block_size=1024), fileFingerprint(middle, block_size=1024))
+        self.assertNotEqual(fileFingerprint(original, full=True, block_size=1024), fileFingerprint(middle, full=True, block_size=1024))
+        self.assertNotEqual(fileFingerprint(original, block_size=1024), fileFingerprint(tail, block_size=1024))
+        self.assertNotEqual(fileFingerprint(original, block_size=1024), fileFingerprint(longer, block_size=1024))
+
+        # Small files are always hashed in full
+        self.assertEqual(fileFingerprint(original, full=True), fileFingerprint(original))
+
+class RecordingProducer():
+    ''' Stands in for FileWatcherProducer, recording what would be queued. '''
+    def __init__(self) -> None:
+        self.enqueued = []
+
+    def enqueue(self, path, signature=None):
+        self.enqueued.append(path)
+
+class TestUploadEvents(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.original_path = parameters.PATH
+        self.original_settle = parameters.UPLOAD_SETTLE_SECONDS
+        parameters.PATH = self.tmp.name
+        parameters.UPLOAD_SETTLE_SECONDS = 0.05
+        os.makedirs(os.path.join(self.tmp.name, 'AU0002', 'processed'))
+        self.upload = os.path.join(self.tmp.name, 'AU0002', 'AU0002_20221107_111129_639666_detected.tar.bz2')
+        with open(self.upload, 'wb') as f:
+            f.write(b'upload')
+        self.producer = RecordingProducer()
+        self.handler = watchdog.UploadEventHandler(self.producer)
+
+    def tearDown(self):
+        parameters.PATH = self.original_path
+        parameters.UPLOAD_SETTLE_SECONDS = self.original_settle
+        self.tmp.cleanup()
+
+    def waitForEnqueued(self, n: int):
+        deadline = time.monotonic() + 2
+        while len(self.producer.enqueued) < n and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def testIsUploadPath(self):
+        root = self.tmp.name
+        self.assertTrue(watchdog.isUploadPath(os.path.join(root, 'upload.tar.bz2'), root))
+        self.assertTrue(watchdog.isUploadPath(os.path.join(root, 'AU0002', 'upload.tar.bz2'), root))
+        self.assertTrue(watchdog.isUploadPath(os.path.join(root, 'AU0002', 'processed', 'upload.tar.bz2'), root))
+        self.assertFalse(watchdog.isUploadPath(os.path.join(root, 'AU0002', 'upload.tar.bz2.part'), root))
+        self.assertFalse(watchdog.isUploadPath(os.path.join(root, 'AU0002', 'tmp', 'upload.tar.bz2'), root))
+        self.assertFalse(watchdog.isUploadPath(os.path.join(os.path.dirname(root), 'upload.tar.bz2'), root))
+
+    def testCloseAndMoveEvents(self):
+        self.handler.on_closed(FileClosedEvent(self.upload))
+        self.handler.on_moved(FileMovedEvent(self.upload + '.part', self.upload))
+        self.handler.on_moved(FileMovedEvent(self.upload, self.upload + '.old'))
+        self.handler.on_closed(DirModifiedEvent(os.path.join(self.tmp.name, 'AU0002')))
+        self.assertEqual([self.upload, self.upload], self.producer.enqueued)
+
+    def testCreatedEventWaitsForSettledFile(self):
+        # Moved in from outside the watched tree, the file is complete
+        self.handler.on_created(FileCreatedEvent(self.upload))
+        self.waitForEnqueued(1)
+        self.assertEqual([self.upload], self.producer.enqueued)
+
+        # Still being written: it grows before the re-check and is left to its close event
+        growing = os.path.join(self.tmp.name, 'AU0002', 'AU0002_20221108_111129_639666_detected.tar.bz2')
+        with open(growing, 'wb') as f:
+            f.write(b'up')
+            f.flush()
+            self.handler.on_created(FileCreatedEvent(growing))
+            f.write(b'load')
+        time.sleep(0.2)
+        self.assertEqual([self.upload], self.producer.enqueued)
+
+        # Empty files and directories are never queued from a created event
+        empty = os.path.join(self.tmp.name, 'AU0002', 'AU0002_20221109_111129_639666_detected.tar.bz2')
+        open(empty, 'wb').close()
+        self.handler.on_created(FileCreatedEvent(empty))
+        self.handler.on_created(DirCreatedEvent(os.path.join(self.tmp.name, 'AU0002', 'processed')))
+        time.sleep(0.2)
+        self.assertEqual([self.upload], self.producer.enqueued)
+
+class TestScanner(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.station_dir = os.path.join(self.tmp.name, 'AU0002')
+        self.processed_dir = os.path.join(self.station_dir, 'processed')
+        os.makedirs(self.processed_dir)
+        os.makedirs(os.path.join(self.tmp.name, 'backups'))
+        for path in (os.path.join(self.station_dir, 'AU0002_20221107.tar.bz2'), os.path.join(self.station_dir, 'notes.txt'),
+                     os.path.join(self.processed_dir, 'AU0002_20221106.tar.bz2'),
+                     os.path.join(self.tmp.name, 'backups', 'AU0002_20221105.tar.bz2')):
+            with open(path, 'wb') as f:
+                f.write(b'upload')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def testIsScannedDir(self):
+        self.assertTrue(scanner.isScannedDir('AU0002'))
+        self.assertTrue(scanner.isScannedDir('Processed'))
+        self.assertFalse(scanner.isScannedDir('backups'))
+
+    def testPrunesUnchangedDirs(self):
+        scanned, stats = scanner.ParallelScanner(workers=2).scan(self.tmp.name)
+        files = {scanned_dir.path: [os.path.basename(path) for path, _, _ in scanned_dir.files] for scanned_dir in scanned}
+        self.assertEqual({self.tmp.name: [], self.station_dir: ['AU0002_20221107.tar.bz2'],
+                          self.processed_dir: ['AU0002_20221106.tar.bz2']}, files)
+        self.assertEqual((3, 0, 2), (stats.dirs, stats.pruned_dirs, stats.files))
+
+        # Unchanged directories are not listed, but their subdirectories are still visited
+        dir_mtimes = {scanned_dir.path: scanned_dir.mtime_ns for scanned_dir in scanned}
+        with open(os.path.join(self.processed_dir, 'AU0002_20221108.tar.bz2'), 'wb') as f:
+            f.write(b'upload')
+        os.utime(self.processed_dir, ns=(0, dir_mtimes[self.processed_dir] + 1))
+        scanned, stats = scanner.ParallelScanner(workers=2).scan(self.tmp.name, dir_mtimes)
+        listed = {scanned_dir.path: scanned_dir.files for scanned_dir in scanned}
+        self.assertIsNone(listed[self.station_dir])
+        self.assertEqual(2, len(listed[self.processed_dir]))
+        self.assertEqual((3, 2, 2), (stats.dirs, stats.pruned_dirs, stats.files))
+
+    def testUnchangedDirsNotListed(self):
+        scanned, _ = scanner.ParallelScanner(workers=2).scan(self.tmp.name)
+        dir_mtimes = {scanned_dir.path: scanned_dir.mtime_ns for scanned_dir in scanned}
+        dir_subdirs = {scanned_dir.path: scanned_dir.subdirs for scanned_dir in scanned}
+        self.assertEqual([self.processed_dir], dir_subdirs[self.station_dir])
+
+        # With their subdirectories known, unchanged directories are only stat'ed
+        scanned, stats = scanner.ParallelScanner(workers=2).scan(self.tmp.name, dir_mtimes, dir_subdirs)
+        self.assertEqual((3, 3, 3, 0), (stats.dirs, stats.pruned_dirs, stats.unlisted_dirs, stats.entries))
+        self.assertEqual({self.tmp.name, self.station_dir, self.processed_dir}, {scanned_dir.path for scanned_dir in scanned})
+
+        # A new subdirectory changes the mtime of its parent, which is listed again
+        new_dir = os.path.join(self.station_dir, 'PROCESSED')
+        os.makedirs(new_dir)
+        os.utime(self.station_dir, ns=(0, dir_mtimes[self.station_dir] + 1))
+        scanned, stats = scanner.ParallelScanner(workers=2).scan(self.tmp.name, dir_mtimes, dir_subdirs)
+        self.assertIn(new_dir, {scanned_dir.path for scanned_dir in scanned})
+        self.assertEqual((4, 2), (stats.dirs, stats.unlisted_dirs))
+
+class TestPolling(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.original_path = parameters.PATH
+        self.original_settle = parameters.UPLOAD_SETTLE_SECONDS
+        parameters.PATH = self.tmp.name
+        parameters.UPLOAD_SETTLE_SECONDS = 0
+        self.station_dir = os.path.join(self.tmp.name, 'AU0002')
+        os.makedirs(self.station_dir)
+        self.producer = watchdog.FileWatcherProducer(queue.Queue(), queue.Queue())
+        self.producer.latest_timestamp = 0
+
+    def tearDown(self):
+        parameters.PATH = self.original_path
+        parameters.UPLOAD_SETTLE_SECONDS = self.original_settle
+        self.tmp.cleanup()
+
+    def finishIngestion(self):
+        # What a consumer does with the next queued upload
+        self.producer.done.put(self.producer.queue.get_nowait())
+        self.producer.evict_done()
+
+    def testHalfWrittenUploadIsQueuedAgain(self):
+        upload = os.path.join(self.station_dir, 'AU0002_20221107_111129_639666_detected.tar.bz2')
+        with open(upload, 'wb') as f:
+            f.write(b'up')
+        os.utime(upload, ns=(0, 10**18))
+        self.producer.poll()
+        self.assertNotIn(self.station_dir, self.producer.dir_mtimes)
+
+        # Its ingestion fails while the rest is written, which leaves the directory mtime unchanged
+        self.finishIngestion()
+        with open(upload, 'ab') as f:
+            f.write(b'load')
+        os.utime(upload, ns=(0, 10**18 + 10**9))
+        self.producer.poll()
+        self.assertEqual(upload, self.producer.queue.queue[0])
+
+        # Once nothing is in flight the directory is pruned
+        self.finishIngestion()
+        self.producer.poll()
+        self.assertTrue(self.producer.queue.empty())
+        self.assertIn(self.station_dir, self.producer.dir_mtimes)
+        scanned, _ = self.producer.scanner.scan(self.tmp.name, self.producer.dir_mtimes)
+        self.assertEqual([None], [scanned_dir.files for scanned_dir in scanned if scanned_dir.path == self.station_dir])
+
+class TestCatchUp(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.upload_dir = tempfile.TemporaryDirectory()
+        self.original_path = parameters.PATH
+        parameters.PATH = self.upload_dir.name
+        os.makedirs(os.path.join(self.upload_dir.name, 'AU0002'))
+
+    def tearDown(self):
+        parameters.PATH = self.original_path
+        self.upload_dir.cleanup()
+        super().tearDown()
+
+    def writeUpload(self, name: str) -> str:
+        path = os.path.join(self.upload_dir.name, 'AU0002', name)
+        with open(path, 'wb') as f:
+            f.write(b'upload')
+        return path
+
+    def testFirstStartRecordsBaseline(self):
+        existing = self.writeUpload('AU0002_20221107_111129_639666_detected.tar.bz2')
+        producer = watchdog.FileWatcherProducer(queue.Queue(), queue.Queue())
+        producer.catch_up()
+        self.assertTrue(os.path.exists(db_connection.DB_PATH))
+        self.assertIn(existing, db_queries.getScannedFiles())
+        self.assertTrue(producer.queue.empty())
+
+        # Only the upload that arrived in between is queued on the next start
+        arrived = self.writeUpload('AU0002_20221108_111129_639666_detected.tar.bz2')
+        producer = watchdog.FileWatcherProducer(queue.Queue(), queue.Queue())
+        producer.catch_up()
+        self.assertEqual(arrived, producer.queue.get_nowait())
+        self.assertTrue(producer.queue.empty())
+        self.assertEqual([arrived], list(producer.enqueued))
+
+        # Uploads the consumers are done with are forgotten
+        producer.done.put(arrived)
+        producer.evict_done()
+        self.assertEqual({}, producer.enqueued)
+
+    def testUnchangedDirsNotListedOnRestart(self):
+        # Settled long ago, so its directory is recorded on the first start
+        os.utime(self.writeUpload('AU0002_20221107_111129_639666_detected.tar.bz2'), ns=(0, 10**18))
+        os.makedirs(os.path.join(self.upload_dir.name, 'AU0002', 'processed'))
+        watchdog.FileWatcherProducer(queue.Queue(), queue.Queue()).catch_up()
+        station_dir = os.path.join(self.upload_dir.name, 'AU0002')
+        self.assertEqual([os.path.join(station_dir, 'processed')], db_queries.getScannedSubdirs()[station_dir])
+
+        producer = watchdog.FileWatcherProducer(queue.Queue(), queue.Queue())
+        producer.catch_up()
+        scanned, stats = producer.scanner.scan(parameters.PATH, db_queries.getScannedDirs(), db_queries.getScannedSubdirs())
+        self.assertEqual((3, 3, 0), (stats.dirs, stats.unlisted_dirs, stats.entries))
+
+def preprocessFieldsumsPandas(station_data: StationData, avg_window=30, std_window=30):
+    '''
+    The DataFrame implementation preprocessFieldsums replaced, kept as the reference of its semantics.
+    '''
+    df = pd.DataFrame({
+        'datetimes': station_data.timestamps.view('datetime64[ns]'),
+        'intensities': station_data.intensity_array,
+    }).set_index('datetimes')
+    b, a = signal.butter(4, [1/10, 1], btype='bandpass', fs=parameters.FPS)
+    df['bandpass_intensities'] = abs(signal.filtfilt(b, a, df['intensities']))
+    moving_avg = df['bandpass_intensities'].rolling(window=f'{avg_window}s').mean()
+    df['detrended_intensities'] = abs(df['bandpass_intensities'] - moving_avg)
+    df['moving_std'] = df['detrended_intensities'].rolling(window=f'{std_window}s').std()
+    return df['detrended_intensities'].to_numpy(), df['moving_std'].to_numpy()
+
+class TestPreprocessing(unittest.TestCase):
+    def testMatchesPandas(self):
+        rng = np.random.default_rng(7)
+        # Two blocks of fields with a gap between them, noise on a slow trend and a flash
+        start = np.datetime64('2022-11-14T19:50:00', 'ns').astype(np.int64)
+        timestamps = np.concatenate([start + np.arange(9000) * 20_000_000,
+                                     start + 200 * 10**9 + np.arange(6000) * 20_000_000])
+        intensities = (2_000_000 + np.linspace(0, 50_000, len(timestamps)) + rng.normal(0, 300, len(timestamps))).astype(np.uint32)
+        intensities[4000:4010] += 20_000
+        station_data = StationData(timestamps=timestamps, intensity_array=intensities)
+
+        for avg_window, std_window in ((30, 30), (10, 45)):
+            processed = preprocessing.preprocessFieldsums(station_data, avg_window, std_window)
+            detrended, moving_std = preprocessFieldsumsPandas(station_data, avg_window, std_window)
+            np.testing.assert_allclose(processed.detrended_array, detrended, rtol=1e-9, atol=1e-6)
+            np.testing.assert_allclose(processed.moving_std_array, moving_std, rtol=1e-7, atol=1e-6)
+        self.assertIs(station_data.timestamps, processed.timestamps)
+        self.assertTrue(np.isnan(processed.moving_std_array[0]))
+
+    def testSegmentsAreProcessedSeparately(self):
+        rng = np.random.default_rng(11)
+        start = np.datetime64('2022-11-14T10:00:00', 'ns').astype(np.int64)
+        # Three capture sessions an hour apart, the last one shorter than the filter padding
+        sessions = [start + np.arange(n) * 40_000_000 + k * 3600 * 10**9 for k, n in enumerate((5000, 3000, 20))]
+        timestamps = np.concatenate(sessions)
+        intensities = (1_000_000 + rng.normal(0, 200, len(timestamps))).astype(np.uint32)
+        np.testing.assert_array_equal([0, 5000, 8000, 8020], preprocessing.segmentEdges(timestamps))
+
+        detrended, moving_std = preprocessing.preprocessArrays(timestamps, intensities)
+        lo = 0
+        for session in sessions:
+            hi = lo + len(session)
+            segment_detrended, segment_std = preprocessing.preprocessArrays(timestamps[lo:hi], intensities[lo:hi])
+            np.testing.assert_array_equal(segment_detrended, detrended[lo:hi])
+            np.testing.assert_array_equal(segment_std, moving_std[lo:hi])
+            lo = hi
+
+    def testBatchMatchesSingleStations(self):
+        rng = np.random.default_rng(5)
+        start = np.datetime64('2022-11-14T19:00:00', 'ns').astype(np.int64)
+        stations_data = {}
+        for station_id, n_samples in (('AU0001', 6000), ('AU0002', 2500), ('AU0003', 0)):
+            timestamps = start + np.arange(n_samples) * 40_000_000
+            intensities = (3_000_000 + rng.normal(0, 400, n_samples)).astype(np.uint32)
+            stations_data[station_id] = StationData(timestamps=timestamps, intensity_array=intensities)
+
+        processed = preprocessing.preprocessBatch(stations_data)
+        self.assertEqual(list(stations_data), list(processed))
+        for station_id, station_data in stations_data.items():
+            single = preprocessing.preprocessFieldsums(station_data)
+            np.testing.assert_array_equal(single.detrended_array, processed[station_id].detrended_array)
+            np.testing.assert_array_equal(single.moving_std_array, processed[station_id].moving_std_array)
+        self.assertEqual(0, len(processed['AU0003']))
+        self.assertIs(preprocessing.bandpassCoefficients(), preprocessing.bandpassCoefficients())
+
+    def testMovingSumsAreCompensated(self):
+        rng = np.random.default_rng(3)
+        # Raw intensities near 2**32, where plain cumulative sums lose the noise
+        values = 4e9 + rng.normal(0, 300, 200_000)
+        timestamps = np.arange(len(values), dtype=np.int64) * 40_000_000
+        starts = preprocessing.windowStarts(timestamps, 30)
+        means = preprocessing.movingMean(values, starts)
+        for idx in (0, 749, 750, 123_456, len(values) - 1):
+            self.assertAlmostEqual(math.fsum(values[starts[idx]:idx + 1]) / (idx + 1 - starts[idx]), means[idx], delta=1e-6)
+
+def detectCrossingsLoop(detrended, moving_std, cutoff):
+    '''
+    The up/down state machine identifyFireballs used before detectCrossings, kept as its reference.
+    '''
+    starts, ends = [], []
+    up, down = True, False
+    for idx in range(len(detrended)):
+        std = moving_std[idx]
+        if detrended[idx] >= cutoff * std and up:
+            up, down = False, True
+            starts.append(idx)
+        if detrended[idx] <= cutoff * std and down:
+            down, up = False, True
+            ends.append(idx)
+    return starts[:len(ends)], ends
+
+class TestDetectCrossings(unittest.TestCase):
+    def testMatchesStateMachine(self):
+        rng = np.random.default_rng(13)
+        for _ in range(50):
+            n_samples = int(rng.integers(1, 400))
+            # Small integers give many samples exactly at the threshold, NaNs as at segment starts
+            detrended = rng.integers(0, 8, n_samples).astype(np.float64)
+            moving_std = rng.integers(1, 3, n_samples).astype(np.float64)
+            detrended[rng.random(n_samples) < 0.05] = np.nan
+            moving_std[rng.random(n_samples) < 0.05] = np.nan
+            moving_std[0] = np.nan
+
+            starts, ends = detectCrossings(detrended, moving_std, 3)
+            expected_starts, expected_ends = detectCrossingsLoop(detrended, moving_std, 3)
+            self.assertEqual(expected_starts, starts.tolist())
+            self.assertEqual(expected_ends, ends.tolist())
+
+    def testSameSampleEvent(self):
+        starts, ends = detectCrossings(np.array([0.0, 3.0, 4.0, 2.0, 9.0]), np.ones(5), 3)
+        self.assertEqual(([1, 2], [1, 3]), (starts.tolist(), ends.tolist()))
+
 if __name__=='__main__':
     unittest.main()
@@ -10,8 +10,14 @@
 import datetime
 import os
 import io
+import tarfile
 import numpy as np
 
+# FS binary layout: little-endian uint16 entry count, then one uint32 intensity per entry
+FS_COUNT_DTYPE = np.dtype('<u2')
+FS_ENTRY_DTYPE = np.dtype('<u4')
+FS_HEADER_SIZE = FS_COUNT_DTYPE.itemsize
+
 def filenameToDatetime(file_name, microseconds='auto'):
     """ Converts FF bin file name to a datetime object.
 
@@ -67,6 +73,93 @@ def filenameToDatetime(file_name, microseconds='auto'):
 
     return datetime.datetime(year, month, day, hour, minute, seconds, us)
 
+def decodeFieldIntensities(buffer, deinterlace=False):
+    """ Decode a whole field intensities binary in a single pass.
+
+    The FS format is a uint16 entry count followed by that many uint32 summed field intensities. The
+    intensities are returned as a read-only view on the given buffer, so no copy is made.
+
+    Arguments:
+        buffer: [bytes-like] Contents of an FS file.
+
+    Keyword arguments:
+        deinterlace: [bool] If True, the entries are fields rather than full frames.
+
+    Return:
+        (half_frames, intensity_array): [tuple of ndarrays] Frame number and summed intensity of each entry.
+
+    """
+
+    buffer = memoryview(buffer)
+    if buffer.nbytes < FS_HEADER_SIZE:
+        raise ValueError(f"Fieldsum buffer too short for header: {buffer.nbytes} bytes")
+
+    # Read the number of entries and make sure the buffer actually holds them
+    n_entries = int(np.frombuffer(buffer, dtype=FS_COUNT_DTYPE, count=1)[0])
+    expected_size = FS_HEADER_SIZE + n_entries*FS_ENTRY_DTYPE.itemsize
+    if buffer.nbytes < expected_size:
+        raise ValueError(f"Fieldsum header declares {n_entries} entries ({expected_size} bytes) "
+                         f"but buffer holds {buffer.nbytes} bytes")
+
+    intensity_array = np.frombuffer(buffer, dtype=FS_ENTRY_DTYPE, count=n_entries, offset=FS_HEADER_SIZE)
+
+    deinterlace_flag = 2.0 if deinterlace else 1.0
+    half_frames = np.arange(n_entries)/deinterlace_flag
+
+    return half_frames, intensity_array
+
+def frameTimestamps(start_time, n_entries, fps, deinterlace=False):
+    """ Compute the timestamps of every entry in an FS file.
+
+    Arguments:
+        start_time: [datetime] Time of the first frame, as given by filenameToDatetime.
+        n_entries: [int] Number of entries in the file.
+        fps: [float] Frames per second of the camera.
+
+    Keyword arguments:
+        deinterlace: [bool] If True, the entries are fields, i.e. two per frame.
+
+    Return:
+        [ndarray] int64 epoch nanoseconds, start + i*frame_period for each entry i.
+
+    """
+
+    deinterlace_flag = 2.0 if deinterlace else 1.0
+    period_ns = 1e9/(fps*deinterlace_flag)
+
+    start_ns = np.datetime64(start_time, 'ns').astype(np.int64)
+    return start_ns + np.rint(np.arange(n_entries)*period_ns).astype(np.int64)
+
+def mergeSortedBlocks(timestamp_blocks, value_blocks):
+    """ Merge blocks of samples that are each already sorted by time.
+
+    Blocks are ordered by their first timestamp and concatenated. Only if blocks overlap in time is a
+    stable sort done, which for int64 is a timsort that merges the existing sorted runs.
+
+    Arguments:
+        timestamp_blocks: [list of ndarrays] int64 timestamps of each block, each sorted.
+        value_blocks: [list of ndarrays] Values belonging to each timestamp block.
+
+    Return:
+        (timestamps, values): [tuple of ndarrays] All samples sorted by time.
+
+    """
+
+    if not timestamp_blocks:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint32)
+
+    order = sorted(range(len(timestamp_blocks)),
+                   key=lambda i: timestamp_blocks[i][0] if len(timestamp_blocks[i]) else np.iinfo(np.int64).max)
+    timestamps = np.concatenate([timestamp_blocks[i] for i in order])
+    values = np.concatenate([value_blocks[i] for i in order])
+
+    if len(timestamps) > 1 and np.any(timestamps[1:] < timestamps[:-1]):
+        sort_idx = np.argsort(timestamps, kind='stable')
+        timestamps = timestamps[sort_idx]
+        values = values[sort_idx]
+
+    return timestamps, values
+
 def readFieldIntensitiesBin(dir_path, file_name, deinterlace=False):
     """ Read the field intensities form a binary file.
 
@@ -76,49 +169,56 @@ def readFieldIntensitiesBin(dir_path, file_name, deinterlace=False):
     """
 
     with open(os.path.join(dir_path, file_name), 'rb') as fid:
-        # Read the number of entries
-        n_entries = int(np.fromfile(fid, dtype=np.uint16, count = 1))
+        return decodeFieldIntensities(fid.read(), deinterlace=deinterlace)
 
-        intensity_array = np.zeros(n_entries, dtype=np.uint32)
-        half_frames = np.zeros(n_entries)
+def readFieldIntensitiesBytes(bytes: io.BytesIO, deinterlace=False):
+    return decodeFieldIntensities(bytes.getbuffer(), deinterlace=deinterlace)
 
-        if deinterlace:
-            deinterlace_flag = 2.0
-        else:
-            deinterlace_flag = 1.0
-        
-        # fid.seek(0)
-        # Read individual entries
-        for i in range(n_entries):
+def iterFieldIntensitiesTarball(fs_tarball: tarfile.TarFile, deinterlace=False):
+    """ Decode the FS files of an FS tarball one at a time, in member order.
 
-            # Calculate the half frame
-            half_frames[i] = float(i)/deinterlace_flag
+    Works on archives opened in stream mode ('r|bz2'), so only one FS file is held in memory at a time.
 
-            # Read the summed field intensity
-            intensity_array[i] = int(np.fromfile(fid, dtype=np.uint32, count = 1))
+    Arguments:
+        fs_tarball: [TarFile] An opened FS*.tar.bz2 archive.
 
-        return half_frames, intensity_array
+    Keyword arguments:
+        deinterlace: [bool] If True, the entries are fields rather than full frames.
 
-def readFieldIntensitiesBytes(bytes: io.BytesIO, deinterlace=False):
-    # Read the number of entries
-    bytes.seek(0)
-    n_entries = int(np.frombuffer(bytes.read(2), dtype=np.uint16, count = 1))
+    Return:
+        [generator] (file_name, intensity_array) for each FS file.
 
-    intensity_array = np.zeros(n_entries, dtype=np.uint32)
-    half_frames = np.zeros(n_entries)
+    """
 
-    if deinterlace:
-        deinterlace_flag = 2.0
-    else:
-        deinterlace_flag = 1.0
+    for fs_member in fs_tarball:
+        fs_file = fs_tarball.extractfile(fs_member)
+        if fs_file is None: continue
 
-    # Read individual entries
-    for i in range(n_entries):
+        _, intensity_arr = decodeFieldIntensities(fs_file.read(), deinterlace=deinterlace)
+        yield os.path.basename(fs_member.name), intensity_arr
 
-        # Calculate the half frame
-        half_frames[i] = float(i)/deinterlace_flag
+def readFieldIntensitiesTarball(fs_tarball: tarfile.TarFile, deinterlace=False):
+    """ Decode every FS file in an FS tarball into one contiguous intensity array.
 
-        # Read the summed field intensity
-        intensity_array[i] = int(np.frombuffer(bytes.read(4), dtype=np.uint32, count = 1))
+    Arguments:
+        fs_tarball: [TarFile] An opened FS*.tar.bz2 archive.
 
-    return half_frames, intensity_array
+    Keyword arguments:
+        deinterlace: [bool] If True, the entries are fields rather than full frames.
+
+    Return:
+        (file_names, counts, intensity_array): [tuple] Base name of each decoded FS file, number of entries
+            in each, and all intensities concatenated in member order.
+
+    """
+
+    file_names = []
+    blocks = []
+    for file_name, intensity_arr in iterFieldIntensitiesTarball(fs_tarball, deinterlace=deinterlace):
+        file_names.append(file_name)
+        blocks.append(intensity_arr)
+
+    counts = np.array([len(block) for block in blocks], dtype=np.int64)
+    intensity_array = np.concatenate(blocks) if blocks else np.zeros(0, dtype=np.uint32)
+
+    return file_names, counts, intensity_array
@@ -0,0 +1,32 @@
+import os
+import hashlib
+
+from fireball_clustering import parameters
+
+def fileFingerprint(path: str, full: bool = False, block_size: int | None = None) -> str:
+    '''
+    Fingerprints the content of a file without decompressing it.
+
+    Args:
+        path (str): Path to the file.
+        full (bool): If True, hash the whole file. Otherwise only the first and last block are hashed,
+            together with the file size, which is enough to tell re-uploaded tarballs apart from new ones.
+        block_size (int): Size of the head and tail blocks. Defaults to parameters.FINGERPRINT_BLOCK_SIZE.
+    Returns:
+        str: '<SIZE>-<BLAKE2B HEX DIGEST>'
+    '''
+    block_size = parameters.FINGERPRINT_BLOCK_SIZE if block_size is None else block_size
+    size = os.path.getsize(path)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(size.to_bytes(8, 'little'))
+
+    with open(path, 'rb') as f:
+        if full or size <= 2 * block_size:
+            while chunk := f.read(1 << 20):
+                digest.update(chunk)
+        else:
+            digest.update(f.read(block_size))
+            f.seek(-block_size, os.SEEK_END)
+            digest.update(f.read(block_size))
+
+    return f'{size}-{digest.hexdigest()}'
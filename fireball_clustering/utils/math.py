@@ -25,6 +25,16 @@ def haversineRadiusPoint(lat, lon, distance_km, bearing_degrees):
 
     return new_lat, new_lon
 
+def haversineDistance(lat1, lon1, lat2, lon2) -> float:
+    ''' Returns the great circle distance in km between two coordinates in degrees '''
+    R = 6371.0
+    lat1_rad, lat2_rad = math.radians(lat1), math.radians(lat2)
+    delta_lat = lat2_rad - lat1_rad
+    delta_lon = math.radians(lon2 - lon1)
+
+    a = math.sin(delta_lat / 2) ** 2 + math.cos(lat1_rad) * math.cos(lat2_rad) * math.sin(delta_lon / 2) ** 2
+    return 2 * R * math.asin(math.sqrt(min(a, 1.0)))
+
 def stationsWithinRadius(stations: list[tuple[str, float, float]], lat: float, lon: float, radius_km: int) -> list:
     ''' Returns a list of stations within a radius of the given coordinates
 
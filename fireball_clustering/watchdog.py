@@ -1,67 +1,341 @@
 import os
 import time
+import uuid
+import queue
 import threading
 import traceback
-from queue import Queue
+import multiprocessing
+from collections import deque
 from datetime import datetime
 
 from fireball_clustering.data_ingestion.local_fetcher import ingestFromTarball
-from fireball_clustering.database.db_writes import insertFRs, insertFieldsums, setDataToIngested
+from fireball_clustering.data_ingestion.scanner import ParallelScanner, isScannedDir
+from fireball_clustering.data_processing.summaries import summarizeFieldsums
+from fireball_clustering.database import db_connection, db_queries, db_setup, db_writer, db_writes, sample_store
+from fireball_clustering.utils.fingerprint import fileFingerprint
 from fireball_clustering import parameters
 
-# Starts producer(FS upload handler) and consumer(FS ingestion) threads
+# Event driven upload detection needs the watchdog package and Linux inotify,
+# otherwise the producer falls back to polling
+try:
+    from watchdog.observers.inotify import InotifyObserver
+    from watchdog.events import FileSystemEventHandler
+except (ImportError, OSError):
+    InotifyObserver = None
+    FileSystemEventHandler = object
+
+# Starts producer(FS upload handler) thread and consumer(FS ingestion) processes
 class FileWatcher():
-    def __init__(self) -> None:
-        self.queue = Queue()
+    def __init__(self, writers: list[db_writer.WriterClient] | None = None) -> None:
+        '''
+        Args:
+            writers: Clients of the writer process, one for the watcher's own process followed by one
+                per consumer (parameters.WATCHDOG_WORKERS + 1 in all). Writes are applied directly if None.
+        '''
+        # DB writes of the producer and the consumers go through the writer process if there is one.
+        # Each process waits for replies on its own client.
+        writers = writers or [None] * (parameters.WATCHDOG_WORKERS + 1)
+        if len(writers) != parameters.WATCHDOG_WORKERS + 1:
+            raise ValueError(f'FileWatcher needs {parameters.WATCHDOG_WORKERS + 1} writer clients, got {len(writers)}.')
+        self.writer = writers[0]
+        db_writer.useClient(self.writer)
+
+        # Bounded so that a burst of uploads applies back-pressure to the producer. The consumers report
+        # the uploads they are done with on the done queue.
+        self.queue = multiprocessing.Queue(maxsize=parameters.INGEST_QUEUE_SIZE)
+        self.done = multiprocessing.Queue()
 
         # File event watching and handling (producer)
-        self.observer = FileWatcherProducer(self.queue)
+        self.observer = FileWatcherProducer(self.queue, self.done)
         self.observer.start()
 
-        # Queue handler
-        self.consumer = QueueConsumer(self.queue)
-        self.consumer.start()
-    
+        # Queue handlers, each ingesting one tarball at a time in its own process
+        self.consumers = [QueueConsumer(self.queue, worker_id, writers[worker_id + 1], self.done)
+                          for worker_id in range(parameters.WATCHDOG_WORKERS)]
+        for consumer in self.consumers:
+            consumer.start()
+
     def start_file_watcher(self):
         try:
             while True:
-                time.sleep(1)
+                time.sleep(parameters.WATCHDOG_STATS_INTERVAL)
+                self.report()
         finally:
             # self.observer.stop()
             self.observer.join()
-            self.consumer.join()
+            for consumer in self.consumers:
+                consumer.join()
+
+    def report(self):
+        try:
+            depth = self.queue.qsize()
+        except NotImplementedError:
+            depth = 'unknown'
+        print(f'[Watchdog] Queue depth: {depth}, spilled: {len(self.observer.spill)}')
+        if self.observer.last_scan_stats:
+            print(f'[Watchdog] Last scan: {self.observer.last_scan_stats}')
+        for consumer in self.consumers:
+            print(f'[Watchdog] {consumer.stats.summary(consumer.worker_id)}')
+
+class UploadEventHandler(FileSystemEventHandler):
+    '''
+    Enqueues uploads as soon as they are completely written (IN_CLOSE_WRITE) or moved into place (IN_MOVED_TO).
+    '''
+    def __init__(self, producer: 'FileWatcherProducer') -> None:
+        super().__init__()
+        self.producer = producer
+
+    def on_closed(self, event):
+        if not event.is_directory and isUploadPath(event.src_path):
+            self.producer.enqueue(event.src_path)
+
+    def on_moved(self, event):
+        if not event.is_directory and isUploadPath(event.dest_path):
+            self.producer.enqueue(event.dest_path)
+
+    def on_created(self, event):
+        # A file moved in from outside the watched tree raises IN_MOVED_TO without IN_MOVED_FROM, which
+        # arrives as a created event. It is only queued once its size and mtime have settled; a file that
+        # is still being written changes in the meantime and is queued by its close event instead.
+        if event.is_directory or not isUploadPath(event.src_path):
+            return
+        signature = fileSignature(event.src_path)
+        if signature is None or signature[0] == 0:
+            return
+        timer = threading.Timer(parameters.UPLOAD_SETTLE_SECONDS, self.enqueueIfSettled, (event.src_path, signature))
+        timer.daemon = True
+        timer.start()
+
+    def enqueueIfSettled(self, path: str, signature: tuple[int, int]):
+        if fileSignature(path) == signature:
+            self.producer.enqueue(path, signature)
+
+def fileSignature(path: str) -> tuple[int, int] | None:
+    '''
+    Returns:
+        tuple[int, int]: (size, mtime_ns) of a file, None if it no longer exists.
+    '''
+    try:
+        path_stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (path_stat.st_size, path_stat.st_mtime_ns)
+
+def isUploadPath(path: str, root: str | None = None) -> bool:
+    '''
+    Checks whether a path is an upload that the scan would pick up: a *.tar.bz2 whose parent directories
+    below the root are all six character station directories or processed directories.
+    '''
+    root = parameters.PATH if root is None else root
+    if not path.endswith('tar.bz2'):
+        return False
+
+    rel_dir = os.path.relpath(os.path.dirname(path), root)
+    if rel_dir == '.':
+        return True
+    if rel_dir.startswith('..'):
+        return False
+    return all(isScannedDir(name) for name in rel_dir.split(os.sep))
 
 class FileWatcherProducer():
-    def __init__(self, queue: Queue) -> None:
+    def __init__(self, queue: multiprocessing.Queue, done: 'multiprocessing.Queue | None' = None) -> None:
         self.queue = queue
+        self.done = done
         self.thread = threading.Thread(target=self.producer_loop)
         self.latest_timestamp = time.time()
 
+        # Paths that did not fit in the bounded queue, retried first on the next scan.
+        # Guarded by a lock because inotify events arrive on the observer thread
+        self.spill = deque()
+        self.lock = threading.Lock()
+        self.observer = None
+
+        # (size, mtime_ns) of each path that is queued or being ingested, so an upload is only queued
+        # once. Paths are forgotten when a consumer reports them done.
+        self.enqueued = {}
+
+        # Directory mtimes and subdirectories of the previous poll, directories that did not change
+        # are pruned and not listed again
+        self.scanner = ParallelScanner()
+        self.dir_mtimes = {}
+        self.dir_subdirs = {}
+        self.last_scan_stats = None
+
+    def start_inotify(self) -> bool:
+        '''
+        Starts watching parameters.PATH with inotify. Returns False if inotify is unavailable, in which
+        case the producer polls instead.
+        '''
+        if not parameters.USE_INOTIFY or InotifyObserver is None:
+            return False
+        try:
+            observer = InotifyObserver()
+            observer.schedule(UploadEventHandler(self), parameters.PATH, recursive=True)
+            observer.start()
+        except OSError as e:
+            print(f'[Watchdog] inotify unavailable ({e}), falling back to polling.')
+            return False
+        self.observer = observer
+        return True
+
+    def catch_up(self):
+        '''
+        Enqueues uploads that arrived while the watcher was not running, using the scan state
+        persisted in the DB. Directories whose mtime is unchanged since all of their uploads were
+        ingested are not listed again; only their recorded subdirectories are followed.
+
+        On the very first start the scan state is empty; the existing archive is then recorded as
+        the baseline instead of being ingested again. Directories are only recorded once their
+        uploads are settled (see is_settled).
+        '''
+        # Without a DB the first start still records its baseline, else the next start would
+        # ingest the whole archive
+        if not os.path.exists(db_connection.DB_PATH):
+            db_setup.initializeEmptyDatabase()
+        else:
+            db_setup.migrateDatabase()
+
+        scanned_files = db_queries.getScannedFiles()
+        scanned_dirs = db_queries.getScannedDirs()
+        scanned_subdirs = db_queries.getScannedSubdirs()
+        baseline = not scanned_files and not scanned_dirs
+
+        clean_dirs = []
+        baseline_files = []
+        count = 0
+        scanned, stats = self.scanner.scan(parameters.PATH, scanned_dirs, scanned_subdirs)
+        for scanned_dir in scanned:
+            if scanned_dir.files is None:
+                self.dir_mtimes[scanned_dir.path] = scanned_dir.mtime_ns
+                self.dir_subdirs[scanned_dir.path] = scanned_dir.subdirs
+                # Recorded before its subdirectories were, they are known from this listing on
+                if scanned_dir.path not in scanned_subdirs:
+                    clean_dirs.append((scanned_dir.path, scanned_dir.mtime_ns, scanned_dir.subdirs))
+                continue
+            pending = [(path, size, mtime_ns) for path, size, mtime_ns in scanned_dir.files
+                       if scanned_files.get(path) != (size, mtime_ns)]
+            if baseline:
+                baseline_files.extend(pending)
+            else:
+                for path, size, mtime_ns in pending:
+                    self.enqueue(path, (size, mtime_ns))
+                count += len(pending)
+            if self.is_settled(scanned_dir.files):
+                clean_dirs.append((scanned_dir.path, scanned_dir.mtime_ns, scanned_dir.subdirs))
+                self.dir_mtimes[scanned_dir.path] = scanned_dir.mtime_ns
+                self.dir_subdirs[scanned_dir.path] = scanned_dir.subdirs
+
+        db_writer.submit(('insertScannedFiles', (baseline_files,)), ('insertScannedDirs', (clean_dirs,)))
+
+        if baseline:
+            print(f'[Watchdog] Recorded {len(baseline_files)} existing uploads as the scan baseline.')
+        print(f'[Watchdog] Catch-up scanned {stats}, enqueued {count} uploads.')
+
     def producer_loop(self):
+        inotify = self.start_inotify()
+
+        # Catch up only once the live detection is running so no upload falls in between
+        try:
+            self.catch_up()
+        except Exception as e:
+            print(f'[Watchdog] Catch-up failed: {e}')
+            traceback.print_exc()
+
+        if inotify:
+            print(f'[Watchdog] Watching {parameters.PATH} with inotify.')
+            while True:
+                time.sleep(5)
+                self.evict_done()
+                self.drain_spill()
+
+        print(f'[Watchdog] Polling {parameters.PATH} every 5s.')
         while True:
             time.sleep(5)
-            # Check for new files by comparing to most recent upload
-            new_latest_timestamp = self.latest_timestamp
-            for path, mtime in self.fast_scan(parameters.PATH):
+            self.evict_done()
+            self.drain_spill()
+            self.poll()
+
+    def poll(self):
+        '''
+        Scans parameters.PATH once and enqueues the uploads modified since the most recent upload
+        of the previous polls.
+        '''
+        new_latest_timestamp = self.latest_timestamp
+        scanned, self.last_scan_stats = self.scanner.scan(parameters.PATH, self.dir_mtimes, self.dir_subdirs)
+        for scanned_dir in scanned:
+            if scanned_dir.files is None:
+                continue
+            for path, size, mtime_ns in scanned_dir.files:
+                mtime = mtime_ns / 1e9
                 if mtime > self.latest_timestamp:
-                    self.queue.put(path)
-                    print(f'[Watchdog] PUT path: {path} in the queue.')
+                    self.enqueue(path, (size, mtime_ns))
                     new_latest_timestamp = max(mtime, new_latest_timestamp)
-            self.latest_timestamp = new_latest_timestamp
-
-    def fast_scan(self, dir):
-        with os.scandir(dir) as it:
-            for entry in it:
-                entry_stat = entry.stat()
-
-                if entry.is_file() and entry.path.endswith('tar.bz2'):
-                    yield entry.path, entry_stat.st_mtime
-                
-                # Only check processed directory if it has been modified recently
-                if entry.is_dir() and entry.name.lower() == 'processed' and entry_stat.st_mtime > self.latest_timestamp:
-                    yield from self.fast_scan(entry.path)
-                elif entry.is_dir() and entry.name.lower() != 'processed' and len(entry.name) == 6: 
-                    yield from self.fast_scan(entry.path)
+
+            # Listed again on the next poll until its uploads are settled
+            if self.is_settled(scanned_dir.files):
+                self.dir_mtimes[scanned_dir.path] = scanned_dir.mtime_ns
+                self.dir_subdirs[scanned_dir.path] = scanned_dir.subdirs
+            else:
+                self.dir_mtimes.pop(scanned_dir.path, None)
+                self.dir_subdirs.pop(scanned_dir.path, None)
+        self.latest_timestamp = new_latest_timestamp
+
+    def is_settled(self, files: list[tuple[str, int, int]]) -> bool:
+        '''
+        Checks whether a directory's uploads allow pruning it until its mtime changes: none of them is
+        queued, being ingested or was modified within parameters.UPLOAD_SETTLE_SECONDS. Writing to an
+        upload does not change the mtime of its directory, so pruning earlier would hide the rest of
+        a half-written upload.
+        '''
+        settled_ns = time.time_ns() - int(parameters.UPLOAD_SETTLE_SECONDS * 1e9)
+        with self.lock:
+            return all(path not in self.enqueued and mtime_ns <= settled_ns for path, _, mtime_ns in files)
+
+    def enqueue(self, path, signature=None):
+        if signature is None:
+            signature = fileSignature(path)
+            if signature is None:
+                return
+
+        with self.lock:
+            if self.enqueued.get(path) == signature:
+                return
+            self.enqueued[path] = signature
+
+            # Keep the order of uploads, nothing goes to the queue while older paths are spilled
+            if not self.spill:
+                try:
+                    self.queue.put_nowait(path)
+                    print(f'[Watchdog] PUT path: {path} in the queue.')
+                    return
+                except queue.Full:
+                    pass
+            self.spill.append(path)
+            print(f'[Watchdog] Queue full, spilled path: {path} ({len(self.spill)} spilled).')
+
+    def evict_done(self):
+        '''
+        Forgets the uploads that consumers are done with, ingested or failed, so a later change to
+        them is queued again and enqueued does not grow with the archive.
+        '''
+        if self.done is None:
+            return
+        with self.lock:
+            while True:
+                try:
+                    path = self.done.get_nowait()
+                except queue.Empty:
+                    return
+                self.enqueued.pop(path, None)
+
+    def drain_spill(self):
+        with self.lock:
+            while self.spill:
+                try:
+                    self.queue.put_nowait(self.spill[0])
+                except queue.Full:
+                    return
+                print(f'[Watchdog] PUT spilled path: {self.spill.popleft()} in the queue.')
 
     def start(self):
         self.thread.start()
@@ -70,39 +344,126 @@ class FileWatcherProducer():
     def join(self):
         self.thread.join()
 
+class IngestionStats():
+    '''
+    Throughput counters of a single ingestion worker, shared with the watchdog process.
+    '''
+    def __init__(self) -> None:
+        self.files = multiprocessing.Value('q', 0)
+        self.failures = multiprocessing.Value('q', 0)
+        self.samples = multiprocessing.Value('q', 0)
+        self.bytes = multiprocessing.Value('q', 0)
+        self.busy_seconds = multiprocessing.Value('d', 0.0)
+
+    def record(self, size: int, samples: int, seconds: float, failed: bool = False):
+        with self.files.get_lock():
+            self.files.value += 1
+            self.failures.value += int(failed)
+            self.samples.value += samples
+            self.bytes.value += size
+            self.busy_seconds.value += seconds
+
+    def summary(self, worker_id: int) -> str:
+        with self.files.get_lock():
+            files = self.files.value
+            failures = self.failures.value
+            samples = self.samples.value
+            megabytes = self.bytes.value / 1e6
+            busy = self.busy_seconds.value
+        rate = megabytes / busy if busy else 0.0
+        return (f'Worker {worker_id}: {files} files ({failures} failed), {samples} samples, '
+                f'{megabytes:.1f} MB in {busy:.1f}s busy ({rate:.2f} MB/s)')
+
 class QueueConsumer():
-    def __init__(self, queue: Queue) -> None:
+    def __init__(self, queue: multiprocessing.Queue, worker_id: int = 0, writer: db_writer.WriterClient | None = None,
+                 done: 'multiprocessing.Queue | None' = None) -> None:
         self.queue = queue
-        self.thread = threading.Thread(target=self.consumer_loop)
+        self.done = done
+        self.worker_id = worker_id
+        self.writer = writer
+        self.stats = IngestionStats()
+        # Not a daemon so that ingestion can use its own process pool for large uploads
+        self.process = multiprocessing.Process(target=self.consumer_loop, name=f'ingestion-worker-{worker_id}')
+
+    def __getstate__(self):
+        # The process handle cannot be sent to the child when it is spawned rather than forked
+        state = self.__dict__.copy()
+        state.pop('process', None)
+        return state
 
     def consumer_loop(self):
+        db_writer.useClient(self.writer)
         while True:
-            src_path = self.queue.get(timeout=10) if not self.queue.empty() else None
+            src_path = self.queue.get()
             if src_path == None:
-                continue
-            print(f'[Watchdog] Ingesting files from {src_path}')
+                break
+            print(f'[Watchdog] Worker {self.worker_id} ingesting files from {src_path}')
+            start_time = time.time()
+            samples = 0
+            failed = False
             try:
-                station_data, fr_files = ingestFromTarball(src_path)
-                
-                # src_path of format path/to/fieldsums/dir/AU000X_239123_19.tar.bz2
-                split_path = src_path.split('_')
-                station_id_path = split_path[0]
-                station_id = station_id_path.split('/')[-1]
-                date_str = split_path[1]
-                date_obj = datetime.strptime(date_str, '%Y%m%d')
-
-                insertFieldsums(station_id, date_obj, station_data)
-                insertFRs(station_id, date_obj, fr_files)
-                setDataToIngested([(station_id, date_obj)])
+                samples = self.ingest(src_path)
                 print(f'[Watchdog] Files ingested from {src_path}')
             except Exception as e:
+                failed = True
                 print(f'Error: {e}')
                 traceback.print_exc()
+            finally:
+                size = os.path.getsize(src_path) if os.path.exists(src_path) else 0
+                self.stats.record(size, samples, time.time() - start_time, failed)
+                if self.done is not None:
+                    self.done.put(src_path)
+
+    def ingest(self, src_path: str) -> int:
+        src_stat = os.stat(src_path)
+
+        # Re-uploads of content that was already ingested are skipped before any decompression
+        fingerprint = fileFingerprint(src_path)
+        if db_queries.isIngestedFingerprint(fingerprint):
+            print(f'[Watchdog] Skipping {src_path}, its content has already been ingested.')
+            db_writer.submit(('insertScannedFiles', ([(src_path, src_stat.st_size, src_stat.st_mtime_ns)],)))
+            return 0
+
+        station_data, fr_files = ingestFromTarball(src_path)
+
+        # src_path of format path/to/fieldsums/dir/AU000X_239123_19.tar.bz2
+        split_path = src_path.split('_')
+        station_id_path = split_path[0]
+        station_id = station_id_path.split('/')[-1]
+        date_str = split_path[1]
+        date_obj = datetime.strptime(date_str, '%Y%m%d')
+
+        # The samples are written to the store here, the writer only catalogs them, and all rows of
+        # the upload are committed together. The file is the upload's own, so uploads of the same
+        # night by other workers cannot replace it before or after its catalog row is committed.
+        path = sample_store.samplePath(station_id, date_obj, uuid.uuid4().hex)
+        n_samples, start_ns, end_ns = sample_store.writeSamples(path, station_data)
+        summaries = summarizeFieldsums(station_data)
+        try:
+            # The ledger entry comes first, the batch is rolled back if another worker recorded it already
+            _, previous_path, *_ = db_writer.call(
+                ('insertLedgerEntry', (fingerprint, src_path, station_id, date_obj)),
+                ('catalogFieldsums', (station_id, date_obj, path, n_samples, start_ns, end_ns)),
+                ('insertSummaries', (station_id, start_ns, end_ns, summaries)),
+                ('insertFRs', (station_id, date_obj, fr_files)),
+                ('setDataToIngested', ([(station_id, date_obj)],)),
+                ('insertScannedFiles', ([(src_path, src_stat.st_size, src_stat.st_mtime_ns)],)),
+            )
+        except db_writes.DuplicateUpload:
+            print(f'[Watchdog] Skipping {src_path}, its content was ingested by another worker.')
+            sample_store.removeSamples(path)
+            db_writer.submit(('insertScannedFiles', ([(src_path, src_stat.st_size, src_stat.st_mtime_ns)],)))
+            return 0
+
+        # The upload this one replaced is no longer cataloged
+        if previous_path is not None:
+            sample_store.removeSamples(previous_path)
+        return len(station_data)
 
     def start(self):
-        self.thread.start()
-        print('[Watchdog] Consumer started.')
+        self.process.start()
+        print(f'[Watchdog] Consumer {self.worker_id} started.')
 
     def join(self):
-        self.thread.join()
+        self.process.join()
 
@@ -1,23 +1,43 @@
+import os
 import multiprocessing
 
 from fireball_clustering import watchdog
 from fireball_clustering import analysis_pipeline
+from fireball_clustering import parameters
+from fireball_clustering.database import db_setup, db_connection, db_writer
 
-def run_watchdog():
-    file_watcher = watchdog.FileWatcher()
+def run_watchdog(writers):
+    file_watcher = watchdog.FileWatcher(writers)
     file_watcher.start_file_watcher()
 
-def run_analysis_pipeline():
-    analysis = analysis_pipeline.Analysis()
+def run_analysis_pipeline(writer):
+    analysis = analysis_pipeline.Analysis(writer)
     analysis.start()
     analysis.join()
 
 if __name__ == "__main__":
-    p1 = multiprocessing.Process(target=run_watchdog)
-    p2 = multiprocessing.Process(target=run_analysis_pipeline)
+    # Create the database, or bring an existing one up to the current schema, before the writer
+    # and any worker use it
+    if os.path.exists(db_connection.DB_PATH):
+        db_setup.migrateDatabase()
+    else:
+        db_setup.initializeEmptyDatabase()
+        db_setup.insertStations()
+    db_connection.closeConnection()
+
+    # All DB writes of the watchdog and the analysis pipeline go through one writer process
+    writer = db_writer.DatabaseWriter()
+    # One client per process that waits on the writer: the watcher and each of its consumers
+    watchdog_writers = [writer.client() for _ in range(parameters.WATCHDOG_WORKERS + 1)]
+    analysis_writer = writer.client()
+    writer.start()
+
+    p1 = multiprocessing.Process(target=run_watchdog, args=(watchdog_writers,))
+    p2 = multiprocessing.Process(target=run_analysis_pipeline, args=(analysis_writer,))
 
     p1.start()
     p2.start()
 
     p1.join()
     p2.join()
+    writer.stop()